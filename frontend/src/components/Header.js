@@ -25,7 +25,11 @@ export default function Header ({documentTitle='Untitled', sidebarOpen=false, to
       // Request timeout to only send request once user has stopped typing
       const delayDebounceFn = setTimeout(() => {
         baseRequest(user, setUser, history, (accessToken) => {
-          fetch(`/api/users/search/?search=${searchBarValue}`, {
+          const query = new URLSearchParams({'q': searchBarValue});
+          if (documentId) {
+            query.set('document', documentId);
+          }
+          fetch(`/api/users/autocomplete/?${query}`, {
             method: 'GET',
             headers: {
               'Authorization': `Bearer ${accessToken}`,
@@ -37,7 +41,7 @@ export default function Header ({documentTitle='Untitled', sidebarOpen=false, to
           }).then((data) => {
             if (data !== undefined) {
               console.log("Search Response", data);
-              setSearchResults(data);
+              setSearchResults(data.results);
             }
           });
         });
@@ -26,6 +26,8 @@ export default function EditorPage() {
 
   // Document
   const [documents, setDocuments] = useState(null);
+  // Link to the next page of documents, only loaded when the user asks for more
+  const [nextDocumentsUrl, setNextDocumentsUrl] = useState(null);
   const [currentDocumentId, setCurrentDocumentId] = useState(null);
   const [documentCollaborators, setDocumentCollaborators] = useState(null);
   const [authenticationTicket, setAuthenticationTicket] = useState(null);
@@ -113,9 +115,10 @@ export default function EditorPage() {
     }
   };
 
-  useEffect(() => {
+  const fetchDocuments = (url) => {
+    // Documents are listed a page at a time, most recently modified first
     baseRequest(user, setUser, history, (accessToken) => {
-      fetch('/api/documents/', {
+      fetch(url, {
         method: 'GET',
         headers: {
           'Authorization': `Bearer ${accessToken}`,
@@ -126,17 +129,36 @@ export default function EditorPage() {
         }
       }).then((data) => {
         if (data !== undefined) {
+          const page = data.results;
           // Set untitled default text
-          for (var i=0; i < data.length; i++) {
-            if (data[i].title === '') {
-              data[i].title = 'Untitled';
+          for (var i=0; i < page.length; i++) {
+            if (page[i].title === '') {
+              page[i].title = 'Untitled';
             }
           }
-          setDocuments(data);
-          console.log("DOCUMENTS", data);
+          setDocuments((documents) => [...(documents || []), ...page]);
+          if (data.next !== null) {
+            // Next page link is absolute, keep requests going through the same origin
+            const next = new URL(data.next);
+            setNextDocumentsUrl(next.pathname + next.search);
+          }
+        } else {
+          // Let the user try again
+          setNextDocumentsUrl(url);
         }
       });
-    })
+    });
+  };
+
+  const loadMoreDocuments = () => {
+    // Hidden until the page has loaded, so it's only requested once
+    const url = nextDocumentsUrl;
+    setNextDocumentsUrl(null);
+    fetchDocuments(url);
+  };
+
+  useEffect(() => {
+    fetchDocuments('/api/documents/');
   }, []);
 
   const fetchDocument = (id) => {
@@ -149,7 +171,11 @@ export default function EditorPage() {
         },
       }).then((response) => {
         if (response.ok) {
-          return response.json();
+          // Ticket is sent as a header so it's fresh even when the browser reuses its cached copy of the document
+          return response.json().then((data) => ({
+            ...data,
+            authentication_ticket: response.headers.get('X-Authentication-Ticket'),
+          }));
         }
         return undefined;
       }).then((data) => {
@@ -186,8 +212,8 @@ export default function EditorPage() {
         data.title = 'Untitled';
         setCurrentDocumentId(data.id);
         setDocuments([
-          ...documents,
-          data
+          data,
+          ...documents
         ]);
       })
     });
@@ -352,6 +378,15 @@ export default function EditorPage() {
         });
         // }
         break;
+
+      case 'sync_document':
+        // Sent the whole document when the connection fell too far behind to be sent every update
+        if (data.body.editor !== undefined) {
+          setDocumentEditorState((editorState) => EditorState.push(editorState, convertFromRaw(data.body.editor), 'apply-entity'));
+          setPreviousTitle(data.body.title);
+          setTitleEditorState((editorState) => EditorState.push(editorState, ContentState.createFromText(data.body.title)));
+        }
+        break;
     }
   }
 
@@ -422,6 +457,9 @@ export default function EditorPage() {
             <h4 style={{margin: '12px 0', cursor: 'pointer'}}>{document.title}</h4>
           </div>;
         })}
+        {nextDocumentsUrl !== null && <div style={{padding: '12px 18px'}}>
+          <Button text='Load more' onClick={loadMoreDocuments} />
+        </div>}
       </Sidebar>}
       
       <div style={{marginLeft: `${sidebarContentMargin !== 0 ? sidebarContentMargin: 0}px`, position: 'sticky', top: '0px', background: '#101010', zIndex: '10', height: '64px'}}>
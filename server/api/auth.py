@@ -1,3 +1,5 @@
+import hmac
+import time
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
 from channels.db import database_sync_to_async
@@ -6,13 +8,20 @@ from authentication.models import User
 
 async def is_token_valid(access_token: str, user: User) -> bool:
     """ Given a JWT determine wether its valid and matches a given user object (for a current WebSocket session) """
+    return await validate_token(access_token, user) is not None
+
+
+async def validate_token(access_token: str, user: User):
+    """ Given a JWT return its validated token if it's valid and matches the given user, otherwise None """
     authenticator = JWTAuthentication()
 
     try:
         validated_token = authenticator.get_validated_token(access_token)
-        return await get_token_user(validated_token) == user
+        if await get_token_user(validated_token) == user:
+            return validated_token
     except InvalidToken:
-        return False
+        pass
+    return None
 
 
 @database_sync_to_async
@@ -26,3 +35,30 @@ def get_token_user(validated_token) -> User:
         return None
     except AuthenticationFailed:
         return None
+
+
+class AccessTokenCache:
+    """
+    Remembers the last access token validated for a WebSocket connection. Clients send their
+    access token with every message, so once a token has been fully validated, later messages
+    carrying the same token only need comparing against it and checking it hasn't expired.
+    """
+    __slots__ = ('_token', '_expires_at')
+
+    def __init__(self) -> None:
+        self._token: bytes = None
+        self._expires_at: float = 0
+
+    async def is_valid(self, access_token: str, user: User) -> bool:
+        token: bytes = access_token.encode()
+        if self._token is not None and hmac.compare_digest(token, self._token) and time.time() < self._expires_at:
+            return True
+
+        # New or expired token, validate it fully before trusting it
+        self._token = None
+        validated_token = await validate_token(access_token, user)
+        if validated_token is None:
+            return False
+
+        self._token, self._expires_at = token, validated_token['exp']
+        return True
@@ -0,0 +1,80 @@
+from __future__ import annotations
+import threading
+from collections import OrderedDict
+from time import monotonic
+from django.conf import settings
+from django.db.models.functions import Lower
+from authentication.models import User
+
+# Sorts after every character, so a prefix up to it covers every username starting with the prefix
+PREFIX_END = '\U0010ffff'
+# SQLite's lower() only folds ASCII letters, prefixes are folded the same way so they compare like the index
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+def ascii_lower(text: str) -> str:
+    """ Lowercase ASCII letters only, as SQLite's lower() does """
+    return text.translate(ASCII_LOWER)
+
+
+def users_with_prefix(prefix: str, limit: int) -> list[User]:
+    """
+    First `limit` users by username whose username starts with `prefix`, ignoring the case of ASCII
+    letters. Queried as a range over the lowercased username so it's served by the user_username_lower
+    index rather than a LIKE scan of every user.
+    """
+    prefix = ascii_lower(prefix)
+    return list(User.objects.annotate(username_lower=Lower('username')).filter(
+        username_lower__gte=prefix, username_lower__lt=prefix + PREFIX_END,
+    ).order_by('username_lower').only('id', 'username', 'profile_picture')[:limit])
+
+
+class UsernamePrefixCache:
+    """
+    Least recently used cache of the users matching each username prefix typed into the add
+    collaborator box, so the same few prefixes autocompleted by everyone don't query every keystroke.
+    Each prefix holds up to `candidates` users for `ttl` seconds, enough that the results still
+    fill up once a document's existing collaborators are left out of them. A user registering is
+    dropped from every prefix of their username, so they can be added straight away.
+    """
+
+    def __init__(self, ttl: float, candidates: int, max_size: int) -> None:
+        self.ttl = ttl
+        self.candidates = candidates
+        self.max_size = max_size
+        # Lowercased prefix to (expiry time, matching users)
+        self._prefixes: OrderedDict[str, tuple[float, list[User]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, prefix: str) -> list[User]:
+        """ Users whose username starts with `prefix`, querying and caching them if necessary """
+        prefix = ascii_lower(prefix)
+        with self._lock:
+            cached = self._prefixes.get(prefix)
+            if cached is not None and cached[0] > monotonic():
+                self._prefixes.move_to_end(prefix)
+                return cached[1]
+
+        users = users_with_prefix(prefix, self.candidates)
+        with self._lock:
+            self._prefixes[prefix] = (monotonic() + self.ttl, users)
+            self._prefixes.move_to_end(prefix)
+            while len(self._prefixes) > self.max_size:
+                self._prefixes.popitem(last=False)
+        return users
+
+    def clear(self) -> None:
+        with self._lock:
+            self._prefixes.clear()
+
+    def invalidate(self, username: str) -> None:
+        """ Forget every prefix a username would be listed under """
+        username = ascii_lower(username)
+        with self._lock:
+            for length in range(len(username) + 1):
+                self._prefixes.pop(username[:length], None)
+
+
+username_prefix_cache = UsernamePrefixCache(
+    settings.USER_AUTOCOMPLETE_CACHE_TTL.total_seconds(), settings.USER_AUTOCOMPLETE_CANDIDATES,
+    settings.USER_AUTOCOMPLETE_CACHE_SIZE)
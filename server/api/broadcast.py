@@ -0,0 +1,116 @@
+from __future__ import annotations
+import asyncio
+import logging
+from time import perf_counter
+from django.conf import settings
+from channels.layers import get_channel_layer
+from api import codecs, metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastAggregator:
+    """
+    Collects the update_document_content responses sockets in this process send for a document
+    over DOCUMENT_BROADCAST_WINDOW, then broadcasts them to the document's group as one event, so
+    each recipient is sent a single frame per tick rather than one per batch. Batches keep their
+    revision order. Senders are never sent their own operations back, each gets a frame holding
+    only everyone else's.
+    With a zero window every batch is broadcast as soon as it's added.
+    """
+    # Group events sent, and batches which were folded into another batch's event instead of their own
+    events_sent = 0
+    events_saved = 0
+
+    def __init__(self, group: str) -> None:
+        self.group = group
+        # (sender channel name, response frame) pairs waiting to be broadcast
+        self.pending: list[tuple[str, dict]] = []
+        # When each pending response was added
+        self.added_at: list[float] = []
+        self.pending_operations = 0
+        self._task: asyncio.Task = None
+
+    @property
+    def window(self) -> float:
+        return settings.DOCUMENT_BROADCAST_WINDOW.total_seconds()
+
+    async def add(self, sender_channel_name: str, response: dict) -> None:
+        """ Queue a response frame (a RESPONSE_KEYS dict) sent by a socket in this process for broadcast """
+        self.pending.append((sender_channel_name, response))
+        self.added_at.append(perf_counter())
+        self.pending_operations += len(response['body']['data'])
+
+        if not self.window or self.pending_operations >= settings.DOCUMENT_BROADCAST_MAX_OPERATIONS:
+            await self.flush()
+        elif self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception('Failed to broadcast updates to %s', self.group)
+
+    async def flush(self) -> None:
+        """ Broadcast everything pending as a single event """
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+            self._task = None
+        if not self.pending:
+            return
+
+        pending = sorted(self.pending, key=lambda item: item[1]['revision'])
+        added_at = self.added_at
+        self.pending, self.added_at, self.pending_operations = [], [], 0
+        await get_channel_layer().group_send(self.group, self.event(pending))
+
+        sent_at = perf_counter()
+        for time in added_at:
+            metrics.BROADCAST_SECONDS.observe(sent_at - time)
+
+        BroadcastAggregator.events_sent += 1
+        BroadcastAggregator.events_saved += len(pending) - 1
+
+    def close(self) -> None:
+        """ Stop waiting to broadcast, for when the document has no sockets left to send to """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.pending, self.added_at, self.pending_operations = [], [], 0
+
+    @staticmethod
+    def encode(responses: list[dict]) -> str:
+        """ Client facing frame for a list of responses, combined into one update when there's more than one """
+        if len(responses) == 1:
+            return codecs.dumps(responses[0])
+        sender_user_ids = {response.get('sender_user_id') for response in responses}
+        return codecs.dumps({
+            'type': 'update_document_content',
+            'body': {'data': [update for response in responses for update in response['body']['data']]},
+            'revision': responses[-1]['revision'],
+            'sender_user_id': sender_user_ids.pop() if len(sender_user_ids) == 1 else None,
+        })
+
+    @classmethod
+    def event(cls, pending: list[tuple[str, dict]]) -> dict:
+        """
+        Group event for pending responses. Every sender of one of the batches gets its own frame
+        without its batches in it, None if it sent all of them, everyone else gets `text`.
+        """
+        responses = [response for sender, response in pending]
+        texts = {}
+        for sender in {sender for sender, response in pending}:
+            others = [response for other, response in pending if other != sender]
+            texts[sender] = cls.encode(others) if others else None
+
+        return {
+            'type': 'update_document_content',
+            # Every batch was sent from this process, so any sender identifies where the event came from
+            'sender_channel_name': pending[0][0],
+            'batches': [[response['revision'], len(response['body']['data'])] for response in responses],
+            'text': cls.encode(responses),
+            'texts': texts,
+        }
@@ -0,0 +1,87 @@
+"""
+Encodings websocket frames are sent in.
+
+Sockets use JSON text frames unless they ask for the `msgpack` subprotocol when connecting, in
+which case frames both ways are MessagePack encoded binary. orjson is used for JSON whenever it's
+installed, msgpack has to be installed for the binary subprotocol to be offered.
+
+Broadcasts are encoded to JSON once by the sender (see api.broadcast), sockets using another
+codec transcode that text, which is cached so each broadcast is transcoded once per process
+rather than once per socket.
+"""
+from __future__ import annotations
+import json
+from functools import lru_cache
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+if orjson is not None:
+    def dumps(data: Any) -> str:
+        return orjson.dumps(data).decode()
+    loads = orjson.loads
+else:
+    def dumps(data: Any) -> str:
+        return json.dumps(data)
+    loads = json.loads
+
+
+class JSONCodec:
+    """ Default codec, JSON text frames """
+    subprotocol: str = None
+
+    def decode(self, text_data: str = None, bytes_data: bytes = None) -> Any:
+        """ Decode a frame, raising ValueError if it isn't valid """
+        return loads(text_data if text_data is not None else bytes_data)
+
+    def encode(self, data: Any) -> str:
+        return dumps(data)
+
+    def from_json(self, text: str) -> str:
+        """ Frame for data which has already been encoded as JSON """
+        return text
+
+
+class MessagePackCodec:
+    """ Binary MessagePack frames, for clients which ask for the `msgpack` subprotocol """
+    subprotocol = 'msgpack'
+
+    def decode(self, text_data: str = None, bytes_data: bytes = None) -> Any:
+        if bytes_data is None:
+            # Clients may still send the odd text frame
+            return loads(text_data)
+        return msgpack.unpackb(bytes_data)
+
+    def encode(self, data: Any) -> bytes:
+        return msgpack.packb(data)
+
+    def from_json(self, text: str) -> bytes:
+        return json_to_msgpack(text)
+
+
+@lru_cache(maxsize=256)
+def json_to_msgpack(text: str) -> bytes:
+    return msgpack.packb(loads(text))
+
+
+JSON = JSONCodec()
+# Subprotocols which can be negotiated, in order of preference
+SUBPROTOCOL_CODECS = {codec.subprotocol: codec for codec in (
+    [MessagePackCodec()] if msgpack is not None else [])}
+
+
+def negotiate(subprotocols: list[str]):
+    """ Codec for the first subprotocol a client asked for that's supported, JSON if there isn't one """
+    for subprotocol in subprotocols:
+        if subprotocol in SUBPROTOCOL_CODECS:
+            return SUBPROTOCOL_CODECS[subprotocol]
+    return JSON
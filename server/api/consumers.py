@@ -1,14 +1,21 @@
-import json
+import logging
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from api.models import Document, ContentBlock, InlineStyle
-from api.serializers import *
+from api import codecs, metrics
+from api.flowcontrol import REPLY, UPDATE, PRESENCE, ReceiveQueue, SendQueue, TokenBucket
+from api.models import Document, DocumentCollaborator
+from api.operations import (Operation, WebSocketMessage, UpdateDocumentContent, UpdateDocumentTitle, SyncDocument, LoadBlocks,
+                            Presence, operation_for)
+from api.permissions import permission_cache, NOT_CACHED
+from api.serializers import DocumentCollaboratorSerializer
+from api.session import BlockExists, DocumentSession
+from api.writer import database_writers
 from authentication.models import User
-from .auth import is_token_valid
+from .auth import AccessTokenCache
 
-# TODO: Once REDIS is set up, look at loading document object and all children into this to reduce lookup times in main database
-#        then drip feed updates back in every few minutes and leave redis when all websocket's close. Make super fast!!
+logger = logging.getLogger(__name__)
 
 
 class DocumentConsumer(AsyncWebsocketConsumer):
@@ -16,156 +23,335 @@ class DocumentConsumer(AsyncWebsocketConsumer):
     Consumer to handle collaborative document editing, along with
     'saveless' editing (user doesn't need to spam Ctrl+S)
     """
-    METHOD_SERIALIZERS = {
-        'insert': InsertDocumentContentSerializer,
-        'delete': DeleteDocumentContentSerializer,
-        'split-block': SplitContentBlockSerializer,
-        'set-block-type': SetContentBlockTypeSerializer,
-        'set-inline-style': SetInlineStyleSerializer,
-        # This exists solely for base error catching/handling
-        '': BaseDocumentUpdateContentSerializer,
+    RESPONSE_KEYS = ('type', 'body', 'sender_user_id', 'revision')
+    # Highest DocumentCollaborator.permission level allowed to send each message type
+    REQUIRED_PERMISSIONS = {
+        'update_document_content': DocumentCollaborator.EDITOR,
+        'update_document_title': DocumentCollaborator.EDITOR,
+        'add_new_collaborator': DocumentCollaborator.ADMIN,
+        'sync_document': DocumentCollaborator.VIEWER,
+        'load_blocks': DocumentCollaborator.VIEWER,
+        'presence': DocumentCollaborator.VIEWER,
     }
-    RESPONSE_KEYS = ('type', 'body', 'sender_user_id')
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self._errors: list = []
+        self.session: DocumentSession = None
+        # Id of the socket's entry in the document's DocumentPresence
+        self.connection: str = None
+        self.access_token_cache = AccessTokenCache()
+        self.codec = codecs.JSON
+        # Frames are queued rather than sent straight away, so a slow client can't hold up the channel layer
+        self.send_queue = SendQueue(self.send_frame, self.close_slow, settings.SOCKET_SEND_QUEUE_SIZE,
+                                    {UPDATE: self.document_snapshot, PRESENCE: self.presence_snapshot})
+        # Messages are handled from a queue of their own, so waiting on the rate limit doesn't hold up channel layer events
+        self.receive_queue = ReceiveQueue(self.handle_message, self.close_flooding, settings.SOCKET_RECEIVE_QUEUE_SIZE,
+                                          TokenBucket(settings.SOCKET_RECEIVE_RATE, settings.SOCKET_RECEIVE_BURST))
 
     async def connect(self) -> None:
         """ Run when websocket connection established """
         self.document_id: str = self.scope['url_route']['kwargs']['document_id']
-        try:
-            self.document: Document = await self.get_document(self.document_id)
-            self.user: User = self.scope['user']
-            if self.is_user_contributor(self.user, self.document):
-                # Join channel group
-                self.document_group_name = f'document_{self.document_id}'
-                await self.channel_layer.group_add(self.document_group_name, self.channel_name)
-                await self.accept()
-
-        except ObjectDoesNotExist:
-            pass
+        self.user: User = self.scope['user']
+        # Users who aren't collaborators, including of documents which don't exist, are turned away
+        if self.user is not None and await self.get_permission() is not None:
+            # Join channel group first, so no edits are missed by a copy of the document loaded from the database
+            self.document_group_name = f'document_{self.document_id}'
+            await self.channel_layer.group_add(self.document_group_name, self.channel_name)
+            # Load the document into memory (or share the already loaded copy) for editing
+            self.session = await DocumentSession.join(self.document_id)
+            self.document: Document = self.session.document
+            # Frames are JSON text unless the client asked for a binary subprotocol
+            self.codec = codecs.negotiate(self.scope.get('subprotocols', []))
+            await self.accept(subprotocol=self.codec.subprotocol)
+        else:
+            await self.close()
 
     async def disconnect(self, close_code) -> None:
         """ Run when websocket connection terminates """
-        await self.channel_layer.group_discard(self.document_group_name, self.channel_name)
+        self.send_queue.stop()
+        self.receive_queue.stop()
+        if self.session is not None:
+            if self.connection is not None:
+                await self.session.presence.leave(self.connection)
+                await self.channel_layer.group_discard(self.session.presence.group, self.channel_name)
+            await self.channel_layer.group_discard(self.document_group_name, self.channel_name)
+            await self.session.leave()
 
-    async def receive(self, text_data) -> None:
+    async def receive(self, text_data: str = None, bytes_data: bytes = None) -> None:
         """ Run when server websocket receives data from client """
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except ValueError:
+            await self.send_encoded(self.codec.encode({'errors': [{'non_field_errors': ['Message could not be decoded.']}]}))
+            return
+        if isinstance(data, dict) and data.get('type') == 'presence':
+            # Cursor moves are coalesced rather than rate limited, they don't use up the socket's budget for edits
+            await self.receive_presence(data.get('body'))
+            return
+        self.receive_queue.put(data)
+
+    async def handle_message(self, data) -> None:
+        """ Handle a decoded message taken from the receive queue """
         # TODO improve errors returned via websocket
-        serializer = await self.load_message_serializer(text_data)
-        response = json.loads(text_data)
+        message = WebSocketMessage(data)
+        # Filled in with validated fields as the message is handled, the client's access token never goes anywhere near it
+        response: dict = {'type': data.get('type')} if isinstance(data, dict) else {}
 
-        if serializer.is_valid():
-            if await self.is_valid_access_token(serializer.validated_data['access_token']):
-                type: str = serializer.validated_data['type']
-                body: dict = serializer.validated_data['body']
+        if message.is_valid():
+            if await self.is_valid_access_token(message.access_token):
+                type: str = message.type
+                body: dict = message.body
+                metrics.MESSAGES.inc(self.metric_type(type))
 
-                if type == 'update_document_content':
-                    serializers = await self.document_update_type(body)
-                    for serializer in serializers:
-                        await self.save_serializer(serializer, pass_document_instance=True)
+                if type not in self.REQUIRED_PERMISSIONS:
+                    await self.raise_error({'type': f'Unknown message type {type}'})
+
+                elif not await self.has_permission(self.REQUIRED_PERMISSIONS[type]):
+                    await self.raise_error({'permission': 'You do not have permission to do this'})
+
+                elif type == 'update_document_content':
+                    operations = await self.document_update_type(body)
+                    # Only apply the batch if every update in it is valid
+                    if not self._errors:
+                        # Only validated fields are broadcast, whatever else the client sent along with them
+                        response['body'] = {'data': [operation.data for operation in operations]}
+                        try:
+                            response['revision'] = await self.session.apply(operations, self.user)
+                        except ObjectDoesNotExist:
+                            await self.raise_error({'block': ['Content block does not exist.']})
+                        except BlockExists:
+                            await self.raise_error({'newBlock': ['Content block already exists.']})
 
                 elif type == 'update_document_title':
-                    title_serializer = UpdateDocumentTitleSerializer(data=body)
-                    if title_serializer.is_valid():
-                        await self.save_serializer(title_serializer, pass_document_instance=True)
+                    title = UpdateDocumentTitle(body)
+                    if title.is_valid():
+                        title.save(instance=self.session)
+                        response['body'] = {'title': title.title}
                     else:
-                        await self.raise_error(serializer.errors)
+                        await self.raise_error(title.errors)
+
+                elif type == 'sync_document':
+                    sync = SyncDocument(body)
+                    if sync.is_valid():
+                        # Only the reconnecting client needs catching up, nothing to broadcast
+                        await self.send_encoded(self.codec.encode({
+                            'type': 'sync_document',
+                            'body': self.session.sync(sync.revision),
+                        }))
+                        return
+                    else:
+                        await self.raise_error(sync.errors)
+
+                elif type == 'load_blocks':
+                    window = LoadBlocks(body)
+                    if window.is_valid():
+                        try:
+                            # Served from the live copy of the document, only to the socket which asked
+                            await self.send_encoded(self.codec.encode({
+                                'type': 'load_blocks',
+                                'body': self.session.blocks_window(window.limit, window.offset, window.after),
+                            }))
+                            return
+                        except ObjectDoesNotExist:
+                            await self.raise_error({'after': ['Content block does not exist.']})
+                    else:
+                        await self.raise_error(window.errors)
 
                 # TODO Streamline these methods into a single switch like condition
                 elif type == 'add_new_collaborator':
                     body['document'] = str(self.document.id)
                     serializer = await self.create_document_collaborator_serializer(body)
                     if await self.is_serializer_valid(serializer):
-                        await self.save_serializer(serializer, pass_document_instance=False)
+                        await self.save_serializer(serializer)
                         response['body'] = await self.serializer_data(serializer)
                     else:
                         await self.raise_error(serializer.errors)
             else:
                 await self.raise_error({"access_token": "Invalid access token"})
         else:
-            await self.raise_error()
+            await self.raise_error(message.errors)
 
         response['sender_user_id'] = str(self.user.id)
         response['sender_channel_name'] = self.channel_name
-        print(response)
         await self.send_response(response)
 
+    async def receive_presence(self, body: dict) -> None:
+        """
+        Cursor moves skip the access token check and everything else an edit goes through, they
+        change nothing but where the user's cursor is shown, and the socket's user is already known.
+        Sockets are only sent presence events once they've sent their own cursor, so clients which
+        don't show cursors aren't sent anyone else's.
+        """
+        metrics.MESSAGES.inc('presence')
+        presence = Presence(body)
+        if not presence.is_valid():
+            metrics.MESSAGE_ERRORS.inc('presence')
+            await self.send_encoded(self.codec.encode({'errors': [presence.errors]}))
+        elif await self.has_permission(self.REQUIRED_PERMISSIONS['presence']):
+            if self.connection is None:
+                await self.join_presence()
+            self.session.presence.move(self.connection, presence.selection)
+
+    async def join_presence(self) -> None:
+        """ Start receiving presence events, sending the socket its connection id and everyone already present """
+        await self.channel_layer.group_add(self.session.presence.group, self.channel_name)
+        self.connection, present = await self.session.presence.join(self.user)
+        await self.send_encoded(self.presence_frame(present))
+
+    def presence_frame(self, present: list[dict]) -> str | bytes:
+        """ Frame listing everyone present, which replaces whoever the client thought was present """
+        return self.codec.encode({
+            'type': 'presence',
+            'body': {'connection': self.connection, 'events': [{'event': 'joined', **entry} for entry in present]},
+        })
+
+    def presence_snapshot(self) -> tuple[None, str | bytes]:
+        """ Frame sent in place of presence events dropped from the send queue """
+        return None, self.presence_frame(list(self.session.presence.entries.values()))
+
+    def document_snapshot(self) -> tuple[int, str | bytes]:
+        """ Frame sent in place of updates dropped from the send queue, the whole document as it is now """
+        body = self.session.snapshot()
+        return body['revision'], self.codec.encode({'type': 'sync_document', 'body': body})
+
     async def raise_error(self, errors: dict = None):
         # 1002 - data is flawed, throw all blame on the client lol
-        print('ERRORS', errors)
-        self._errors += errors
+        if errors:
+            self._errors.append(errors)
         # self.close(code=1002)
         # self.send(json.dumps(errors))
 
     async def send_response(self, text_data):
         # TODO Once everything is working, potentially don't send websocket response to sender, might see performance improvements
-        print("RESPONSE")
         if self._errors:
-            print(json.dumps(self._errors))
-            await self.send(text_data=json.dumps({"errors": self._errors}))
+            metrics.MESSAGE_ERRORS.inc(self.metric_type(text_data.get('type')))
+            logger.debug('Message from %s rejected: %s', self.channel_name, self._errors)
+            await self.send_encoded(self.codec.encode({"errors": self._errors}))
             self._errors = []
         else:
             # Group send send the message to other consumers, thus we need a method which will run when its received
-            await self.channel_layer.group_send(self.document_group_name, text_data)
-
-    async def document_update_type(self, data: dict) -> list[BaseDocumentUpdateContentSerializer]:
-        """ Convert update message to specific update type serializer. If invalid, None is returned """
-        # Generic parent serializer
-        serializer = UpdateDocumentContentSerializer(data=data)
-        serializers = []
-
-        if serializer.is_valid():
-            # Specific update type serializer
-            for update in serializer.validated_data['data']:
-                serializer = self.METHOD_SERIALIZERS.get(
-                    update.get('type', ''))(data=update)
-                if serializer.is_valid():
-                    serializers.append(serializer)
+            if text_data['type'] == 'update_document_content':
+                # Edits may be held back briefly, to be sent along with other edits to the document
+                await self.session.broadcaster.add(self.channel_name, {
+                    key: text_data[key] for key in self.RESPONSE_KEYS if key in text_data})
+            else:
+                await self.channel_layer.group_send(self.document_group_name, self.broadcast_event(text_data))
+
+    def metric_type(self, type) -> str:
+        """ Message type to label metrics with, clients can send any type so unknown types share one label """
+        return type if isinstance(type, str) and type in self.REQUIRED_PERMISSIONS else 'unknown'
+
+    def broadcast_event(self, response: dict) -> dict:
+        """
+        Group event for a response, carrying the frame sent to clients already encoded so every
+        recipient forwards the same text rather than encoding it again
+        """
+        return {
+            'type': response['type'],
+            'sender_channel_name': response['sender_channel_name'],
+            'text': codecs.dumps({key: response[key] for key in self.RESPONSE_KEYS if key in response}),
+        }
+
+    async def document_update_type(self, data: dict) -> list[Operation]:
+        """ Convert update message to specific update type operations, validating every update in the batch """
+        # Generic parent message
+        content = UpdateDocumentContent(data)
+        operations = []
+
+        if content.is_valid():
+            # Specific update type operation
+            for update in content.data:
+                operation = operation_for(update)
+                if operation.is_valid():
+                    operations.append(operation)
                 else:
-                    await self.raise_error(serializer.errors)
+                    await self.raise_error(operation.errors)
         else:
-            await self.raise_error(serializer.errors)
-        return serializers
+            await self.raise_error(content.errors)
+        return operations
 
     async def is_valid_access_token(self, token):
-        return await is_token_valid(token, self.scope['user'])
+        return await self.access_token_cache.is_valid(token, self.scope['user'])
 
     # TODO Implement event methods for all update types
     async def update_document_content(self, event):
-        """Event handler for update_document_content messages"""
-        if event['sender_channel_name'] != self.channel_name:
-            await self._event_send(event)
+        """Event handler for update_document_content messages, built by BroadcastAggregator"""
+        # Edits from other processes are replicated into the session by the session itself, in revision order
+        # Sockets whose edits are in the event are sent everything except their own edits
+        text: str = event['texts'].get(self.channel_name, event['text'])
+        if text is not None:
+            # Tagged with the latest revision in the frame, so it's skipped if a snapshot has already caught the socket up
+            await self.send_encoded(self.codec.from_json(text), UPDATE, event['batches'][-1][0])
 
     async def update_document_title(self, event):
         """Event handler for update_document_title messages"""
-        print("UPDATE", event['sender_channel_name'], self.channel_name)
+        if not self.is_local_channel(event['sender_channel_name']):
+            self.session.set_title(codecs.loads(event['text'])['body']['title'])
         if event['sender_channel_name'] != self.channel_name:
-            await self._event_send(event)
+            await self._event_send(event, UPDATE)
+
+    async def presence(self, event):
+        """Event handler for presence events, built by DocumentPresence"""
+        self.session.presence.apply(event)
+        await self._event_send(event, PRESENCE)
+
+    async def skip_revisions(self, event):
+        """Event handler for revisions another process reserved and didn't use, which only its DocumentSession needs"""
+
+    async def flush_document(self, event):
+        """Event handler for another process about to load the document, which needs this process' edits written first"""
+        await self.session.flush()
+        await self.channel_layer.send(event['reply_channel'], {'type': 'document_flushed', 'channel': self.channel_name})
+
+    def is_local_channel(self, channel_name: str) -> bool:
+        """ Determine wether a channel belongs to this process, and so shares this process' DocumentSession """
+        is_local_channel = getattr(self.channel_layer, 'is_local_channel', None)
+        return is_local_channel is None or is_local_channel(channel_name)
 
     async def add_new_collaborator(self, event):
         """Event handler for add_new_collaborator messages"""
+        # Roster may have been changed by another process, whose signals won't have reached this cache
+        permission_cache.invalidate(self.document_id)
         await self._event_send(event)
 
-    async def _event_send(self, event: dict) -> None:
-        """Method to send responses from event handlers"""
-        await self.send(
-            text_data=json.dumps(
-                {key: event[key] for key in event if key in self.RESPONSE_KEYS})
-        )
+    async def _event_send(self, event: dict, kind: str = REPLY) -> None:
+        """Method to send responses from event handlers, the frame was encoded once by the sender"""
+        await self.send_encoded(self.codec.from_json(event['text']), kind)
 
-    @database_sync_to_async
-    def load_message_serializer(self, text_data) -> WebSocketMessageSerializer:
-        return WebSocketMessageSerializer(data=json.loads(text_data), context={'user': self.scope['user']})
+    async def send_encoded(self, frame, kind: str = REPLY, revision: int = None) -> None:
+        """ Queue a frame encoded by the socket's codec to be sent, without waiting for it to be sent """
+        self.send_queue.put(frame, kind, revision)
 
-    @database_sync_to_async
-    def get_document(self, id: str) -> Document:
-        return Document.objects.get(id=id)
+    async def send_frame(self, frame) -> None:
+        """ Send a frame from the send queue, as a binary frame if it's bytes """
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def close_flooding(self) -> None:
+        """ Close a socket sending messages faster than its rate limit for so long they can't all be handled """
+        logger.info('Closing %s, too many messages held back by its rate limit', self.channel_name)
+        # 1008 - policy violation
+        await self.close(code=1008)
+
+    async def close_slow(self) -> None:
+        """ Close a socket which still can't keep up once everything which can be dropped has been """
+        logger.info('Closing %s, too far behind on frames sent to it', self.channel_name)
+        # 1013 - try again later
+        await self.close(code=1013)
+
+    async def has_permission(self, required_permission: int) -> bool:
+        """ Determine wether the user's permission level is at least `required_permission`, without a query once cached """
+        permission = permission_cache.peek(self.document_id, self.user.id)
+        if permission is NOT_CACHED:
+            permission = await self.get_permission()
+        return permission is not None and permission <= required_permission
 
     @database_sync_to_async
-    def is_user_contributor(self, user: User, document: Document) -> bool:
-        return user in document.collaborators.all()
+    def get_permission(self) -> int:
+        return permission_cache.get(self.document_id, self.user.id)
 
     @database_sync_to_async
     def create_document_collaborator_serializer(self, body: dict) -> DocumentCollaboratorSerializer:
@@ -180,8 +366,6 @@ class DocumentConsumer(AsyncWebsocketConsumer):
     def serializer_data(self, serializer) -> dict:
         return serializer.data
 
-    @database_sync_to_async
-    def save_serializer(self, serializer, pass_document_instance: bool = True) -> None:
-        """Sync to Async wrapper around serializer.save method"""
-        kwargs = {'instance': self.document} if pass_document_instance else {}
-        serializer.save(**kwargs)
+    async def save_serializer(self, serializer) -> None:
+        """Sync to Async wrapper around serializer.save method, saved by the document's writer thread"""
+        await database_writers.run(self.document_id, serializer.save)
@@ -0,0 +1,222 @@
+"""
+Flow control for document websockets, so one slow or noisy client can't hold up everyone else
+sharing its document.
+
+Frames sent to a socket wait in its own bounded SendQueue rather than being sent from channel layer
+handlers, which would otherwise block the consumer, and with it the channel layer queue every
+broadcast to the document is put on, for as long as the client takes to read each frame.
+Messages received from a socket wait in its ReceiveQueue, and are handled at the rate its TokenBucket
+allows. Those over the limit are held back rather than dropped, as a client can't take back edits
+it has already shown its user, but without holding up the consumer's channel layer handlers.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+from typing import Any, Awaitable, Callable
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+# Kinds of frame queued. Replies are never dropped, updates to the document (edits and titles) and
+# presence events can be replaced by a snapshot of the document or of everyone present
+REPLY, UPDATE, PRESENCE = 'reply', 'update', 'presence'
+
+
+class SendQueue:
+    """
+    Frames waiting to be sent to one socket, sent in order by a task of its own. Putting a frame
+    never waits, if the socket falls `size` frames behind:
+
+    1. Queued presence events are coalesced, dropped for a single frame of everyone present.
+    2. Queued updates are dropped for a snapshot of the whole document, and further updates are
+       dropped until it's sent. Updates sent afterwards which are already in it are skipped.
+    3. If the queue is still full, the socket is closed.
+
+    Snapshots are made by `snapshots`, which return the revision the snapshot is at (or None) and
+    the frame, when it's about to be sent so it's as up to date as possible.
+    """
+
+    def __init__(self, send: Callable[[Any], Awaitable], close: Callable[[], Awaitable], size: int,
+                 snapshots: dict[str, Callable[[], tuple[int, Any]]]) -> None:
+        self.send = send
+        self.close = close
+        self.size = size
+        self.snapshots = snapshots
+        self.frames: deque[tuple[str, int, Any]] = deque()
+        # Kinds of frame which were dropped and are waiting on a snapshot
+        self.pending: set[str] = set()
+        # Revision of the last document snapshot sent
+        self.revision: int = None
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task: asyncio.Task = None
+        self._closing: asyncio.Task = None
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def put(self, frame: Any, kind: str = REPLY, revision: int = None) -> None:
+        """ Queue a frame to be sent, `revision` being the latest revision of the updates in an update frame """
+        if self.closed or self._covered(kind, revision):
+            return
+        if len(self.frames) >= self.size and not self._make_room(kind):
+            metrics.SLOW_SOCKETS.inc('closed')
+            self.stop()
+            self._closing = asyncio.create_task(self.close())
+            return
+        if kind in self.pending:
+            metrics.SEND_QUEUE_DROPPED.inc(kind)
+            return
+
+        self.frames.append((kind, revision, frame))
+        self._ready.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._drain())
+
+    def _covered(self, kind: str, revision: int) -> bool:
+        """ Whether an update is already in the snapshot which was sent """
+        return kind == UPDATE and None not in (revision, self.revision) and revision <= self.revision
+
+    def _make_room(self, kind: str) -> bool:
+        """ Drop queued presence events, and then updates, for snapshots, returning whether there's room for a frame of `kind` """
+        for droppable, action in ((PRESENCE, 'coalesced'), (UPDATE, 'resynced')):
+            dropped = [frame for frame in self.frames if frame[0] == droppable]
+            if not dropped and kind != droppable:
+                continue
+            if droppable not in self.pending:
+                metrics.SLOW_SOCKETS.inc(action)
+            self.pending.add(droppable)
+            self.frames = deque(frame for frame in self.frames if frame[0] != droppable)
+            metrics.SEND_QUEUE_DROPPED.inc(droppable, amount=len(dropped))
+            self._ready.set()
+            # A frame of the kind dropped is itself dropped, there's no need for room
+            if kind == droppable or len(self.frames) < self.size:
+                return True
+        return False
+
+    async def _drain(self) -> None:
+        while True:
+            if self.pending:
+                # Snapshots go first, they replace frames which were queued before anything still queued
+                kind = UPDATE if UPDATE in self.pending else PRESENCE
+                self.pending.discard(kind)
+                revision, frame = self.snapshots[kind]()
+                if revision is not None:
+                    self.revision = revision
+            elif self.frames:
+                kind, revision, frame = self.frames.popleft()
+                if self._covered(kind, revision):
+                    continue
+            else:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            try:
+                await self.send(frame)
+            except Exception:
+                logger.exception('Failed to send a %s frame', kind)
+
+    def stop(self) -> None:
+        """ Drop everything queued and stop sending, for when the socket has closed """
+        self.closed = True
+        self.frames.clear()
+        self.pending.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class ReceiveQueue:
+    """
+    Messages received from one socket, handled in order by a task of its own no faster than `limit`
+    allows. Waiting for the limit here rather than in the consumer leaves it free to handle channel
+    layer events meanwhile, so the socket is still sent everyone else's edits. A socket with `size`
+    messages waiting is sending faster than it ever could be handled, and is closed.
+    """
+
+    def __init__(self, handle: Callable[[Any], Awaitable], close: Callable[[], Awaitable], size: int,
+                 limit: TokenBucket) -> None:
+        self.handle = handle
+        self.close = close
+        self.size = size
+        self.limit = limit
+        self.messages: deque[Any] = deque()
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task: asyncio.Task = None
+        self._closing: asyncio.Task = None
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def put(self, message: Any) -> None:
+        if self.closed:
+            return
+        if len(self.messages) >= self.size:
+            metrics.FLOODING_SOCKETS.inc()
+            self.stop()
+            self._closing = asyncio.create_task(self.close())
+            return
+
+        self.messages.append(message)
+        self._ready.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._drain())
+
+    async def _drain(self) -> None:
+        while True:
+            if not self.messages:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            if (delay := self.limit.reserve()):
+                metrics.RATE_LIMITED.inc()
+                await asyncio.sleep(delay)
+            try:
+                # A message being handled when the socket closes is seen through, an edit may be half applied
+                await asyncio.shield(self.handle(self.messages.popleft()))
+            except Exception:
+                logger.exception('Failed to handle a message')
+
+    def stop(self) -> None:
+        """ Drop everything waiting and stop handling messages, for when the socket has closed """
+        self.closed = True
+        self.messages.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class TokenBucket:
+    """
+    Rate limit of `rate` a second on average, in bursts of up to `burst`. Tokens are topped up
+    from the time since the last one was taken, rather than by a timer.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+
+    def _top_up(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+    def take(self) -> bool:
+        """ Take a token, returning False if there are none left """
+        self._top_up()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def reserve(self) -> float:
+        """ Take a token whether or not there's one left, returning the seconds until it would have been topped up """
+        self._top_up()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
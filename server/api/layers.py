@@ -0,0 +1,332 @@
+"""
+Channel layer for running several ASGI worker processes on one host without Redis.
+
+Every worker process connects to a single broker process (`python manage.py runbroker`) over a
+Unix domain socket. The broker keeps track of group membership and which worker each channel
+lives in, and fans a group_send out as one frame per worker, listing that worker's channels,
+rather than one frame per channel. Groups with members in the sending process are delivered to
+locally without going through the broker at all.
+
+The broker also hands out sequence numbers, which live document sessions use so that revisions
+stay unique when a document is open in more than one worker, and can count the workers a
+group_send reached so the sender can wait for each of them to reply (see `group_request`).
+
+Only process specific channels (the `specific.` channels consumers are given) are supported,
+messages to normal channels would need a worker to pull them from a shared queue.
+"""
+import asyncio
+import json
+import logging
+import os
+import struct
+from uuid import uuid4
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!I')
+
+
+async def read_frame(reader: asyncio.StreamReader) -> dict:
+    """ Read a single length prefixed JSON frame """
+    header: bytes = await reader.readexactly(HEADER.size)
+    return json.loads(await reader.readexactly(HEADER.unpack(header)[0]))
+
+
+def write_frame(writer: asyncio.StreamWriter, frame: dict) -> None:
+    """ Buffer a single length prefixed JSON frame to be written """
+    data: bytes = json.dumps(frame, separators=(',', ':')).encode()
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+def channel_worker(channel: str) -> str:
+    """ Id of the worker process a process specific channel belongs to, `specific.<worker>!<client>` """
+    return channel.partition('!')[0].rpartition('.')[2]
+
+
+class ChannelBroker:
+    """ Routes channel layer messages between the worker processes connected to it """
+
+    # Frames are dropped for workers with more than this many bytes waiting to be written to them
+    MAX_WORKER_BUFFER = 16 * 1024 * 1024
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.workers: dict[str, asyncio.StreamWriter] = {}
+        self.groups: dict[str, set[str]] = {}
+        self.sequences: dict[str, int] = {}
+
+    async def serve(self) -> None:
+        if os.path.exists(self.path):
+            # Left behind by a broker which didn't shut down cleanly
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle_worker, path=self.path)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        worker: str = None
+        try:
+            while True:
+                frame: dict = await read_frame(reader)
+                command: str = frame['command']
+
+                if command == 'hello':
+                    worker = frame['worker']
+                    self.workers[worker] = writer
+                elif command == 'send':
+                    self.deliver(channel_worker(frame['channel']), [frame['channel']], frame['message'])
+                elif command == 'group_add':
+                    self.groups.setdefault(frame['group'], set()).add(frame['channel'])
+                elif command == 'group_discard':
+                    self.discard(frame['group'], frame['channel'])
+                elif command == 'group_send':
+                    workers = self.group_send(
+                        frame['group'], frame['message'], exclude=worker)
+                    if 'id' in frame:
+                        write_frame(
+                            writer, {'command': 'reply', 'id': frame['id'], 'value': workers})
+                elif command == 'sequence':
+                    write_frame(writer, {'command': 'reply', 'id': frame['id'], 'value': self.sequence(
+                        frame['key'], frame['count'], frame['minimum'])})
+                elif command == 'flush':
+                    self.remove_worker_channels(worker)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if worker is not None and self.workers.get(worker) is writer:
+                del self.workers[worker]
+                self.remove_worker_channels(worker)
+            writer.close()
+
+    def deliver(self, worker: str, channels: list[str], message: dict) -> None:
+        writer = self.workers.get(worker)
+        if writer is None or writer.transport.get_write_buffer_size() > self.MAX_WORKER_BUFFER:
+            # Worker has gone, or isn't keeping up, drop the message as a full channel would
+            return
+        write_frame(writer, {'command': 'deliver',
+                    'channels': channels, 'message': message})
+
+    def group_send(self, group: str, message: dict, exclude: str = None) -> int:
+        """ Send a message to every channel in a group, as a single frame per worker, returning the number of workers """
+        channels_by_worker: dict[str, list[str]] = {}
+        for channel in self.groups.get(group, ()):
+            channels_by_worker.setdefault(
+                channel_worker(channel), []).append(channel)
+        channels_by_worker.pop(exclude, None)
+
+        for worker, channels in channels_by_worker.items():
+            self.deliver(worker, channels, message)
+        return len(channels_by_worker)
+
+    def discard(self, group: str, channel: str) -> None:
+        channels = self.groups.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.groups[group]
+
+    def remove_worker_channels(self, worker: str) -> None:
+        for group, channels in list(self.groups.items()):
+            for channel in [channel for channel in channels if channel_worker(channel) == worker]:
+                self.discard(group, channel)
+
+    def sequence(self, key: str, count: int, minimum: int) -> int:
+        """ Reserve the next `count` numbers of a sequence (above `minimum`), returning the last one """
+        value = max(self.sequences.get(key, 0), minimum) + count
+        self.sequences[key] = value
+        return value
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """ Channel layer connecting this worker process to a ChannelBroker, see module docstring """
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path: str, expiry: int = 60, capacity: int = 100, channel_capacity: dict = None, **kwargs) -> None:
+        super().__init__(expiry=expiry, capacity=capacity,
+                         channel_capacity=channel_capacity, **kwargs)
+        self.path = path
+        self.worker_id: str = uuid4().hex
+        # Messages waiting to be received by each channel in this process
+        self._queues: dict[str, asyncio.Queue] = {}
+        # Local group membership, replayed to the broker if the connection has to be re-established
+        self._groups: dict[str, set[str]] = {}
+        self._requests: dict[int, asyncio.Future] = {}
+        self._request_id = 0
+
+        self._loop: asyncio.AbstractEventLoop = None
+        self._writer: asyncio.StreamWriter = None
+        self._connect_lock: asyncio.Lock = None
+
+    # CONNECTION
+
+    async def _connection(self) -> asyncio.StreamWriter:
+        """ Connection to the broker, (re)connecting if there isn't one for the running event loop """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Anything belonging to a previous event loop can't be used from this one
+            self._loop, self._writer, self._connect_lock = loop, None, asyncio.Lock()
+            self._queues, self._requests = {}, {}
+
+        if self._writer is None or self._writer.is_closing():
+            async with self._connect_lock:
+                if self._writer is None or self._writer.is_closing():
+                    reader, writer = await asyncio.open_unix_connection(self.path)
+                    write_frame(
+                        writer, {'command': 'hello', 'worker': self.worker_id})
+                    for group, channels in self._groups.items():
+                        for channel in channels:
+                            write_frame(
+                                writer, {'command': 'group_add', 'group': group, 'channel': channel})
+                    await writer.drain()
+                    self._writer = writer
+                    loop.create_task(self._read(reader, writer))
+        return self._writer
+
+    async def _command(self, **frame) -> None:
+        writer = await self._connection()
+        write_frame(writer, frame)
+        await writer.drain()
+
+    async def _request(self, **frame):
+        """ Send a command to the broker and wait for its reply """
+        writer = await self._connection()
+        self._request_id += 1
+        future = self._loop.create_future()
+        self._requests[self._request_id] = future
+        write_frame(writer, {**frame, 'id': self._request_id})
+        await writer.drain()
+        return await future
+
+    async def _read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """ Handle frames from the broker for as long as the connection lasts """
+        try:
+            while True:
+                frame: dict = await read_frame(reader)
+                if frame['command'] == 'deliver':
+                    for channel in frame['channels']:
+                        self._deliver(channel, frame['message'])
+                elif frame['command'] == 'reply':
+                    future = self._requests.pop(frame['id'], None)
+                    if future is not None and not future.done():
+                        future.set_result(frame['value'])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if self._writer is writer:
+                logger.warning('Lost connection to channel broker at %s', self.path)
+        finally:
+            writer.close()
+            if self._writer is writer:
+                self._writer = None
+            for future in self._requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Lost connection to channel broker'))
+            self._requests = {}
+
+    def _queue(self, channel: str) -> asyncio.Queue:
+        if (queue := self._queues.get(channel)) is None:
+            queue = self._queues[channel] = asyncio.Queue(
+                maxsize=self.get_capacity(channel))
+        return queue
+
+    def _deliver(self, channel: str, message: dict) -> bool:
+        """ Queue a message for a channel in this process, False if the channel is full """
+        queue = self._queue(channel)
+        if queue.full():
+            return False
+        queue.put_nowait(message)
+        return True
+
+    def is_local_channel(self, channel: str) -> bool:
+        """ Determine wether a channel belongs to this worker process """
+        return channel_worker(channel) == self.worker_id
+
+    # CHANNEL LAYER API
+
+    async def new_channel(self, prefix: str = 'specific') -> str:
+        return f'{prefix}.{self.worker_id}!{uuid4().hex}'
+
+    async def send(self, channel: str, message: dict) -> None:
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        if '!' not in channel:
+            raise NotImplementedError(
+                'BrokerChannelLayer only supports process specific channels')
+
+        if self.is_local_channel(channel):
+            await self._connection()
+            if not self._deliver(channel, message):
+                raise ChannelFull(channel)
+        else:
+            await self._command(command='send', channel=channel, message=message)
+
+    async def receive(self, channel: str) -> dict:
+        self.require_valid_channel_name(channel)
+        # Make sure messages from the broker are being read
+        await self._connection()
+        return await self._queue(channel).get()
+
+    async def group_add(self, group: str, channel: str) -> None:
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self._groups.setdefault(group, set()).add(channel)
+        await self._command(command='group_add', group=group, channel=channel)
+
+    async def group_discard(self, group: str, channel: str) -> None:
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        channels = self._groups.get(group, set())
+        channels.discard(channel)
+        if not channels:
+            self._groups.pop(group, None)
+        if not any(channel in channels for channels in self._groups.values()):
+            # Channel isn't listening to anything any more, stop holding messages for it
+            self._queues.pop(channel, None)
+        await self._command(command='group_discard', group=group, channel=channel)
+
+    async def group_send(self, group: str, message: dict) -> None:
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        # Members in this process are delivered to directly, the broker handles every other process
+        for channel in self._groups.get(group, ()):
+            self._deliver(channel, message)
+        await self._command(command='group_send', group=group, message=message)
+
+    async def flush(self) -> None:
+        self._queues, self._groups = {}, {}
+        await self._command(command='flush')
+
+    async def close(self) -> None:
+        """ Disconnect from the broker, it will forget this process' group memberships """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    # EXTENSIONS
+
+    async def group_request(self, group: str, message: dict, timeout: float) -> None:
+        """
+        Send a message to a group's channels in every other process, waiting until a channel in
+        each of those processes has replied, or `timeout` seconds have passed. Receivers reply
+        by sending a message holding their `channel` name to the message's `reply_channel`.
+        """
+        reply_channel: str = await self.new_channel()
+        try:
+            workers: int = await self._request(command='group_send', group=group, message={**message, 'reply_channel': reply_channel})
+            replied: set[str] = set()
+            async with asyncio.timeout(timeout):
+                while len(replied) < workers:
+                    reply: dict = await self.receive(reply_channel)
+                    replied.add(channel_worker(reply['channel']))
+        except TimeoutError:
+            logger.warning('Timed out waiting for replies to %s from group %s',
+                           message.get('type'), group)
+        finally:
+            self._queues.pop(reply_channel, None)
+
+    async def sequence(self, key: str, count: int = 1, minimum: int = 0) -> int:
+        """
+        Reserve the next `count` numbers of a sequence shared by every process connected to the
+        broker, returning the last one. The sequence starts from at least `minimum`.
+        """
+        return await self._request(command='sequence', key=key, count=count, minimum=minimum)
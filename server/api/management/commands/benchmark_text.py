@@ -0,0 +1,78 @@
+import random
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from api.text import Rope
+
+
+class Command(BaseCommand):
+    """
+    Benchmark editing a block's text with the Rope used by live document sessions against
+    rebuilding the whole str with slicing on every update, as the update serializers used to.
+    Ropes up to Rope.FLAT_SIZE are sliced strs themselves, for those the difference left is the
+    cost of calling a method for each update.
+    """
+    help = 'Benchmark Rope text edits against str slicing for a simulated typing session'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000],
+                            help='Starting lengths of the block being edited')
+        parser.add_argument('--ops', type=int, default=5_000,
+                            help='Number of updates in each typing session')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"length":>10} {"str (ms)":>12} {"rope (ms)":>12} {"speedup":>9}')
+        for size in options['sizes']:
+            updates = self.typing_session(size, options['ops'], options['seed'])
+            str_time, str_result = self.time(self.apply_str, 'x' * size, updates)
+            rope_time, rope_result = self.time(self.apply_rope, 'x' * size, updates)
+            assert str_result == rope_result, 'Rope and str edits diverged'
+
+            self.stdout.write(
+                f'{size:>10} {str_time * 1000:>12.2f} {rope_time * 1000:>12.2f} {str_time / rope_time:>8.1f}x')
+
+    def typing_session(self, size: int, count: int, seed: int) -> list[tuple]:
+        """
+        Generate updates resembling a user typing: mostly single character inserts at a cursor
+        with the odd backspace, and the cursor occasionally jumping somewhere else in the block
+        """
+        rng = random.Random(seed)
+        updates = []
+        cursor = rng.randrange(size)
+        length = size
+        for _ in range(count):
+            roll = rng.random()
+            if roll < 0.02:
+                cursor = rng.randrange(length)
+            elif roll < 0.12 and cursor > 0:
+                updates.append(('delete', cursor - 1, 1))
+                cursor -= 1
+                length -= 1
+                continue
+            updates.append(('insert', cursor, 'a'))
+            cursor += 1
+            length += 1
+        return updates
+
+    def time(self, apply, text: str, updates: list[tuple]) -> tuple[float, str]:
+        start = perf_counter()
+        result = apply(text, updates)
+        return perf_counter() - start, result
+
+    def apply_str(self, text: str, updates: list[tuple]) -> str:
+        for type, position, value in updates:
+            if type == 'insert':
+                text = text[:position] + value + text[position:]
+            else:
+                text = text[:position] + text[position + value:]
+        return text
+
+    def apply_rope(self, text: str, updates: list[tuple]) -> str:
+        rope = Rope(text)
+        for type, position, value in updates:
+            if type == 'insert':
+                rope.insert(position, value)
+            else:
+                rope.delete(position, position + value)
+        # Materialised once, as it would be when the session flushes
+        return str(rope)
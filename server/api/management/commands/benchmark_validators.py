@@ -0,0 +1,98 @@
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from rest_framework import serializers
+from api.operations import OPERATIONS, operation_for
+
+
+class WebSocketMessageSerializer(serializers.Serializer):
+    """
+    The DRF serializers which validated websocket messages and operations before api.operations,
+    kept as the baseline to measure against
+    """
+    type = serializers.CharField(required=True)
+    access_token = serializers.CharField(required=True)
+    body = serializers.DictField(required=True)
+
+
+class BaseDocumentUpdateContentSerializer(serializers.Serializer):
+    block = serializers.CharField(required=True, min_length=1, max_length=5)
+    position = serializers.IntegerField(required=True, min_value=0)
+
+
+class InsertDocumentContentSerializer(BaseDocumentUpdateContentSerializer):
+    text = serializers.CharField(
+        required=True, trim_whitespace=False, allow_blank=True)
+
+
+class DeleteDocumentContentSerializer(BaseDocumentUpdateContentSerializer):
+    position = serializers.IntegerField(required=True, min_value=-1)
+    offset = serializers.IntegerField(required=True, min_value=0)
+
+
+class SplitContentBlockSerializer(BaseDocumentUpdateContentSerializer):
+    newBlock = serializers.CharField(
+        required=True, min_length=1, max_length=5)
+
+
+class SetContentBlockTypeSerializer(BaseDocumentUpdateContentSerializer):
+    newBlockType = serializers.CharField(required=True)
+    position = None
+
+
+class SetInlineStyleSerializer(BaseDocumentUpdateContentSerializer):
+    offset = serializers.IntegerField(required=True, min_value=0)
+    style = serializers.CharField(required=True)
+
+
+DRF_SERIALIZERS = {
+    'insert': InsertDocumentContentSerializer,
+    'delete': DeleteDocumentContentSerializer,
+    'split-block': SplitContentBlockSerializer,
+    'set-block-type': SetContentBlockTypeSerializer,
+    'set-inline-style': SetInlineStyleSerializer,
+    '': BaseDocumentUpdateContentSerializer,
+}
+
+SAMPLE_UPDATES = {
+    'insert': {'type': 'insert', 'block': 'a1b2c', 'position': 12, 'text': 'e'},
+    'delete': {'type': 'delete', 'block': 'a1b2c', 'position': 12, 'offset': 1},
+    'split-block': {'type': 'split-block', 'block': 'a1b2c', 'position': 12, 'newBlock': 'd3e4f'},
+    'set-block-type': {'type': 'set-block-type', 'block': 'a1b2c', 'newBlockType': 'header-one'},
+    'set-inline-style': {'type': 'set-inline-style', 'block': 'a1b2c', 'position': 0, 'offset': 5, 'style': 'BOLD'},
+}
+
+
+class Command(BaseCommand):
+    """
+    Benchmark validating a single operation with the api.operations validators used by
+    DocumentConsumer against the DRF serializers they replaced.
+    """
+    help = 'Benchmark per operation validation cost of DRF serializers against api.operations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ops', type=int, default=20_000,
+                            help='Number of operations validated for each type')
+
+    def handle(self, *args, **options):
+        count: int = options['ops']
+        self.stdout.write(f'{"operation":>18} {"drf (us)":>10} {"fast (us)":>10} {"speedup":>9}')
+        for type, update in SAMPLE_UPDATES.items():
+            drf_serializer = DRF_SERIALIZERS[type]
+            assert OPERATIONS[type](update).is_valid() and drf_serializer(data=update).is_valid()
+
+            drf_time = self.time(lambda: drf_serializer(data=update).is_valid(), count)
+            fast_time = self.time(lambda: operation_for(update).is_valid(), count)
+            self.stdout.write(
+                f'{type:>18} {drf_time / count * 1e6:>10.2f} {fast_time / count * 1e6:>10.2f} {drf_time / fast_time:>8.1f}x')
+
+        invalid = {'type': 'insert', 'block': '', 'position': -4}
+        drf_time = self.time(lambda: InsertDocumentContentSerializer(data=invalid).is_valid(), count)
+        fast_time = self.time(lambda: operation_for(invalid).is_valid(), count)
+        self.stdout.write(
+            f'{"invalid":>18} {drf_time / count * 1e6:>10.2f} {fast_time / count * 1e6:>10.2f} {drf_time / fast_time:>8.1f}x')
+
+    def time(self, validate, count: int) -> float:
+        start = perf_counter()
+        for _ in range(count):
+            validate()
+        return perf_counter() - start
@@ -0,0 +1,248 @@
+import asyncio
+import random
+import statistics
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from time import perf_counter
+from unittest import mock
+from uuid import uuid4
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
+from authentication.models import User
+from api.models import Document, DocumentCollaborator, ContentBlock
+from api.session import DocumentSession
+from api.utils import evenly_spaced_ranks
+
+# Share of operations which are deletes and block splits, the rest are single character inserts
+DELETE_SHARE = 0.15
+SPLIT_SHARE = 0.03
+BLOCK_KEY_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+class QueryCounter:
+    """ Database execute wrapper counting every query made, from any thread """
+
+    def __init__(self) -> None:
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs) -> None:
+        connection.execute_wrappers.append(self)
+
+
+class Editor:
+    """
+    One simulated client typing into its own block of a shared document, through a websocket
+    to the ASGI application like the frontend, while receiving everyone else's edits
+    """
+
+    def __init__(self, user: User, document: Document, block: str, length: int, rng: random.Random, keys) -> None:
+        self.user = user
+        self.document = document
+        self.block = block
+        self.cursor = self.length = length
+        self.rng = rng
+        self.keys = keys
+        self.communicator: WebsocketCommunicator = None
+        self.access_token = str(AccessToken.for_user(user))
+        # Edits of every block received so far, matched up against the times they were sent
+        self.received: dict[str, int] = {}
+        self.expected = 0
+        self.errors = 0
+
+    def next_operation(self) -> dict:
+        """ Operation a user typing would send next, moving the cursor along with it """
+        roll = self.rng.random()
+        if roll < SPLIT_SHARE:
+            operation = {'type': 'split-block', 'block': self.block,
+                         'position': self.cursor, 'newBlock': next(self.keys)}
+            self.block, self.length, self.cursor = operation['newBlock'], self.length - self.cursor, 0
+        elif roll < SPLIT_SHARE + DELETE_SHARE and self.cursor > 0:
+            self.cursor -= 1
+            self.length -= 1
+            operation = {'type': 'delete', 'block': self.block, 'position': self.cursor, 'offset': 1}
+        else:
+            operation = {'type': 'insert', 'block': self.block, 'position': self.cursor,
+                         'text': self.rng.choice('abcdefghijklmnopqrstuvwxyz ')}
+            self.cursor += 1
+            self.length += 1
+        return operation
+
+    def message(self, operation: dict) -> dict:
+        return {'type': 'update_document_content', 'access_token': self.access_token,
+                'body': {'data': [operation]}}
+
+
+class Command(BaseCommand):
+    """
+    Load test the websocket API by driving the ASGI application in process with simulated
+    editors spread over several documents, each typing a mix of inserts, deletes and block splits.
+    Runs against a throwaway test database, so it doesn't touch the configured one.
+    """
+    help = 'Measure ops/sec, apply and broadcast latency and queries for concurrent editors over websockets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--editors', type=int, default=20,
+                            help='Number of concurrent editors, spread evenly over the documents')
+        parser.add_argument('--documents', type=int, default=4)
+        parser.add_argument('--ops', type=int, default=200,
+                            help='Number of operations sent by each editor')
+        parser.add_argument('--blocks', type=int, default=100,
+                            help='Number of blocks each document starts with, besides the editors own blocks')
+        parser.add_argument('--think', type=float, default=0.05,
+                            help='Seconds each editor waits between operations, 0 to send as fast as possible. '
+                                 'Below 1 / SOCKET_RECEIVE_RATE the rate limit delays operations, and once '
+                                 'SOCKET_RECEIVE_QUEUE_SIZE of them are waiting closes the socket')
+        parser.add_argument('--flush-interval', type=float, default=None,
+                            help='Override DOCUMENT_SESSION_FLUSH_INTERVAL, in seconds')
+        parser.add_argument('--broadcast-window', type=float, default=None,
+                            help='Override DOCUMENT_BROADCAST_WINDOW, in seconds')
+        parser.add_argument('--timeout', type=float, default=10,
+                            help='Seconds to wait for broadcasts before giving up on them')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options['flush_interval'] is not None:
+            overrides['DOCUMENT_SESSION_FLUSH_INTERVAL'] = timedelta(seconds=options['flush_interval'])
+        if options['broadcast_window'] is not None:
+            overrides['DOCUMENT_BROADCAST_WINDOW'] = timedelta(seconds=options['broadcast_window'])
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(**overrides):
+                editors = self.create_editors(options)
+                results = asyncio.run(self.run(editors, options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        self.report(editors, options, **results)
+
+    def create_editors(self, options) -> list[Editor]:
+        """ Create the documents and a collaborator with a block of their own for every editor """
+        keys = (''.join(BLOCK_KEY_ALPHABET[i // 36 ** digit % 36] for digit in range(5)) for i in count())
+        documents = [Document.objects.create(title=f'Load test {i}') for i in range(options['documents'])]
+        editors_per_document = [options['editors'] // len(documents) + (i < options['editors'] % len(documents))
+                                for i in range(len(documents))]
+
+        editors = []
+        for document, editor_count in zip(documents, editors_per_document):
+            ranks = evenly_spaced_ranks(options['blocks'] + editor_count)
+            ContentBlock.objects.bulk_create(
+                ContentBlock(document=document, key=next(keys), text='Lorem ipsum dolor sit amet. ' * 8, rank=rank)
+                for rank in ranks[:options['blocks']])
+
+            for rank in ranks[options['blocks']:]:
+                # With a ticket to connect with, as the frontend gets before connecting
+                user = User.objects.create(
+                    username=f'loadtest_{uuid4().hex[:16]}', authentication_ticket=uuid4(),
+                    authentication_ticket_expires_at=datetime.now(tz=timezone.utc) + timedelta(minutes=10))
+                DocumentCollaborator.objects.create(
+                    document=document, user=user, permission=DocumentCollaborator.EDITOR)
+                block = ContentBlock.objects.create(document=document, key=next(keys), text='', rank=rank)
+                editors.append(Editor(user, document, block.key, 0,
+                                      random.Random(f'{options["seed"]}-{len(editors)}'), keys))
+        return editors
+
+    async def run(self, editors: list[Editor], options) -> dict:
+        from collaborative_text_editor.asgi import application
+
+        sent_at: dict[str, list[float]] = {}
+        broadcast_latencies: list[float] = []
+        apply_latencies: list[float] = []
+        apply = DocumentSession.apply
+
+        async def timed_apply(session, *args, **kwargs):
+            start = perf_counter()
+            try:
+                return await apply(session, *args, **kwargs)
+            finally:
+                apply_latencies.append(perf_counter() - start)
+
+        async def send(editor: Editor) -> None:
+            for _ in range(options['ops']):
+                operation = editor.next_operation()
+                sent_at.setdefault(operation['block'], []).append(perf_counter())
+                await editor.communicator.send_json_to(editor.message(operation))
+                await asyncio.sleep(options['think'])
+
+        async def receive(editor: Editor) -> float:
+            last = perf_counter()
+            while sum(editor.received.values()) < editor.expected:
+                try:
+                    frame = await editor.communicator.receive_json_from(timeout=options['timeout'])
+                except asyncio.TimeoutError:
+                    # The communicator stops the application when it times out
+                    break
+                last = perf_counter()
+                if 'errors' in frame:
+                    editor.errors += 1
+                    continue
+                for operation in frame['body']['data']:
+                    seen = editor.received.get(operation['block'], 0)
+                    broadcast_latencies.append(last - sent_at[operation['block']][seen])
+                    editor.received[operation['block']] = seen + 1
+            return last
+
+        # Every query from the first connection to the last disconnection is counted
+        counter = QueryCounter()
+        connection_created.connect(counter.install)
+        connection.execute_wrappers.append(counter)
+        try:
+            with mock.patch.object(DocumentSession, 'apply', timed_apply):
+                for editor in editors:
+                    await self.connect(editor, application)
+                    editor.expected = options['ops'] * (sum(other.document == editor.document for other in editors) - 1)
+
+                start = perf_counter()
+                receivers = [asyncio.create_task(receive(editor)) for editor in editors]
+                await asyncio.gather(*(send(editor) for editor in editors))
+                end = max(await asyncio.gather(*receivers))
+                for editor in editors:
+                    if not editor.communicator.future.done():
+                        await editor.communicator.disconnect()
+        finally:
+            connection_created.disconnect(counter.install)
+            connection.execute_wrappers.remove(counter)
+
+        return {
+            'elapsed': end - start,
+            'apply_latencies': apply_latencies,
+            'broadcast_latencies': broadcast_latencies,
+            'queries': counter.queries,
+        }
+
+    async def connect(self, editor: Editor, application) -> None:
+        editor.communicator = WebsocketCommunicator(
+            application, f'/ws/document/{editor.document.id}/?{editor.user.authentication_ticket}')
+        connected, _ = await editor.communicator.connect()
+        assert connected, f'{editor.user.username} could not connect'
+
+    def report(self, editors: list[Editor], options, elapsed: float, apply_latencies: list[float],
+               broadcast_latencies: list[float], queries: int) -> None:
+        operations = options['ops'] * len(editors)
+        expected = sum(editor.expected for editor in editors)
+        self.stdout.write(
+            f'{len(editors)} editors over {options["documents"]} documents, {operations} operations in {elapsed:.2f}s')
+        self.stdout.write(f'{"ops/sec":>24} {operations / elapsed:>10.1f}')
+        self.stdout.write(f'{"apply p50/p99 (ms)":>24} {self.percentiles(apply_latencies)}')
+        self.stdout.write(f'{"broadcast p50/p99 (ms)":>24} {self.percentiles(broadcast_latencies)}')
+        self.stdout.write(f'{"queries":>24} {queries:>10} ({queries / operations:.2f} per op)')
+        # Latencies only cover the broadcasts which arrived, so the ones which didn't are counted on their own
+        missing = expected - len(broadcast_latencies)
+        errors = sum(editor.errors for editor in editors)
+        style = self.style.WARNING if missing or errors else str
+        self.stdout.write(style(f'{"missing broadcasts":>24} {missing:>10} of {expected}'))
+        self.stdout.write(style(f'{"error frames":>24} {errors:>10}'))
+
+    def percentiles(self, latencies: list[float]) -> str:
+        if len(latencies) < 2:
+            return f'{"-":>10}'
+        quantiles = statistics.quantiles(latencies, n=100)
+        return f'{quantiles[49] * 1000:>10.2f} {quantiles[98] * 1000:>10.2f}'
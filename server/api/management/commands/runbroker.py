@@ -0,0 +1,26 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.layers import ChannelBroker
+
+
+class Command(BaseCommand):
+    """
+    Run the broker which BrokerChannelLayer connects every ASGI worker process to, so sockets
+    editing the same document can be spread over several workers.
+    """
+    help = 'Run the channel layer broker shared by every ASGI worker process on this host'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.CHANNEL_BROKER_SOCKET,
+                            help='Unix socket to listen on, defaults to the CHANNEL_BROKER_SOCKET setting')
+
+    def handle(self, *args, **options):
+        if not options['path']:
+            raise CommandError('Set CHANNEL_BROKER_SOCKET or pass --path')
+
+        self.stdout.write(f'Channel broker listening on {options["path"]}')
+        try:
+            asyncio.run(ChannelBroker(options['path']).serve())
+        except KeyboardInterrupt:
+            pass
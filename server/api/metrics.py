@@ -0,0 +1,169 @@
+"""
+In process metrics for the websocket hot path, exposed in the Prometheus text format by the
+`metrics/` endpoint (see api.views.metrics).
+
+Metrics are plain counters, gauges and histograms kept per process, cheap enough to update on
+every message and operation. Values which already exist elsewhere, such as the number of sockets
+open on each document, are read by a function when metrics are collected rather than tracked twice.
+"""
+from __future__ import annotations
+from bisect import bisect_left
+from typing import Callable, Iterator
+from channels.layers import get_channel_layer
+
+# Every metric in the order they're exposed
+REGISTRY: list[Metric] = []
+
+# Upper bounds in seconds, from a single in memory operation up to a flush which hits the database
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    """
+    Base class for metrics, with label values given positionally in the order of `labels`.
+    Given a `function` the metric's values are read from it when collected instead, it returns a
+    value, or a dict of label value tuples to values.
+    """
+    type: str = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), function: Callable = None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self.values: dict[tuple, float] = {}
+        REGISTRY.append(self)
+
+    def samples(self) -> Iterator[tuple[str, dict, float]]:
+        """ (name suffix, labels, value) for every sample of the metric """
+        values = self.values
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        for label_values, value in values.items():
+            yield '', dict(zip(self.labels, label_values)), value
+
+    def expose(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{self.name}{suffix}{format_labels(labels)} {value:g}'
+                     for suffix, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, *label_values: str) -> None:
+        self.values[label_values] = value
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values: str, amount: float = 1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # Label values to [count in each bucket (not cumulative) plus one for +Inf, sum]
+        self.observations: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        observations = self.observations.get(label_values)
+        if observations is None:
+            observations = self.observations[label_values] = [[0] * (len(self.buckets) + 1), 0]
+        observations[0][bisect_left(self.buckets, value)] += 1
+        observations[1] += value
+
+    def samples(self) -> Iterator[tuple[str, dict, float]]:
+        for label_values, (counts, total) in self.observations.items():
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield '_bucket', {**labels, 'le': f'{bound:g}' if bound != '+Inf' else bound}, cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+
+def expose() -> str:
+    """ Every metric in the Prometheus text exposition format """
+    return '\n'.join(metric.expose() for metric in REGISTRY) + '\n'
+
+
+def active_sockets() -> dict[tuple, int]:
+    from api.session import DocumentSession
+    return {(document_id,): session.connections for document_id, session in DocumentSession._sessions.items()}
+
+
+def channel_layer_queues() -> list[int]:
+    """ Number of messages waiting in each of the channel layer's queues in this process """
+    channel_layer = get_channel_layer()
+    # InMemoryChannelLayer keeps a queue per channel in `channels`, BrokerChannelLayer in `_queues`
+    queues = getattr(channel_layer, 'channels', None)
+    if not isinstance(queues, dict):
+        queues = getattr(channel_layer, '_queues', {})
+    return [queue.qsize() for queue in list(queues.values())]
+
+
+def broadcast_events() -> dict[tuple, int]:
+    from api.broadcast import BroadcastAggregator
+    return {('sent',): BroadcastAggregator.events_sent, ('coalesced',): BroadcastAggregator.events_saved}
+
+
+MESSAGES = Counter('editor_messages_total', 'Websocket messages received, by message type.', ('type',))
+MESSAGE_ERRORS = Counter('editor_message_errors_total', 'Websocket messages answered with errors, by message type.', ('type',))
+OPERATIONS = Counter('editor_operations_total', 'Document operations applied, by operation type.', ('type',))
+OPERATION_SECONDS = Histogram(
+    'editor_operation_apply_seconds', 'Time to apply a single operation to a live document, by operation type.', ('type',))
+BATCH_SECONDS = Histogram(
+    'editor_batch_apply_seconds', 'Time to apply a batch of operations, including numbering it and any write through flush.')
+BROADCAST_SECONDS = Histogram(
+    'editor_broadcast_seconds', 'Time from a batch being applied to it being sent to the document group, including the broadcast window.')
+BROADCAST_EVENTS = Counter(
+    'editor_broadcast_batches_total', 'Batches broadcast, in an event of their own (sent) or folded into another event (coalesced).',
+    ('outcome',), function=broadcast_events)
+PRESENCE_UPDATES = Counter(
+    'editor_presence_updates_total', 'Cursor moves received, by whether they were sent on or superseded by a later move first.',
+    ('outcome',))
+SLOW_SOCKETS = Counter(
+    'editor_slow_sockets_total', 'Sockets falling too far behind on frames sent to them, by whether their cursors were '
+    'coalesced, their document resynced from a snapshot or the socket closed.', ('action',))
+SEND_QUEUE_DROPPED = Counter(
+    'editor_send_queue_dropped_frames_total', 'Frames dropped from socket send queues for a snapshot, by kind of frame.', ('kind',))
+RATE_LIMITED = Counter('editor_rate_limited_messages_total', 'Websocket messages held back for going over the socket\'s rate limit.')
+FLOODING_SOCKETS = Counter(
+    'editor_flooding_sockets_total', 'Sockets closed for having SOCKET_RECEIVE_QUEUE_SIZE messages held back by their rate limit.')
+WRITE_GROUP_SIZE = Histogram(
+    'editor_database_writes_per_commit', 'Writes committed together in one transaction by a database writer thread.',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+WRITE_GROUP_SECONDS = Histogram(
+    'editor_database_commit_seconds', 'Time for a database writer thread to run and commit a group of writes.')
+ACTIVE_SOCKETS = Gauge(
+    'editor_active_sockets', 'Websockets open on each document live in this process.', ('document',), function=active_sockets)
+CHANNEL_LAYER_QUEUED = Gauge(
+    'editor_channel_layer_queued_messages', 'Messages waiting in the channel layer queues of this process.',
+    function=lambda: sum(channel_layer_queues()))
+CHANNEL_LAYER_MAX_QUEUE = Gauge(
+    'editor_channel_layer_max_queue_depth', 'Messages waiting in the longest channel layer queue of this process.',
+    function=lambda: max(channel_layer_queues(), default=0))
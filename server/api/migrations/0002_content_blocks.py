@@ -0,0 +1,73 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:16
+
+import django.core.validators
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def delete_orphaned_collaborators(apps, schema_editor):
+    """ Collaborators created before the user field existed can't be linked to anyone """
+    DocumentCollaborator = apps.get_model('api', 'DocumentCollaborator')
+    DocumentCollaborator.objects.filter(user__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentcollaborator',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(delete_orphaned_collaborators, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='documentcollaborator',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='title',
+            field=models.CharField(blank=True, default='', max_length=256),
+        ),
+        migrations.AlterField(
+            model_name='documentcollaborator',
+            name='document',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='collaborators', to='api.document'),
+        ),
+        migrations.AlterField(
+            model_name='documentcollaborator',
+            name='permission',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Owner'), (1, 'Admin'), (2, 'Editor'), (3, 'Viewer')], default=3, validators=[django.core.validators.MinLengthValidator(0), django.core.validators.MaxLengthValidator(4)]),
+        ),
+        migrations.CreateModel(
+            name='ContentBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=5)),
+                ('text', models.TextField(blank=True, default='')),
+                ('type', models.CharField(default='unstyled', max_length=20)),
+                ('index', models.PositiveIntegerField()),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='blocks', to='api.document')),
+            ],
+            options={
+                'ordering': ['index'],
+            },
+        ),
+        migrations.CreateModel(
+            name='InlineStyle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('length', models.PositiveIntegerField()),
+                ('offset', models.PositiveIntegerField()),
+                ('style', models.CharField(max_length=10)),
+                ('content_block', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='styles', to='api.contentblock')),
+            ],
+        ),
+    ]
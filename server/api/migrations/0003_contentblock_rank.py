@@ -0,0 +1,58 @@
+from django.db import migrations, models
+from api.utils import evenly_spaced_ranks
+
+
+def index_to_rank(apps, schema_editor):
+    """ Give every block a fractional rank, keeping each document's existing index order """
+    Document = apps.get_model('api', 'Document')
+    ContentBlock = apps.get_model('api', 'ContentBlock')
+
+    for document in Document.objects.all():
+        blocks = list(ContentBlock.objects.filter(
+            document=document).order_by('index', 'pk'))
+        for block, rank in zip(blocks, evenly_spaced_ranks(len(blocks))):
+            block.rank = rank
+        ContentBlock.objects.bulk_update(blocks, ['rank'])
+
+
+def rank_to_index(apps, schema_editor):
+    Document = apps.get_model('api', 'Document')
+    ContentBlock = apps.get_model('api', 'ContentBlock')
+
+    for document in Document.objects.all():
+        blocks = list(ContentBlock.objects.filter(
+            document=document).order_by('rank'))
+        for index, block in enumerate(blocks):
+            block.index = index
+        ContentBlock.objects.bulk_update(blocks, ['index'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_content_blocks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contentblock',
+            name='rank',
+            field=models.CharField(default='', max_length=255),
+            preserve_default=False,
+        ),
+        migrations.RunPython(index_to_rank, rank_to_index),
+        # Default only so the column can be re-added when migrating backwards
+        migrations.AlterField(
+            model_name='contentblock',
+            name='index',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RemoveField(
+            model_name='contentblock',
+            name='index',
+        ),
+        migrations.AlterModelOptions(
+            name='contentblock',
+            options={'ordering': ['rank']},
+        ),
+    ]
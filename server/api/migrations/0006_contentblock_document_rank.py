@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_document_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contentblock',
+            index=models.Index(fields=['document', 'rank'], name='contentblock_document_rank'),
+        ),
+    ]
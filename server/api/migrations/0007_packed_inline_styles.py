@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:52
+
+import struct
+from itertools import groupby
+from django.db import migrations, models
+
+# Matches api.styles.PACKED_RANGE, an (offset, length, Style id) triple of little endian uint32s per range
+PACKED_RANGE = struct.Struct('<3I')
+BATCH_SIZE = 1000
+
+
+def pack_inline_styles(apps, schema_editor):
+    """ Pack every block's InlineStyle rows into its inline_styles column, numbering style names as Styles """
+    InlineStyle = apps.get_model('api', 'InlineStyle')
+    ContentBlock = apps.get_model('api', 'ContentBlock')
+    Style = apps.get_model('api', 'Style')
+
+    Style.objects.bulk_create([Style(name=name) for name in InlineStyle.objects.values_list('style', flat=True).distinct()])
+    style_ids = dict(Style.objects.values_list('name', 'id'))
+
+    rows = InlineStyle.objects.order_by('content_block_id', 'pk').values_list('content_block_id', 'offset', 'length', 'style')
+    blocks = []
+    for block_pk, styles in groupby(rows.iterator(), key=lambda row: row[0]):
+        blocks.append(ContentBlock(pk=block_pk, inline_styles=b''.join(
+            PACKED_RANGE.pack(offset, length, style_ids[style]) for block_pk, offset, length, style in styles)))
+        if len(blocks) == BATCH_SIZE:
+            ContentBlock.objects.bulk_update(blocks, ['inline_styles'])
+            blocks = []
+    ContentBlock.objects.bulk_update(blocks, ['inline_styles'])
+
+
+def unpack_inline_styles(apps, schema_editor):
+    """ Recreate an InlineStyle row for every range packed into a block """
+    InlineStyle = apps.get_model('api', 'InlineStyle')
+    ContentBlock = apps.get_model('api', 'ContentBlock')
+    Style = apps.get_model('api', 'Style')
+
+    style_names = dict(Style.objects.values_list('id', 'name'))
+    blocks = ContentBlock.objects.exclude(inline_styles=b'').values_list('pk', 'inline_styles')
+    InlineStyle.objects.bulk_create((
+        InlineStyle(content_block_id=block_pk, offset=offset, length=length, style=style_names[style_id])
+        for block_pk, inline_styles in blocks.iterator()
+        for offset, length, style_id in PACKED_RANGE.iter_unpack(inline_styles)
+    ), batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_contentblock_document_rank'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Style',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='contentblock',
+            name='inline_styles',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+        migrations.RunPython(pack_inline_styles, unpack_inline_styles),
+        migrations.DeleteModel(
+            name='InlineStyle',
+        ),
+    ]
@@ -0,0 +1,84 @@
+from django.db import migrations
+
+# External content FTS5 tables over block text and document titles, kept up to date by triggers as
+# rows are written so only changed blocks are ever reindexed. Titles are matched up with documents
+# by rowid, as documents have no integer key.
+CREATE_SEARCH_INDEX = [
+    """
+    CREATE VIRTUAL TABLE api_contentblock_fts USING fts5(
+        text, document_id UNINDEXED, content='api_contentblock', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')
+    """,
+    """
+    CREATE TRIGGER api_contentblock_fts_insert AFTER INSERT ON api_contentblock BEGIN
+        INSERT INTO api_contentblock_fts(rowid, text, document_id) VALUES (new.id, new.text, new.document_id);
+    END
+    """,
+    """
+    CREATE TRIGGER api_contentblock_fts_delete AFTER DELETE ON api_contentblock BEGIN
+        INSERT INTO api_contentblock_fts(api_contentblock_fts, rowid, text, document_id)
+        VALUES ('delete', old.id, old.text, old.document_id);
+    END
+    """,
+    """
+    CREATE TRIGGER api_contentblock_fts_update AFTER UPDATE OF text ON api_contentblock BEGIN
+        INSERT INTO api_contentblock_fts(api_contentblock_fts, rowid, text, document_id)
+        VALUES ('delete', old.id, old.text, old.document_id);
+        INSERT INTO api_contentblock_fts(rowid, text, document_id) VALUES (new.id, new.text, new.document_id);
+    END
+    """,
+    """
+    CREATE VIRTUAL TABLE api_document_fts USING fts5(
+        title, content='api_document', tokenize='unicode61 remove_diacritics 2')
+    """,
+    """
+    CREATE TRIGGER api_document_fts_insert AFTER INSERT ON api_document BEGIN
+        INSERT INTO api_document_fts(rowid, title) VALUES (new.rowid, new.title);
+    END
+    """,
+    """
+    CREATE TRIGGER api_document_fts_delete AFTER DELETE ON api_document BEGIN
+        INSERT INTO api_document_fts(api_document_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+    END
+    """,
+    """
+    CREATE TRIGGER api_document_fts_update AFTER UPDATE OF title ON api_document BEGIN
+        INSERT INTO api_document_fts(api_document_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+        INSERT INTO api_document_fts(rowid, title) VALUES (new.rowid, new.title);
+    END
+    """,
+    # Index everything written before the triggers existed
+    "INSERT INTO api_contentblock_fts(api_contentblock_fts) VALUES ('rebuild')",
+    "INSERT INTO api_document_fts(api_document_fts) VALUES ('rebuild')",
+]
+
+DROP_SEARCH_INDEX = [
+    'DROP TRIGGER api_contentblock_fts_insert',
+    'DROP TRIGGER api_contentblock_fts_delete',
+    'DROP TRIGGER api_contentblock_fts_update',
+    'DROP TABLE api_contentblock_fts',
+    'DROP TRIGGER api_document_fts_insert',
+    'DROP TRIGGER api_document_fts_delete',
+    'DROP TRIGGER api_document_fts_update',
+    'DROP TABLE api_document_fts',
+]
+
+
+def run_on_sqlite(statements):
+    """ The search index is built on SQLite's FTS5 extension, other databases are left alone """
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'sqlite':
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_packed_inline_styles'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_sqlite(CREATE_SEARCH_INDEX), run_on_sqlite(DROP_SEARCH_INDEX)),
+    ]
@@ -0,0 +1,87 @@
+from django.db import migrations
+
+# Titles were indexed by api_document's implicit rowid, which VACUUM renumbers, leaving titles matched up
+# with the wrong documents. They're indexed by a key of their own for each document id instead, in a
+# table whose INTEGER PRIMARY KEY is never renumbered.
+CREATE_DOCUMENT_INDEX = [
+    'DROP TRIGGER api_document_fts_insert',
+    'DROP TRIGGER api_document_fts_delete',
+    'DROP TRIGGER api_document_fts_update',
+    'DROP TABLE api_document_fts',
+    'CREATE TABLE api_document_fts_key (id integer NOT NULL PRIMARY KEY, document_id char(32) NOT NULL UNIQUE)',
+    "CREATE VIRTUAL TABLE api_document_fts USING fts5(title, tokenize='unicode61 remove_diacritics 2')",
+    """
+    CREATE TRIGGER api_document_fts_insert AFTER INSERT ON api_document BEGIN
+        INSERT INTO api_document_fts_key(document_id) VALUES (new.id);
+        INSERT INTO api_document_fts(rowid, title)
+        VALUES ((SELECT id FROM api_document_fts_key WHERE document_id = new.id), new.title);
+    END
+    """,
+    """
+    CREATE TRIGGER api_document_fts_delete AFTER DELETE ON api_document BEGIN
+        DELETE FROM api_document_fts WHERE rowid = (SELECT id FROM api_document_fts_key WHERE document_id = old.id);
+        DELETE FROM api_document_fts_key WHERE document_id = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER api_document_fts_update AFTER UPDATE OF title ON api_document BEGIN
+        UPDATE api_document_fts SET title = new.title
+        WHERE rowid = (SELECT id FROM api_document_fts_key WHERE document_id = old.id);
+    END
+    """,
+    'INSERT INTO api_document_fts_key(document_id) SELECT id FROM api_document',
+    """
+    INSERT INTO api_document_fts(rowid, title)
+    SELECT api_document_fts_key.id, api_document.title
+    FROM api_document JOIN api_document_fts_key ON api_document_fts_key.document_id = api_document.id
+    """,
+]
+
+DROP_DOCUMENT_INDEX = [
+    'DROP TRIGGER api_document_fts_insert',
+    'DROP TRIGGER api_document_fts_delete',
+    'DROP TRIGGER api_document_fts_update',
+    'DROP TABLE api_document_fts',
+    'DROP TABLE api_document_fts_key',
+    """
+    CREATE VIRTUAL TABLE api_document_fts USING fts5(
+        title, content='api_document', tokenize='unicode61 remove_diacritics 2')
+    """,
+    """
+    CREATE TRIGGER api_document_fts_insert AFTER INSERT ON api_document BEGIN
+        INSERT INTO api_document_fts(rowid, title) VALUES (new.rowid, new.title);
+    END
+    """,
+    """
+    CREATE TRIGGER api_document_fts_delete AFTER DELETE ON api_document BEGIN
+        INSERT INTO api_document_fts(api_document_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+    END
+    """,
+    """
+    CREATE TRIGGER api_document_fts_update AFTER UPDATE OF title ON api_document BEGIN
+        INSERT INTO api_document_fts(api_document_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+        INSERT INTO api_document_fts(rowid, title) VALUES (new.rowid, new.title);
+    END
+    """,
+    "INSERT INTO api_document_fts(api_document_fts) VALUES ('rebuild')",
+]
+
+
+def run_on_sqlite(statements):
+    """ The search index is built on SQLite's FTS5 extension, other databases are left alone """
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'sqlite':
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_sqlite(CREATE_DOCUMENT_INDEX), run_on_sqlite(DROP_DOCUMENT_INDEX)),
+    ]
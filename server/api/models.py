@@ -9,22 +9,30 @@ class Document(models.Model):
     """ Model for representing a document page. Content is constructed from a series of ordered content blocks """
     id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
     title = models.CharField(max_length=256, default='', blank=True)
+    # Number of content operations applied to the document, see DocumentOperation
+    revision = models.PositiveBigIntegerField(default=0)
+    # Last time the document's title or content was saved, live sessions set it when they flush
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def user_permission(self, user: User) -> int:
+        """ A user's DocumentCollaborator.permission level for the Document, None if they aren't a collaborator """
+        from api.permissions import permission_cache
+        return permission_cache.get(self.id, user.id)
 
     def user_is_owner(self, user: User) -> bool:
         """ Determine wether a given user is the owner of the Document """
-        collaborator: DocumentCollaborator = self.collaborators.get(user, None)
-        if collaborator:
-            return collaborator.permission == 0
-        return False
+        return self.user_permission(user) == DocumentCollaborator.OWNER
 
 
 class DocumentCollaborator(models.Model):
     """ Intermediary table for collaborators of a specific document """
+    # Lower permission levels can do everything higher levels can
+    OWNER, ADMIN, EDITOR, VIEWER = 0, 1, 2, 3
     PERMISSION_CHOICES = (
-        (0, 'Owner'),
-        (1, 'Admin'),
-        (2, 'Editor'),
-        (3, 'Viewer'),
+        (OWNER, 'Owner'),
+        (ADMIN, 'Admin'),
+        (EDITOR, 'Editor'),
+        (VIEWER, 'Viewer'),
     )
     id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
     document = models.ForeignKey(
@@ -51,17 +59,43 @@ class ContentBlock(models.Model):
     key = models.CharField(max_length=5, blank=False)
     text = models.TextField(default='', blank=True)
     type = models.CharField(default='unstyled', max_length=20)
-    # NOTE I know this isn't the best way of indexing the blocks... but this is a small personal project, and this database isn't realistically going to get hit that often
-    index = models.PositiveIntegerField()
+    # Fractional rank (see api.utils) so blocks can be inserted without renumbering their neighbours
+    rank = models.CharField(max_length=255)
+    # Inline style ranges packed as (offset, length, Style id) uint32 triples, see api.styles.StyleDictionary
+    inline_styles = models.BinaryField(default=b'', blank=True)
 
     class Meta:
-        ordering = ['index']
+        ordering = ['rank']
+        indexes = [
+            # Pages through a document's blocks in order without sorting them all
+            models.Index(fields=['document', 'rank'], name='contentblock_document_rank'),
+        ]
+
+
+class Style(models.Model):
+    """ Dictionary of inline style names, numbering them for ContentBlock.inline_styles (see api.styles) """
+    name = models.CharField(max_length=64, unique=True)
+
+    def __str__(self) -> str:
+        return self.name
 
 
-class InlineStyle(models.Model):
-    """ Model representing a single inline style as part of a series in a ContentBlock """
-    content_block = models.ForeignKey(
-        ContentBlock, related_name='styles', on_delete=models.CASCADE)
-    length = models.PositiveIntegerField()
-    offset = models.PositiveIntegerField()
-    style = models.CharField(max_length=10)
+class DocumentOperation(models.Model):
+    """
+    Append only log of the content operations applied to a document. Each operation takes the
+    document to the next revision, letting a reconnecting client catch up on just what it missed
+    """
+    document = models.ForeignKey(
+        Document, related_name='operations', on_delete=models.CASCADE)
+    revision = models.PositiveBigIntegerField()
+    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
+    # Validated fields of the operation, whatever else the client sent, e.g. {'type': 'insert', 'block': ..., 'position': ..., 'text': ...}
+    data = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['revision']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['document', 'revision'], name='unique_document_revision'),
+        ]
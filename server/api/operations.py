@@ -0,0 +1,385 @@
+"""
+Validation of websocket messages and the document operations they carry.
+
+Every frame a socket sends is validated here rather than by DRF serializers, which cost far
+more than the edits themselves. Each message or operation is a `__slots__` class with a dict of
+field checks, built once when the class is defined, which set the validated values as attributes.
+Checks mirror the DRF fields they replaced (CharField, IntegerField, DictField and ListField) so
+clients are sent exactly the same error payloads. DRF serializers are still used by the REST views.
+"""
+from __future__ import annotations
+import re
+from typing import Any, Callable
+from django.conf import settings
+from api.session import BatchCheck, DocumentSession, LiveBlock
+
+# Stands in for a field missing from the data, as DRF's `empty` does
+MISSING = object()
+
+REQUIRED = 'This field is required.'
+NULL = 'This field may not be null.'
+NO_DATA = 'No data provided'
+UNKNOWN_OPERATION = 'Unknown operation type'
+INVALID_DATA = 'Invalid data. Expected a dictionary, but got {datatype}.'
+INVALID_STRING = 'Not a valid string.'
+BLANK = 'This field may not be blank.'
+MAX_LENGTH = 'Ensure this field has no more than {max_length} characters.'
+MIN_LENGTH = 'Ensure this field has at least {min_length} characters.'
+NULL_CHARACTERS = 'Null characters are not allowed.'
+SURROGATE_CHARACTERS = 'Surrogate characters are not allowed: U+{code_point:X}.'
+INVALID_INTEGER = 'A valid integer is required.'
+MAX_VALUE = 'Ensure this value is less than or equal to {max_value}.'
+MIN_VALUE = 'Ensure this value is greater than or equal to {min_value}.'
+MAX_STRING_LENGTH = 'String value too large.'
+NOT_A_DICT = 'Expected a dictionary of items but got type "{input_type}".'
+NOT_A_LIST = 'Expected a list of items but got type "{input_type}".'
+
+SURROGATE = re.compile('[\ud800-\udfff]')
+# Allows e.g. '1.0' as an integer, but not '1.2'
+DECIMAL = re.compile(r'\.0*\s*$')
+
+
+class FieldError(Exception):
+    def __init__(self, *messages: str) -> None:
+        self.messages = list(messages)
+
+
+def check_empty(value: Any) -> None:
+    """ Fail a missing or null value, which no field here allows """
+    if value is MISSING:
+        raise FieldError(REQUIRED)
+    if value is None:
+        raise FieldError(NULL)
+
+
+def char_field(min_length: int = None, max_length: int = None, allow_blank: bool = False, trim_whitespace: bool = True) -> Callable:
+    """ Build a check matching serializers.CharField """
+    def check(value: Any) -> str:
+        if type(value) is not str:
+            check_empty(value)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise FieldError(INVALID_STRING)
+            value = str(value)
+        elif trim_whitespace:
+            value = value.strip()
+        if not value:
+            if allow_blank:
+                return ''
+            raise FieldError(BLANK)
+
+        errors = []
+        if max_length is not None and len(value) > max_length:
+            errors.append(MAX_LENGTH.format(max_length=max_length))
+        if min_length is not None and len(value) < min_length:
+            errors.append(MIN_LENGTH.format(min_length=min_length))
+        if '\x00' in value:
+            errors.append(NULL_CHARACTERS)
+        if (surrogate := SURROGATE.search(value)):
+            errors.append(SURROGATE_CHARACTERS.format(
+                code_point=ord(surrogate.group())))
+        if errors:
+            raise FieldError(*errors)
+        return value
+    return check
+
+
+def integer_field(min_value: int = None, max_value: int = None) -> Callable:
+    """ Build a check matching serializers.IntegerField """
+    def check(value: Any) -> int:
+        if type(value) is not int:
+            check_empty(value)
+            if isinstance(value, str) and len(value) > 1000:
+                raise FieldError(MAX_STRING_LENGTH)
+            try:
+                value = int(DECIMAL.sub('', str(value)))
+            except (ValueError, TypeError):
+                raise FieldError(INVALID_INTEGER)
+
+        if max_value is not None and value > max_value:
+            raise FieldError(MAX_VALUE.format(max_value=max_value))
+        if min_value is not None and value < min_value:
+            raise FieldError(MIN_VALUE.format(min_value=min_value))
+        return value
+    return check
+
+
+def dict_field(value: Any) -> dict:
+    """ Check matching serializers.DictField, with any values """
+    if type(value) is not dict:
+        check_empty(value)
+        raise FieldError(NOT_A_DICT.format(input_type=type(value).__name__))
+    return value
+
+
+def optional(check: Callable) -> Callable:
+    """ Allow a field to be missing, as required=False does, leaving it None """
+    def check_optional(value: Any) -> Any:
+        return None if value is MISSING else check(value)
+    return check_optional
+
+
+def list_field(value: Any) -> list:
+    """ Check matching serializers.ListField, with any items """
+    if type(value) is not list:
+        check_empty(value)
+        if isinstance(value, (str, dict)) or not hasattr(value, '__iter__'):
+            raise FieldError(NOT_A_LIST.format(input_type=type(value).__name__))
+        value = list(value)
+    return value
+
+
+class Validated:
+    """
+    Base class for data validated by FIELDS, a dict of field names to checks. Follows the
+    Serializer API used by the consumer: `is_valid()`, then `errors` or the validated values
+    as attributes, with the data as given in `initial_data`.
+    """
+    __slots__ = ('initial_data', 'errors')
+    FIELDS: dict[str, Callable] = {}
+
+    def __init__(self, data: Any) -> None:
+        self.initial_data = data
+        self.errors: dict[str, list[str]] = {}
+
+    def is_valid(self) -> bool:
+        data = self.initial_data
+        if type(data) is not dict:
+            message = NO_DATA if data is None else INVALID_DATA.format(datatype=type(data).__name__)
+            self.errors = {'non_field_errors': [message]}
+            return False
+
+        errors = {}
+        for name, check in self.FIELDS.items():
+            try:
+                setattr(self, name, check(data.get(name, MISSING)))
+            except FieldError as error:
+                errors[name] = error.messages
+        self.errors = errors
+        return not errors
+
+
+# MESSAGES
+
+class WebSocketMessage(Validated):
+    """ Basic validity of a websocket message, before its body is validated for its type """
+    FIELDS = {
+        'type': char_field(),
+        'access_token': char_field(),
+        'body': dict_field,
+    }
+    __slots__ = tuple(FIELDS)
+
+
+class UpdateDocumentTitle(Validated):
+    FIELDS = {'title': char_field()}
+    __slots__ = tuple(FIELDS)
+
+    def save(self, instance: DocumentSession) -> None:
+        instance.set_title(self.title)
+
+
+class SyncDocument(Validated):
+    """ Reconnecting client asking for everything since the last revision it saw """
+    FIELDS = {'revision': integer_field(min_value=0)}
+    __slots__ = tuple(FIELDS)
+
+
+class LoadBlocks(Validated):
+    """ Window of a document's blocks, starting at an ordinal `offset` or after the block with key `after` """
+    FIELDS = {
+        'offset': optional(integer_field(min_value=0)),
+        'after': optional(char_field(min_length=1, max_length=5)),
+        'limit': integer_field(min_value=1, max_value=settings.DOCUMENT_BLOCKS_PAGE_LIMIT),
+    }
+    __slots__ = tuple(FIELDS)
+
+
+class Presence(Validated):
+    """ Where a user's cursor is, as a Draft.js selection from an anchor to a focus position """
+    FIELDS = {
+        'anchorKey': char_field(min_length=1, max_length=5),
+        'anchorOffset': integer_field(min_value=0),
+        'focusKey': char_field(min_length=1, max_length=5),
+        'focusOffset': integer_field(min_value=0),
+    }
+    __slots__ = tuple(FIELDS)
+
+    @property
+    def selection(self) -> dict:
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class UpdateDocumentContent(Validated):
+    """ Batch of operations, each of which is validated by its own type """
+    FIELDS = {'data': list_field}
+    __slots__ = tuple(FIELDS)
+
+
+# OPERATIONS
+
+class Operation(Validated):
+    """
+    Base class for operations which modify the content of a document, applied to the
+    document's live DocumentSession by `save`, which handles persisting them.
+    """
+    # Client facing type of the operation
+    TYPE = 'unknown'
+    FIELDS = {
+        'block': char_field(min_length=1, max_length=5),
+        'position': integer_field(min_value=0),
+    }
+    __slots__ = tuple(FIELDS)
+
+    @property
+    def data(self) -> dict:
+        """ The validated operation, as logged and broadcast, leaving out anything else the client sent """
+        return {'type': self.TYPE, **{name: getattr(self, name) for name in self.FIELDS}}
+
+    def check(self, batch: BatchCheck) -> None:
+        """ Make sure the blocks the operation needs will exist when it's applied, before any of its batch is """
+        batch.get(self.block)
+
+    def save(self, instance: DocumentSession) -> LiveBlock:
+        return instance.get_block(self.block)
+
+
+class InsertOperation(Operation):
+    """ Insert text into a block, creating the block if it doesn't exist """
+    TYPE = 'insert'
+    FIELDS = {
+        **Operation.FIELDS,
+        'text': char_field(allow_blank=True, trim_whitespace=False),
+    }
+    __slots__ = ('text',)
+
+    def check(self, batch: BatchCheck) -> None:
+        batch.get_or_create(self.block)
+
+    def save(self, instance: DocumentSession) -> None:
+        block: LiveBlock = instance.get_or_create_block(self.block)
+        block.text.insert(self.position, self.text)
+        block.styles.insert(self.position, len(self.text))
+        instance.mark_updated(block)
+        if block.styles:
+            instance.mark_styled(block)
+
+
+class DeleteOperation(Operation):
+    """ Delete text from a block, if position is -1 the block is deleted and merged into the one before it """
+    TYPE = 'delete'
+    FIELDS = {
+        'block': Operation.FIELDS['block'],
+        'position': integer_field(min_value=-1),
+        'offset': integer_field(min_value=0),
+    }
+    __slots__ = ('offset',)
+
+    def check(self, batch: BatchCheck) -> None:
+        if self.position == -1:
+            batch.merge(self.block)
+        else:
+            batch.get(self.block)
+
+    def save(self, instance: DocumentSession) -> None:
+        block: LiveBlock = super().save(instance)
+        if self.position == -1:
+            if (block_before := instance.get_block_before(block)):
+                styled = bool(block_before.styles)
+                block_before.text.append(
+                    block.text.slice(self.position + self.offset))
+                block_before.styles.extend(block.styles.slice(self.position + self.offset))
+                instance.mark_updated(block_before)
+                if styled or block_before.styles:
+                    instance.mark_styled(block_before)
+                instance.delete_block(block)
+        else:
+            # Styles which are deleted entirely still need deleting from the database
+            styled = bool(block.styles)
+            block.text.delete(self.position, self.position + self.offset)
+            block.styles.delete(self.position, self.position + self.offset)
+            instance.mark_updated(block)
+            if styled:
+                instance.mark_styled(block)
+
+
+class SplitBlockOperation(Operation):
+    """ Split a block in two at a position, the text after it moving to a new block """
+    TYPE = 'split-block'
+    FIELDS = {
+        **Operation.FIELDS,
+        'newBlock': char_field(min_length=1, max_length=5),
+    }
+    __slots__ = ('newBlock',)
+
+    def check(self, batch: BatchCheck) -> None:
+        batch.get(self.block)
+        batch.create(self.newBlock)
+
+    def save(self, instance: DocumentSession) -> None:
+        block: LiveBlock = super().save(instance)
+        overflow_text: str = block.text.slice(self.position)
+        block.text.delete(self.position)
+        overflow_styles = block.styles.split(self.position)
+        instance.mark_updated(block)
+
+        # Create new block directly after the one being split, its text keeping its styles
+        new_block = instance.insert_block_after(block, self.newBlock, overflow_text, overflow_styles)
+        if overflow_styles:
+            instance.mark_styled(new_block)
+        if block.styles or overflow_styles:
+            instance.mark_styled(block)
+
+
+class SetBlockTypeOperation(Operation):
+    TYPE = 'set-block-type'
+    FIELDS = {
+        'block': Operation.FIELDS['block'],
+        'newBlockType': char_field(),
+    }
+    __slots__ = ('newBlockType',)
+
+    def save(self, instance: DocumentSession) -> None:
+        block: LiveBlock = super().save(instance)
+        block.type = self.newBlockType
+        instance.mark_updated(block)
+
+
+class SetInlineStyleOperation(Operation):
+    TYPE = 'set-inline-style'
+    FIELDS = {
+        **Operation.FIELDS,
+        'offset': integer_field(min_value=0),
+        'style': char_field(),
+    }
+    __slots__ = ('offset', 'style')
+
+    def save(self, instance: DocumentSession) -> None:
+        block: LiveBlock = super().save(instance)
+        block.styles.add_style(self.position, self.offset, self.style)
+        instance.mark_styled(block)
+
+
+class UnknownOperation(Operation):
+    """ Update whose type is missing or isn't one of OPERATIONS, which is never valid """
+    __slots__ = ()
+
+    def is_valid(self) -> bool:
+        if type(self.initial_data) is dict:
+            self.errors = {'type': [UNKNOWN_OPERATION]}
+            return False
+        return super().is_valid()
+
+
+OPERATIONS: dict[str, type[Operation]] = {operation.TYPE: operation for operation in (
+    InsertOperation,
+    DeleteOperation,
+    SplitBlockOperation,
+    SetBlockTypeOperation,
+    SetInlineStyleOperation,
+)}
+
+
+def operation_for(update: Any) -> Operation:
+    """ Operation of the right type for an update, an invalid UnknownOperation if its type is missing or unknown """
+    operation_class = OPERATIONS.get(update.get('type')) if type(update) is dict else None
+    return (operation_class or UnknownOperation)(update)
@@ -0,0 +1,12 @@
+from rest_framework.pagination import CursorPagination
+
+
+class DocumentCursorPagination(CursorPagination):
+    """
+    Pages through a user's documents most recently modified first. Cursors encode the position
+    in the listing, so pages don't shift as documents are edited and no count query is needed.
+    """
+    ordering = ('-updated_at', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
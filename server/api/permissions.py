@@ -0,0 +1,65 @@
+from time import monotonic
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from api.models import DocumentCollaborator
+
+# Returned by CollaboratorPermissionCache.peek when a permission isn't cached
+NOT_CACHED = object()
+
+
+class CollaboratorPermissionCache:
+    """
+    Cache of each user's DocumentCollaborator.permission level per document, so authorising
+    websocket connections and every edit they send doesn't need a query.
+    A cached permission of None means the user isn't a collaborator of the document.
+    Entries are invalidated whenever a DocumentCollaborator is saved or deleted, and again once the
+    change commits (see api.signals). Other processes' signals never reach this cache, so entries
+    also expire after `ttl` seconds, the longest a change made elsewhere, or a permission read
+    inside a transaction which was then rolled back, can be served for.
+    """
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        # (document id, user id) to (expiry time, permission)
+        self._permissions: dict[tuple[str, str], tuple[float, int]] = {}
+        # Bumped on every invalidation so a lookup racing an invalidation doesn't cache a stale result
+        self._generation = 0
+
+    def peek(self, document_id, user_id):
+        """ Cached permission for a user in a document, NOT_CACHED if it would need a query """
+        cached = self._permissions.get((str(document_id), str(user_id)))
+        if cached is None or cached[0] <= monotonic():
+            return NOT_CACHED
+        return cached[1]
+
+    def get(self, document_id, user_id) -> int:
+        """ Permission for a user in a document, querying and caching it if necessary """
+        permission = self.peek(document_id, user_id)
+        if permission is NOT_CACHED:
+            generation = self._generation
+            try:
+                permission = DocumentCollaborator.objects.filter(
+                    document_id=document_id, user_id=user_id).values_list('permission', flat=True).first()
+            except ValidationError:
+                # Malformed document id, can't be a collaborator of a document which can't exist
+                return None
+            if generation == self._generation:
+                if len(self._permissions) >= self.max_size:
+                    self._permissions.clear()
+                self._permissions[(str(document_id), str(user_id))] = (monotonic() + self.ttl, permission)
+        return permission
+
+    def invalidate(self, document_id, user_id=None) -> None:
+        """ Forget a user's cached permission for a document, or every user's if user_id is None """
+        self._generation += 1
+        if user_id is not None:
+            self._permissions.pop((str(document_id), str(user_id)), None)
+        else:
+            document_id = str(document_id)
+            for key in [key for key in self._permissions if key[0] == document_id]:
+                del self._permissions[key]
+
+
+permission_cache = CollaboratorPermissionCache(
+    settings.COLLABORATOR_PERMISSION_CACHE_TTL.total_seconds(), settings.COLLABORATOR_PERMISSION_CACHE_SIZE)
@@ -0,0 +1,140 @@
+from __future__ import annotations
+import asyncio
+import logging
+from time import monotonic
+from uuid import uuid4
+from django.conf import settings
+from channels.layers import get_channel_layer
+from api import codecs, metrics
+from authentication.models import User
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentPresence:
+    """
+    Who has a live document open and where their cursor is, held in memory by the document's
+    DocumentSession and never written to the database.
+    Each socket is a connection, with a short id of its own so one user can have several open.
+    Sockets join the document's presence group by sending their cursor. Events are sent to the group
+    as {'type': 'presence', 'body': {'events': [...]}} frames, each event being a connection's entry
+    along with what happened to it: 'joined', 'cursor' (moved), 'idle' (hasn't moved in
+    DOCUMENT_PRESENCE_IDLE_AFTER) or 'left'.
+    Clients are sent their own events too, and skip them by their connection id. A frame which also
+    has the socket's own `connection` lists everyone present, replacing whoever the client knew of,
+    it's sent when the socket joins and in place of events dropped for a socket falling behind.
+
+    Cursor moves are collected for DOCUMENT_PRESENCE_INTERVAL and sent as one frame, only the
+    latest move of each connection is kept so superseded cursors are dropped rather than sent.
+    Every process keeps entries for connections in other processes up to date from their events,
+    so a socket joining is sent everyone already present.
+    """
+
+    def __init__(self, group: str) -> None:
+        self.group = group
+        # Identifies events sent by this process, which have already been applied here
+        self.origin = uuid4().hex
+        # Connection id to {'connection', 'user_id', 'username', 'selection', 'idle'}, for every process
+        self.entries: dict[str, dict] = {}
+        # Connection ids of sockets in this process, to when their cursor last moved
+        self.last_active: dict[str, float] = {}
+        # Connections whose latest cursor move is waiting to be sent
+        self.pending: set[str] = set()
+        self._task: asyncio.Task = None
+        self._idle_task: asyncio.Task = None
+
+    @property
+    def interval(self) -> float:
+        return settings.DOCUMENT_PRESENCE_INTERVAL.total_seconds()
+
+    @property
+    def idle_after(self) -> float:
+        return settings.DOCUMENT_PRESENCE_IDLE_AFTER.total_seconds()
+
+    async def join(self, user: User) -> tuple[str, list[dict]]:
+        """ Add a socket's connection, returning its id and the entries of everyone already present """
+        connection = uuid4().hex[:12]
+        present = list(self.entries.values())
+        entry = self.entries[connection] = {
+            'connection': connection, 'user_id': str(user.id), 'username': user.username, 'selection': None, 'idle': False}
+        self.last_active[connection] = monotonic()
+        if self._idle_task is None:
+            self._idle_task = asyncio.create_task(self._check_idle())
+        await self.send([{'event': 'joined', **entry}])
+        return connection, present
+
+    async def leave(self, connection: str) -> None:
+        entry = self.entries.pop(connection, None)
+        self.last_active.pop(connection, None)
+        self.pending.discard(connection)
+        if not self.last_active:
+            self.close()
+        if entry is not None:
+            await self.send([{'event': 'left', 'connection': connection}])
+
+    def move(self, connection: str, selection: dict) -> None:
+        """ Record a connection's cursor, to be sent with every other move made in the interval """
+        entry = self.entries.get(connection)
+        if entry is None:
+            return
+        if connection in self.pending:
+            metrics.PRESENCE_UPDATES.inc('superseded')
+        entry['selection'], entry['idle'] = selection, False
+        self.last_active[connection] = monotonic()
+        self.pending.add(connection)
+        if self._task is None:
+            self._task = asyncio.create_task(self._send_later())
+
+    async def _send_later(self) -> None:
+        await asyncio.sleep(self.interval)
+        self._task = None
+        events = [{'event': 'cursor', **self.entries[connection]} for connection in self.pending if connection in self.entries]
+        self.pending = set()
+        metrics.PRESENCE_UPDATES.inc('sent', amount=len(events))
+        try:
+            await self.send(events)
+        except Exception:
+            logger.exception('Failed to send cursors to %s', self.group)
+
+    async def _check_idle(self) -> None:
+        """ Mark connections in this process idle once their cursor hasn't moved for a while """
+        while True:
+            await asyncio.sleep(self.idle_after / 4)
+            idle_since = monotonic() - self.idle_after
+            events = []
+            for connection, last_active in self.last_active.items():
+                entry = self.entries[connection]
+                if last_active < idle_since and not entry['idle']:
+                    entry['idle'] = True
+                    events.append({'event': 'idle', **entry})
+            try:
+                await self.send(events)
+            except Exception:
+                logger.exception('Failed to send idle connections to %s', self.group)
+
+    async def send(self, events: list[dict]) -> None:
+        if events:
+            await get_channel_layer().group_send(self.group, {
+                'type': 'presence',
+                'origin': self.origin,
+                'events': events,
+                'text': codecs.dumps({'type': 'presence', 'body': {'events': events}}),
+            })
+
+    def apply(self, event: dict) -> None:
+        """ Bring entries up to date with a presence event sent by another process """
+        if event['origin'] == self.origin:
+            return
+        for update in event['events']:
+            if update['event'] == 'left':
+                self.entries.pop(update['connection'], None)
+            else:
+                self.entries[update['connection']] = {key: value for key, value in update.items() if key != 'event'}
+
+    def close(self) -> None:
+        """ Stop sending cursors and checking for idle connections, for when no sockets are left in this process """
+        for task in (self._task, self._idle_task):
+            if task is not None:
+                task.cancel()
+        self._task = self._idle_task = None
+        self.pending = set()
@@ -0,0 +1,263 @@
+"""
+Full text search over the titles and block text of a user's documents, backed by the SQLite FTS5
+indexes created in migrations 0008 and 0009. Triggers keep the indexes up to date as blocks and titles
+are written, so edits held in memory by a live session are searchable once they're flushed.
+
+Blocks are indexed by their integer primary key. Documents only have a UUID, and their implicit
+rowid is renumbered by VACUUM, so titles are indexed by the key api_document_fts_key gives each one.
+Django rebuilds a table to alter it on SQLite, dropping its triggers, so they're recreated after
+every migrate if they're missing (see repair_search_index).
+
+The indexes are only created on SQLite, other databases are searched with substring matches instead.
+"""
+from __future__ import annotations
+import re
+from uuid import UUID
+from django.db import connection, connections, transaction
+from django.db.models import OuterRef, Q, Subquery
+from api.models import Document, DocumentCollaborator, ContentBlock
+from authentication.models import User
+
+# Marks around matched terms in highlights and snippets, control characters which never appear in text
+MATCH_START, MATCH_END = '\x02', '\x03'
+# Tokens in a snippet of the best matching block
+SNIPPET_TOKENS = 16
+# Title matches count for this many times a match in a block
+TITLE_WEIGHT = 2.0
+
+# FTS5 functions can't be used in an aggregate, so blocks are ranked in a materialized table first
+SEARCH_SQL = f"""
+WITH collaborations AS ({{collaborations}}),
+titles AS MATERIALIZED (
+    SELECT api_document_fts_key.document_id, bm25(api_document_fts) AS rank,
+           highlight(api_document_fts, 0, '{MATCH_START}', '{MATCH_END}') AS title
+    FROM api_document_fts JOIN api_document_fts_key ON api_document_fts_key.id = api_document_fts.rowid
+    WHERE api_document_fts MATCH %s AND api_document_fts_key.document_id IN collaborations
+),
+ranked_blocks AS MATERIALIZED (
+    SELECT document_id, bm25(api_contentblock_fts) AS rank, rowid AS block_id
+    FROM api_contentblock_fts
+    WHERE api_contentblock_fts MATCH %s AND document_id IN collaborations
+),
+blocks AS (
+    -- SQLite takes bare columns from the row with the lowest rank, so each document's best block
+    SELECT document_id, MIN(rank) AS rank, block_id FROM ranked_blocks GROUP BY document_id
+),
+matches AS (
+    SELECT document_id, rank * {TITLE_WEIGHT} AS rank, title, NULL AS block_id FROM titles
+    UNION ALL
+    SELECT document_id, rank, NULL, block_id FROM blocks
+)
+SELECT matches.document_id, SUM(matches.rank) AS rank, MAX(matches.title), MAX(matches.block_id), api_contentblock.key
+FROM matches LEFT JOIN api_contentblock ON api_contentblock.id = matches.block_id
+GROUP BY matches.document_id
+ORDER BY rank
+LIMIT %s
+"""
+
+# Snippets are only made for the blocks which made it into the results
+SNIPPETS_SQL = f"""
+SELECT rowid, snippet(api_contentblock_fts, 0, '{MATCH_START}', '{MATCH_END}', '…', {SNIPPET_TOKENS})
+FROM api_contentblock_fts
+WHERE api_contentblock_fts MATCH %s AND rowid IN ({{block_ids}})
+"""
+
+# Triggers keeping the indexes up to date, by table
+SEARCH_TRIGGERS = {
+    'api_contentblock': {
+        'api_contentblock_fts_insert': """
+            CREATE TRIGGER api_contentblock_fts_insert AFTER INSERT ON api_contentblock BEGIN
+                INSERT INTO api_contentblock_fts(rowid, text, document_id) VALUES (new.id, new.text, new.document_id);
+            END
+        """,
+        'api_contentblock_fts_delete': """
+            CREATE TRIGGER api_contentblock_fts_delete AFTER DELETE ON api_contentblock BEGIN
+                INSERT INTO api_contentblock_fts(api_contentblock_fts, rowid, text, document_id)
+                VALUES ('delete', old.id, old.text, old.document_id);
+            END
+        """,
+        'api_contentblock_fts_update': """
+            CREATE TRIGGER api_contentblock_fts_update AFTER UPDATE OF text ON api_contentblock BEGIN
+                INSERT INTO api_contentblock_fts(api_contentblock_fts, rowid, text, document_id)
+                VALUES ('delete', old.id, old.text, old.document_id);
+                INSERT INTO api_contentblock_fts(rowid, text, document_id) VALUES (new.id, new.text, new.document_id);
+            END
+        """,
+    },
+    'api_document': {
+        'api_document_fts_insert': """
+            CREATE TRIGGER api_document_fts_insert AFTER INSERT ON api_document BEGIN
+                INSERT INTO api_document_fts_key(document_id) VALUES (new.id);
+                INSERT INTO api_document_fts(rowid, title)
+                VALUES ((SELECT id FROM api_document_fts_key WHERE document_id = new.id), new.title);
+            END
+        """,
+        'api_document_fts_delete': """
+            CREATE TRIGGER api_document_fts_delete AFTER DELETE ON api_document BEGIN
+                DELETE FROM api_document_fts WHERE rowid = (SELECT id FROM api_document_fts_key WHERE document_id = old.id);
+                DELETE FROM api_document_fts_key WHERE document_id = old.id;
+            END
+        """,
+        'api_document_fts_update': """
+            CREATE TRIGGER api_document_fts_update AFTER UPDATE OF title ON api_document BEGIN
+                UPDATE api_document_fts SET title = new.title
+                WHERE rowid = (SELECT id FROM api_document_fts_key WHERE document_id = old.id);
+            END
+        """,
+    },
+}
+
+# Reindex everything in a table, for when writes may have been made without the triggers
+REBUILD_SQL = {
+    'api_contentblock': [
+        "INSERT INTO api_contentblock_fts(api_contentblock_fts) VALUES ('rebuild')",
+    ],
+    'api_document': [
+        'DELETE FROM api_document_fts',
+        'DELETE FROM api_document_fts_key',
+        'INSERT INTO api_document_fts_key(document_id) SELECT id FROM api_document',
+        """
+        INSERT INTO api_document_fts(rowid, title)
+        SELECT api_document_fts_key.id, api_document.title
+        FROM api_document JOIN api_document_fts_key ON api_document_fts_key.document_id = api_document.id
+        """,
+    ],
+}
+
+
+def repair_search_index(using: str = 'default') -> list[str]:
+    """
+    Recreate any of the search index's triggers which are missing, reindexing the tables they're on
+    as writes may have been missed, returning the names of the triggers recreated
+    """
+    database = connections[using]
+    if database.vendor != 'sqlite':
+        return []
+    with transaction.atomic(using=using), database.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+        existing = {name for name, in cursor.fetchall()}
+        cursor.execute("SELECT name FROM sqlite_master WHERE name IN ('api_contentblock_fts', 'api_document_fts_key')")
+        if len(cursor.fetchall()) < 2:
+            # Index hasn't been migrated in yet
+            return []
+
+        repaired = []
+        for table, triggers in SEARCH_TRIGGERS.items():
+            missing = [name for name in triggers if name not in existing]
+            for name in missing:
+                cursor.execute(triggers[name])
+            if missing:
+                for statement in REBUILD_SQL[table]:
+                    cursor.execute(statement)
+            repaired += missing
+    return repaired
+
+
+def match_expression(query: str) -> str:
+    """
+    FTS5 query matching documents with every word of `query`, the last as a prefix so results
+    come up as the user types. Words are quoted so FTS5 syntax in the query is never interpreted.
+    None if there are no words to search for.
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def highlights(text: str) -> tuple[str, list[dict]]:
+    """ Text with the match marks taken out, and the {'offset', 'length'} of each match """
+    plain, ranges = '', []
+    for i, part in enumerate(re.split(f'[{MATCH_START}{MATCH_END}]', text)):
+        if i % 2:
+            ranges.append({'offset': len(plain), 'length': len(part)})
+        plain += part
+    return plain, ranges
+
+
+def search_documents(user: User, query: str, limit: int) -> list[dict]:
+    """
+    Up to `limit` of the documents `user` collaborates on matching `query`, best match first.
+    Each match has the document's `id`, its matched `title_highlights`, and the `block` which best
+    matched along with a `snippet` of its text and the `snippet_highlights` within it.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return []
+    if connection.vendor != 'sqlite':
+        return search_documents_unindexed(user, re.findall(r'\w+', query), limit)
+
+    collaborations, params = DocumentCollaborator.objects.filter(user=user).values('document_id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(SEARCH_SQL.format(collaborations=collaborations),
+                       (*params, expression, expression, limit))
+        rows = cursor.fetchall()
+
+        snippets = {}
+        if block_ids := [block_id for document_id, rank, title, block_id, block in rows if block_id is not None]:
+            cursor.execute(SNIPPETS_SQL.format(block_ids=', '.join(['%s'] * len(block_ids))), (expression, *block_ids))
+            snippets = dict(cursor.fetchall())
+
+    matches = []
+    for document_id, rank, title, block_id, block in rows:
+        snippet, snippet_highlights = highlights(snippets[block_id]) if block_id in snippets else (None, [])
+        matches.append({
+            'id': UUID(document_id),
+            'title_highlights': highlights(title)[1] if title is not None else [],
+            'block': block,
+            'snippet': snippet,
+            'snippet_highlights': snippet_highlights,
+        })
+    return matches
+
+
+def substring_highlights(text: str, words: list[str]) -> list[dict]:
+    """ The {'offset', 'length'} of each case insensitive occurrence of any of `words` in `text` """
+    pattern = '|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+    return [{'offset': match.start(), 'length': len(match.group())}
+            for match in re.finditer(pattern, text, re.IGNORECASE)]
+
+
+def substring_snippet(text: str, words: list[str]) -> str:
+    """ Up to SNIPPET_TOKENS words of `text` around the first occurrence of any of `words`, like FTS5 snippet() """
+    tokens = list(re.finditer(r'\S+', text))
+    highlights = substring_highlights(text, words)
+    if len(tokens) <= SNIPPET_TOKENS or not highlights:
+        return text
+    first = next(i for i, token in enumerate(tokens) if token.end() > highlights[0]['offset'])
+    start = max(0, min(first - SNIPPET_TOKENS // 2, len(tokens) - SNIPPET_TOKENS))
+    end = start + SNIPPET_TOKENS
+    snippet = text[tokens[start].start():tokens[end - 1].end()]
+    return ('…' if start > 0 else '') + snippet + ('…' if end < len(tokens) else '')
+
+
+def search_documents_unindexed(user: User, words: list[str], limit: int) -> list[dict]:
+    """
+    search_documents for databases without the FTS5 indexes. Documents match if their title, or
+    one of their blocks, contains every word, case insensitively. Matches aren't ranked, the most
+    recently updated come first and the best matching block is the first which matches.
+    """
+    title, blocks = Q(), ContentBlock.objects.filter(document=OuterRef('pk'))
+    for word in words:
+        title &= Q(title__icontains=word)
+        blocks = blocks.filter(text__icontains=word)
+    documents = Document.objects.filter(collaborators__user=user).annotate(
+        title_matched=Q(title), block=Subquery(blocks.order_by('rank').values('key')[:1]),
+    ).filter(Q(title_matched=True) | Q(block__isnull=False)).order_by('-updated_at')
+    rows = list(documents.values_list('id', 'title', 'title_matched', 'block')[:limit])
+
+    texts = {(document_id, key): text for document_id, key, text in ContentBlock.objects.filter(
+        document_id__in=[document_id for document_id, *_ in rows],
+        key__in=[block for *_, block in rows if block is not None],
+    ).values_list('document_id', 'key', 'text')}
+    matches = []
+    for document_id, document_title, title_matched, block in rows:
+        snippet = substring_snippet(texts[document_id, block], words) if (document_id, block) in texts else None
+        matches.append({
+            'id': document_id,
+            'title_highlights': substring_highlights(document_title, words) if title_matched else [],
+            'block': block,
+            'snippet': snippet,
+            'snippet_highlights': substring_highlights(snippet, words) if snippet is not None else [],
+        })
+    return matches
@@ -1,22 +1,30 @@
-from abc import abstractmethod
+from collections.abc import Iterable
 from uuid import uuid4
 from datetime import datetime
 from django.conf import settings
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
-from api.models import Document, DocumentCollaborator, ContentBlock, InlineStyle
+from api.models import Document, DocumentCollaborator, ContentBlock
+from api.styles import style_dictionary
+from api.utils import evenly_spaced_ranks
 from authentication.serializers import UserSerializer
-from authentication.models import User
 
 
-class InlineStyleSerializer(ModelSerializer):
-    class Meta:
-        model = InlineStyle
-        fields = ('length', 'offset', 'style')
+class InlineStyleSerializer(serializers.Serializer):
+    """ Serializer for a Draft.js inline style range, stored packed into ContentBlock.inline_styles """
+    length = serializers.IntegerField(min_value=0)
+    offset = serializers.IntegerField(min_value=0)
+    style = serializers.CharField(max_length=64)
+
+
+def draft_style_ranges(inline_styles: bytes) -> list[dict]:
+    """ Draft.js inlineStyleRanges for a ContentBlock's packed inline_styles """
+    return [{'length': length, 'offset': offset, 'style': style}
+            for offset, length, style in style_dictionary.unpack(inline_styles)]
 
 
 class ContentBlockSerializer(ModelSerializer):
-    styles = InlineStyleSerializer(many=True)
+    styles = InlineStyleSerializer(many=True, required=False, write_only=True)
 
     class Meta:
         model = ContentBlock
@@ -31,50 +39,95 @@ class ContentBlockSerializer(ModelSerializer):
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
-        representation['inlineStyleRanges'] = representation.pop('styles')
+        representation['inlineStyleRanges'] = draft_style_ranges(instance.inline_styles)
         # Add extra paramters for Draft.js editor
         representation.update({'data': {}, 'depth': 0, 'entityRanges': []})
         return representation
 
     def create(self, validated_data) -> ContentBlock:
-        inline_styles = validated_data.pop('inline_styles', [])
-        content_block: ContentBlock = ContentBlock.objects.create(
-            **validated_data)
-        for style in inline_styles:
-            style_serializer = InlineStyleSerializer(data=style)
-            if style_serializer.is_valid():
-                style_serializer.save(content_block=content_block)
+        inline_styles = validated_data.pop('styles', [])
+        return ContentBlock.objects.create(**validated_data, inline_styles=style_dictionary.pack(
+            (style['offset'], style['length'], style['style']) for style in inline_styles))
+
 
-        return content_block
+def draft_blocks(blocks: Iterable[tuple]) -> list[dict]:
+    """
+    Draft.js representation of ContentBlocks, matching what ContentBlockSerializer gives for each.
+    Built straight from (key, text, type, inline_styles) rows rather than a serializer per block.
+    """
+    return [{
+        'key': key,
+        'text': text,
+        'type': type,
+        'inlineStyleRanges': draft_style_ranges(inline_styles),
+        'data': {},
+        'depth': 0,
+        'entityRanges': [],
+    } for key, text, type, inline_styles in blocks]
+
+
+def editor_content(document: Document) -> dict:
+    """ Draft.js raw content state for a document as stored in the database """
+    return {
+        'blocks': draft_blocks(document.blocks.values_list('key', 'text', 'type', 'inline_styles')),
+        'entityMap': {},
+    }
+
+
+def blocks_window(document: Document, limit: int, offset: int = None, after: str = None) -> dict:
+    """
+    Up to `limit` of a document's blocks as stored in the database, from `offset` or following the
+    block with key `after`, matching DocumentSession.blocks_window. Raises ContentBlock.DoesNotExist
+    if there's no block `after`.
+    """
+    blocks = document.blocks.values_list('key', 'text', 'type', 'inline_styles')
+    if after is not None:
+        # Seek to the cursor block by rank using the (document, rank) index
+        rank: str = document.blocks.values_list('rank', flat=True).get(key=after)
+        offset = document.blocks.filter(rank__lte=rank).count()
+        page = list(blocks.filter(rank__gt=rank)[:limit])
+    else:
+        offset = offset or 0
+        page = list(blocks[offset:offset + limit])
+
+    count: int = document.blocks.count()
+    return {
+        'revision': document.revision,
+        'title': document.title,
+        'count': count,
+        'offset': offset,
+        'blocks': draft_blocks(page),
+        'next': page[-1][0] if page and offset + limit < count else None,
+    }
 
 
 class DocumentCollaboratorSerializer(ModelSerializer):
-    """ Serializer class for DocumentCollaborator model """
+    """ Serializer class for DocumentCollaborator model, select the related user when serializing many """
 
     class Meta:
         model = DocumentCollaborator
         fields = ('id', 'user', 'permission', 'document')
 
-    def get_user(self, user_id: str) -> User:
-        return User.objects.get(id=user_id)
-
     def to_representation(self, instance: DocumentCollaborator) -> dict:
         representation: dict = super().to_representation(instance)
         representation['permission_level'] = instance.permission_level()
-        representation['user'] = UserSerializer(
-            instance=self.get_user(representation['user'])).data
+        representation['user'] = UserSerializer(instance=instance.user).data
         representation['document'] = str(representation['document'])
         return representation
 
 
 class DocumentSerializer(ModelSerializer):
-    """ Serializer class for Document model """
-    blocks = ContentBlockSerializer(many=True, required=False)
-    collaborators = DocumentCollaboratorSerializer(many=True, read_only=True)
+    """
+    Serializer class for Document model. Documents are represented in a fixed number of queries
+    however many blocks, styles and collaborators they have.
+    """
+    blocks = ContentBlockSerializer(many=True, required=False, write_only=True)
+    collaborators = serializers.SerializerMethodField()
 
     class Meta:
         model = Document
-        fields = ('id', 'title', 'blocks', 'collaborators')
+        fields = ('id', 'title', 'revision', 'blocks', 'collaborators')
+        read_only_fields = ('revision',)
 
     def generate_authentication_ticket(self) -> str:
         """ Generate an authentication ticket and store in current user with experation time """
@@ -88,22 +141,22 @@ class DocumentSerializer(ModelSerializer):
 
         return authentication_ticket
 
+    def get_collaborators(self, instance: Document) -> list[dict]:
+        return DocumentCollaboratorSerializer(instance.collaborators.select_related('user'), many=True).data
+
     def to_representation(self, instance: Document):
         representation = super().to_representation(instance)
-        representation['editor'] = {
-            'blocks': representation.pop('blocks'),
-            'entityMap': {},
-        }
+        # DocumentView adds the editor content itself, from its snapshot cache
+        if self.context.get('include_editor', True):
+            representation['editor'] = editor_content(instance)
 
         if 'generate_authentication_ticket' in self.context:
             representation['authentication_ticket'] = self.generate_authentication_ticket(
             )
 
-        collaborator: DocumentCollaborator = instance.collaborators.get(
-            user=self.context['user'])
-
-        representation['permission_level'] = collaborator.permission_level()
-        representation['permission'] = collaborator.permission
+        permission: int = instance.user_permission(self.context['user'])
+        representation['permission_level'] = dict(DocumentCollaborator.PERMISSION_CHOICES).get(permission)
+        representation['permission'] = permission
 
         return representation
 
@@ -121,143 +174,51 @@ class DocumentSerializer(ModelSerializer):
             document=document, user=user, permission=0)
 
         # Create ContentBlocks
-        for block in content_blocks:
+        for block, rank in zip(content_blocks, evenly_spaced_ranks(len(content_blocks))):
             block_serializer = ContentBlockSerializer(data=block)
             if block_serializer.is_valid():
-                block_serializer.save(document=document)
+                block_serializer.save(document=document, rank=rank)
 
         return document
 
 
-class WebSocketMessageSerializer(serializers.Serializer):
-    """ Simple serializer to check the basic validity of a websocket message :- only checks if a type exist """
-    type = serializers.CharField(required=True)
-    access_token = serializers.CharField(required=True)
-    body = serializers.DictField(required=True)
-
-
-class UpdateDocumentTitleSerializer(serializers.Serializer):
-    """ Serializer to handle a document title update """
-    title = serializers.CharField(required=True)
-
-    def save(self, instance: Document, **kwargs):
-        instance.title = self.validated_data['title']
-        instance.save(update_fields=['title'])
-
-
-class UpdateDocumentContentSerializer(serializers.Serializer):
-    """ Serializer to handle a document update """
-    data = serializers.ListField(required=True)
+class DocumentSummarySerializer(ModelSerializer):
+    """
+    Listing representation of a Document, without its content or collaborators. Expects the
+    `permission` and `collaborator_count` annotations added by DocumentsListCreateView.
+    """
+    permission = serializers.IntegerField(read_only=True)
+    permission_level = serializers.SerializerMethodField()
+    collaborator_count = serializers.IntegerField(read_only=True)
 
+    class Meta:
+        model = Document
+        fields = ('id', 'title', 'updated_at', 'permission', 'permission_level', 'collaborator_count')
 
-class BaseDocumentUpdateContentSerializer(serializers.Serializer):
-    """ Base serializer class to be inherited by serializers which modify the content of a document """
-    block = serializers.CharField(required=True, min_length=1, max_length=5)
-    position = serializers.IntegerField(required=True, min_value=0)
+    def get_permission_level(self, instance: Document) -> str:
+        return dict(DocumentCollaborator.PERMISSION_CHOICES).get(instance.permission)
 
-    @abstractmethod
-    def save(self, instance: Document, **kwargs) -> None:
-        """ Define the behaviour for updating document content """
-        return instance.blocks.get(key=self.validated_data['block'])
 
-    def get_block_before(self, block: ContentBlock, instance: Document) -> ContentBlock:
-        """
-        Get the ContentBlock object which comes before `block` in the instance Document
-        None will be returned if it's the last block in the document
-        """
-        queryset = instance.blocks.filter(index__lt=block.index)
-        return queryset.reverse()[0] if len(queryset) > 0 else None
+class BlocksWindowSerializer(serializers.Serializer):
+    """ Serializer for a window of a document's blocks, starting at an ordinal `offset` or after the block with key `after` """
+    offset = serializers.IntegerField(required=False, min_value=0)
+    after = serializers.CharField(required=False, min_length=1, max_length=5)
+    limit = serializers.IntegerField(required=True, min_value=1, max_value=settings.DOCUMENT_BLOCKS_PAGE_LIMIT)
 
-    def get_block_after(self, block: ContentBlock, instance: Document) -> ContentBlock:
-        """
-        Get the ContentBlock object which comes after `block` in the instance Document
-        None will be returned if it's the last block in the document
-        """
-        queryset = instance.blocks.filter(index__gt=block.index)
-        return queryset[0] if len(queryset) > 0 else None
 
+class DocumentSearchSerializer(serializers.Serializer):
+    """ Serializer for a search of a user's documents for `q`, returning at most `limit` results """
+    q = serializers.CharField(required=True, max_length=256)
+    limit = serializers.IntegerField(required=False, default=20, min_value=1, max_value=settings.DOCUMENT_SEARCH_LIMIT)
 
-class InsertDocumentContentSerializer(BaseDocumentUpdateContentSerializer):
-    """ Serializer class to handle inserting text into a document's content """
-    text = serializers.CharField(
-        required=True, trim_whitespace=False, allow_blank=True)
 
-    def save(self, instance: Document, **kwargs) -> None:
-        block: ContentBlock = instance.blocks.get_or_create(
-            key=self.validated_data['block'], defaults={'index': 0})[0]
-        block.text = block.text[:self.validated_data['position']] + \
-            self.validated_data['text'] + \
-            block.text[self.validated_data['position']:]
-        block.save(update_fields=['text'])
+class UserAutocompleteSerializer(serializers.Serializer):
+    """ Serializer for autocompleting usernames starting with `q`, leaving out collaborators of `document` """
+    q = serializers.CharField(required=True, max_length=150)
+    document = serializers.UUIDField(required=False)
+    limit = serializers.IntegerField(required=False, default=10, min_value=1, max_value=settings.USER_AUTOCOMPLETE_LIMIT)
 
 
-class DeleteDocumentContentSerializer(BaseDocumentUpdateContentSerializer):
-    """
-    Serializer class to handle deleting text from a document's conten
-    If position is -1, the given content block will be deleted
-    """
-    position = serializers.IntegerField(required=True, min_value=-1)
-    offset = serializers.IntegerField(required=True, min_value=0)
-
-    def save(self, instance: Document, **kwargs) -> None:
-        block: ContentBlock = instance.blocks.get(
-            key=self.validated_data['block'])
-        if self.validated_data['position'] == -1:
-            if (block_before := self.get_block_before(block, instance)):
-                block_before.text += block.text[self.validated_data['position'] +
-                                                self.validated_data['offset']:]
-                block_before.save(update_fields=['text'])
-                block.delete()
-        else:
-            block.text = block.text[:self.validated_data['position']] + \
-                block.text[self.validated_data['position'] +
-                           self.validated_data['offset']:]
-            block.save(update_fields=['text'])
-
-
-class SplitContentBlockSerializer(BaseDocumentUpdateContentSerializer):
-    newBlock = serializers.CharField(
-        required=True, min_length=1, max_length=5)
-
-    def save(self, instance: Document, **kwargs) -> None:
-        block: ContentBlock = instance.blocks.get(
-            key=self.validated_data['block'])
-        overflow_text: str = block.text[self.validated_data['position']:]
-        block.text = block.text[:self.validated_data['position']]
-        block.save(update_fields=['text'])
-
-        # Shift all block indexes forward
-        for b in instance.blocks.filter(index__gt=block.index):
-            b.index = b.index + 1
-            b.save(update_fields=['index'])
-
-        # Create new ContentBlock
-        new_block: ContentBlock = instance.blocks.create(
-            key=self.validated_data['newBlock'], text=overflow_text, index=block.index + 1)
-
-
-class SetContentBlockTypeSerializer(BaseDocumentUpdateContentSerializer):
-    """ Serializer for changing the type of a content block """
-    newBlockType = serializers.CharField(required=True)
-    position = None
-
-    def save(self, instance: Document, **kwargs):
-        block: ContentBlock = instance.blocks.get(
-            key=self.validated_data['block'])
-        block.type = self.validated_data['newBlockType']
-        block.save(update_fields=['type'])
-
-
-class SetInlineStyleSerializer(BaseDocumentUpdateContentSerializer):
-    """ Serializers for updating inline styles """
-    offset = serializers.IntegerField(required=True, min_value=0)
-    style = serializers.CharField(required=True)
-
-    def save(self, instance: Document, **kwargs):
-        # TODO Implement this super method throughout all BaseDocumentUpdateContentSerializer classes
-        # TODO Will need to update inline styles when inserting or deleting text as well
-        block: ContentBlock = super().save(instance, **kwargs)
-
-        block.styles.create(
-            length=self.validated_data['offset'], offset=self.validated_data['position'], style=self.validated_data['style'])
-        print('Styles: ', block.styles.all())
+class SyncDocumentSerializer(serializers.Serializer):
+    """ Serializer for a reconnecting client asking for everything since the last revision it saw """
+    revision = serializers.IntegerField(required=True, min_value=0)
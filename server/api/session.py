@@ -0,0 +1,752 @@
+from __future__ import annotations
+import asyncio
+import logging
+from bisect import bisect_left
+from collections import deque
+from operator import attrgetter
+from time import perf_counter
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from api import codecs, metrics
+from api.broadcast import BroadcastAggregator
+from api.presence import DocumentPresence
+from api.models import Document, DocumentOperation, ContentBlock
+from api.snapshots import snapshot_cache
+from api.styles import StyleRuns, style_dictionary
+from api.text import Rope
+from api.utils import rank_between, evenly_spaced_ranks, needs_rebalance
+from api.writer import database_writers
+
+logger = logging.getLogger(__name__)
+
+
+class LiveBlock:
+    """ In memory copy of a ContentBlock which is being edited through a DocumentSession """
+    __slots__ = ('pk', 'key', 'text', 'type', 'rank', 'styles')
+
+    def __init__(self, key: str, rank: str, text: str = '', type: str = 'unstyled', pk: int = None,
+                 styles: list | StyleRuns = None) -> None:
+        self.pk = pk
+        self.key = key
+        self.rank = rank
+        # Only flattened back into a str when the block is persisted or serialized
+        self.text = Rope(text)
+        self.type = type
+        # Given as (offset, length, style) tuples, and shifted along with the text as it's edited
+        self.styles = styles if isinstance(styles, StyleRuns) else StyleRuns(len(self.text), styles or ())
+
+    def __repr__(self) -> str:
+        return f'<LiveBlock {self.key}>'
+
+    def to_representation(self) -> dict:
+        """ Draft.js representation of the block, matching ContentBlockSerializer """
+        return {
+            'key': self.key,
+            'text': str(self.text),
+            'type': self.type,
+            'inlineStyleRanges': [{'length': length, 'offset': offset, 'style': style}
+                                  for offset, length, style in self.styles],
+            'data': {},
+            'depth': 0,
+            'entityRanges': [],
+        }
+
+    @classmethod
+    def from_model(cls, block: ContentBlock) -> LiveBlock:
+        return cls(
+            block.key, block.rank, block.text, block.type, pk=block.pk,
+            styles=style_dictionary.unpack(block.inline_styles))
+
+
+class BlockExists(Exception):
+    """ Raised for an operation creating a block with the key of a block which already exists """
+
+
+class StaleRevision(Exception):
+    """ Raised when flushing a copy of a document which is behind the revision another process has written """
+
+    def __init__(self, revision: int) -> None:
+        super().__init__(revision)
+        self.revision = revision
+
+
+class BatchCheck:
+    """
+    Which blocks a batch of operations will find, worked out from the keys alone before any of the
+    batch is applied, so a batch which would fail part way through is rejected whole rather than
+    leaving its first operations applied. Operations say what they need with `check`.
+    Blocks are only ever created at the end of the document or after another block, and a block
+    merged into the one before it is left alone if it's first, so only the first key is tracked.
+    """
+
+    def __init__(self, session: DocumentSession) -> None:
+        self.session = session
+        self.created: set[str] = set()
+        self.deleted: set[str] = set()
+        self.first: str = session.blocks[0].key if session.blocks else None
+
+    def exists(self, key: str) -> bool:
+        return key in self.created or (key not in self.deleted and key in self.session._blocks_by_key)
+
+    def get(self, key: str) -> None:
+        if not self.exists(key):
+            raise ContentBlock.DoesNotExist(f'Content block {key} does not exist')
+
+    def get_or_create(self, key: str) -> None:
+        if not self.exists(key):
+            self.create(key)
+
+    def create(self, key: str) -> None:
+        if self.exists(key):
+            raise BlockExists(f'Content block {key} already exists')
+        self.created.add(key)
+        self.deleted.discard(key)
+        if self.first is None:
+            self.first = key
+
+    def merge(self, key: str) -> None:
+        """ A block merged into the one before it, if there is one """
+        self.get(key)
+        if key != self.first:
+            self.created.discard(key)
+            self.deleted.add(key)
+
+
+class DocumentSession:
+    """
+    Live in memory copy of a document, shared by every websocket editing it in this process.
+    The document and all of its blocks are loaded once when the first socket joins, edits are
+    then applied in memory and dirty blocks are written back to the database every
+    DOCUMENT_SESSION_FLUSH_INTERVAL, and when the last socket leaves, by the document's writer
+    thread (see api.writer).
+    Every applied operation moves the document on a revision and is added to its operation log,
+    the most recent of which are kept in memory to catch reconnecting clients up.
+
+    When the channel layer spans several processes (BrokerChannelLayer) a document can be live in
+    more than one of them. Revisions are then numbered by the broker, and the session listens to
+    the document's group for batches applied elsewhere, which are replicated into this copy. Every
+    copy applies batches strictly in revision order, its own included, holding back any which
+    arrive before an earlier one, so copies at the same revision have the same text. Only the
+    process which applied an operation logs it and writes the blocks it changed, and never while
+    its copy is behind the revision another process has written.
+    """
+    _sessions: dict[str, DocumentSession] = {}
+    # Sessions being loaded or closed by document id, which joins wait for without holding the lock
+    _pending: dict[str, asyncio.Task] = {}
+    _sessions_lock = asyncio.Lock()
+    # Seconds to wait for other processes to flush a document before loading it
+    REMOTE_FLUSH_TIMEOUT = 5
+    # Seconds to wait for a missing revision from another process before carrying on without it
+    REPLICATION_TIMEOUT = 5
+
+    def __init__(self, document: Document, blocks: list[LiveBlock], operations: list[tuple[int, dict]] = ()) -> None:
+        self.document = document
+        self.blocks = blocks
+        self._blocks_by_key: dict[str, LiveBlock] = {block.key: block for block in blocks}
+        self.connections = 0
+        self.broadcaster = BroadcastAggregator(f'document_{document.id}')
+        self.presence = DocumentPresence(f'document_{document.id}_presence')
+
+        self.revision: int = document.revision
+        # (revision, operation) pairs for the latest revisions, oldest first
+        self.operations: deque[tuple[int, dict]] = deque(
+            operations, maxlen=settings.DOCUMENT_OPERATION_CATCHUP_LIMIT)
+        self._replicating = False
+
+        # Multi process replication, see start_replicating
+        self.channel_layer = get_channel_layer()
+        self.channel_name: str = None
+        self._replication_task: asyncio.Task = None
+        # Batches from other processes which arrived before an earlier revision, (last revision, serializers) by the revision before them
+        self._held: dict[int, tuple[int, list]] = {}
+        # Revisions before batches reserved by this process, which are waiting for their turn
+        self._waiting: set[int] = set()
+        self._advanced = asyncio.Event()
+        self._gap_task: asyncio.Task = None
+
+        # Changes waiting to be flushed, all tracked by block key
+        self._created: set[str] = set()
+        self._updated: set[str] = set()
+        self._styled: set[str] = set()
+        self._deleted: set[str] = set()
+        self._title_changed = False
+        self._operations: list[DocumentOperation] = []
+
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task = None
+        # Held from checking a batch until it's applied, so no other batch changes the blocks it was checked against
+        self._apply_lock = asyncio.Lock()
+
+    @classmethod
+    async def join(cls, document_id: str) -> DocumentSession:
+        """ Get the live session for a document, loading it from the database if no socket has it open """
+        while True:
+            async with cls._sessions_lock:
+                session = cls._sessions.get(document_id)
+                if session is not None:
+                    session.connections += 1
+                    return session
+                pending = cls._pending.get(document_id)
+                if pending is None:
+                    pending = cls._pending[document_id] = asyncio.create_task(cls._open(document_id))
+            # Loading can wait on other processes, so only joins of the same document wait for it
+            await asyncio.shield(pending)
+
+    @classmethod
+    async def _open(cls, document_id: str) -> None:
+        """ Load a document's session and make it live, for join """
+        session = None
+        try:
+            # Listen for other processes' edits before loading, so none are missed in between
+            channel_name = await cls.subscribe(document_id)
+            try:
+                await cls._flush_other_processes(document_id)
+                session = await cls.load(document_id)
+            except BaseException:
+                if channel_name is not None:
+                    await get_channel_layer().group_discard(f'document_{document_id}', channel_name)
+                raise
+            session.start_replicating(channel_name)
+            if not session.write_through:
+                session._flush_task = asyncio.create_task(
+                    session._flush_periodically())
+        finally:
+            async with cls._sessions_lock:
+                del cls._pending[document_id]
+                if session is not None:
+                    cls._sessions[document_id] = session
+
+    async def leave(self) -> None:
+        """ Release a socket's hold on the session, persisting and closing it once nobody is left """
+        document_id = str(self.document.id)
+        async with self._sessions_lock:
+            self.connections -= 1
+            if self.connections > 0:
+                return
+            del self._sessions[document_id]
+            # Joins wait for the session to be closed, so they load everything it has written
+            closing = self._pending[document_id] = asyncio.create_task(self._close())
+        await asyncio.shield(closing)
+
+    async def _close(self) -> None:
+        """ Persist a session nobody is left editing and stop it, for leave """
+        try:
+            if self._flush_task is not None:
+                self._flush_task.cancel()
+            try:
+                # Sockets in other processes may still be waiting on this process' edits
+                await self.broadcaster.flush()
+            except Exception:
+                logger.exception('Failed to broadcast updates to document %s on close', self.document.id)
+            self.broadcaster.close()
+            self.presence.close()
+            try:
+                # Still replicating, so a flush waiting for this copy to catch up can finish
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to flush document %s on close', self.document.id)
+            await self.stop_replicating()
+        finally:
+            async with self._sessions_lock:
+                del self._pending[str(self.document.id)]
+
+    @classmethod
+    def get_live(cls, document_id: str) -> DocumentSession:
+        """ Return the session for a document if it's currently open in this process """
+        return cls._sessions.get(str(document_id))
+
+    @classmethod
+    async def flush_document(cls, document_id: str) -> None:
+        """ Flush a document's pending edits, if it has a live session, so the database is up to date """
+        if (session := cls.get_live(document_id)):
+            await session.flush()
+
+    @staticmethod
+    async def _flush_other_processes(document_id: str) -> None:
+        """ Have any other process with the document open write its pending edits, so loading it doesn't miss them """
+        channel_layer = get_channel_layer()
+        if hasattr(channel_layer, 'group_request'):
+            await channel_layer.group_request(
+                f'document_{document_id}', {'type': 'flush_document'}, DocumentSession.REMOTE_FLUSH_TIMEOUT)
+
+    @classmethod
+    @database_sync_to_async
+    def load(cls, document_id: str) -> DocumentSession:
+        document: Document = Document.objects.get(id=document_id)
+        blocks = [LiveBlock.from_model(block)
+                  for block in document.blocks.all()]
+        operations = list(document.operations.order_by(
+            '-revision').values_list('revision', 'data')[:settings.DOCUMENT_OPERATION_CATCHUP_LIMIT])
+        return cls(document, blocks, operations[::-1])
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self._created or self._updated or self._styled or self._deleted or self._title_changed or self._operations)
+
+    # REVISIONS
+
+    def operations_since(self, revision: int) -> list[dict]:
+        """ Operations applied after `revision`, None if they're no longer held in memory """
+        oldest = self.operations[0][0] if self.operations else self.revision + 1
+        if not oldest - 1 <= revision <= self.revision:
+            return None
+        return [operation for operation_revision, operation in self.operations if operation_revision > revision]
+
+    def sync(self, revision: int) -> dict:
+        """
+        Catch a client at `revision` up to the current revision, sending only the operations
+        it missed, or a full snapshot of the document if too many have happened since
+        """
+        operations = self.operations_since(revision)
+        if operations is None:
+            return self.snapshot()
+        return {'revision': self.revision, 'title': self.document.title, 'operations': operations}
+
+    def snapshot(self) -> dict:
+        """ The whole document at the current revision, for a client too far behind to be sent only what it missed """
+        return {'revision': self.revision, 'title': self.document.title, 'editor': self.to_editor()}
+
+    def to_editor(self) -> dict:
+        """ Draft.js raw content state for the document, as returned by DocumentSerializer """
+        return {
+            'blocks': [block.to_representation() for block in self.blocks],
+            'entityMap': {},
+        }
+
+    def blocks_window(self, limit: int, offset: int = None, after: str = None) -> dict:
+        """
+        Up to `limit` blocks from `offset`, or following the block with key `after`, with what the
+        editor needs to place them in the whole document. Raises ContentBlock.DoesNotExist if
+        there's no block `after`.
+        """
+        start = self.position(self.get_block(after)) + 1 if after is not None else offset or 0
+        blocks = self.blocks[start:start + limit]
+        return {
+            'revision': self.revision,
+            'title': self.document.title,
+            'count': len(self.blocks),
+            'offset': start,
+            'blocks': [block.to_representation() for block in blocks],
+            'next': blocks[-1].key if blocks and start + limit < len(self.blocks) else None,
+        }
+
+    # BLOCK ACCESS
+
+    def get_block(self, key: str) -> LiveBlock:
+        """ Get a block by key, raises ContentBlock.DoesNotExist like a queryset would """
+        try:
+            return self._blocks_by_key[key]
+        except KeyError:
+            raise ContentBlock.DoesNotExist(f'Content block {key} does not exist')
+
+    def get_or_create_block(self, key: str) -> LiveBlock:
+        """ Get a block by key, appending a new empty block to the document if it doesn't exist """
+        if key in self._blocks_by_key:
+            return self._blocks_by_key[key]
+        return self.insert_block(len(self.blocks), key)
+
+    def position(self, block: LiveBlock) -> int:
+        """ Position of a block within the document, found by its rank """
+        return bisect_left(self.blocks, block.rank, key=attrgetter('rank'))
+
+    def get_block_before(self, block: LiveBlock) -> LiveBlock:
+        """ Get the block before `block`, None if it's the first block in the document """
+        position = self.position(block)
+        return self.blocks[position - 1] if position > 0 else None
+
+    def get_block_after(self, block: LiveBlock) -> LiveBlock:
+        """ Get the block after `block`, None if it's the last block in the document """
+        position = self.position(block)
+        return self.blocks[position + 1] if position + 1 < len(self.blocks) else None
+
+    # BLOCK MUTATION
+
+    def insert_block(self, position: int, key: str, text: str = '', styles: StyleRuns = None) -> LiveBlock:
+        """ Create a new block at `position` in the document, only the new block needs writing """
+        before = self.blocks[position - 1].rank if position > 0 else None
+        after = self.blocks[position].rank if position < len(self.blocks) else None
+        rank = rank_between(before, after)
+
+        block = LiveBlock(key, rank, text, styles=styles)
+        self.blocks.insert(position, block)
+        self._blocks_by_key[key] = block
+        if not self._replicating:
+            # Replicated blocks are created by the process the operation came from
+            self._created.add(key)
+
+        if needs_rebalance(rank):
+            self.rebalance()
+        return block
+
+    def insert_block_after(self, block: LiveBlock, key: str, text: str = '', styles: StyleRuns = None) -> LiveBlock:
+        return self.insert_block(self.position(block) + 1, key, text, styles)
+
+    def rebalance(self) -> None:
+        """ Re-rank every block evenly, used when repeated inserts in one spot have made ranks too long """
+        for block, rank in zip(self.blocks, evenly_spaced_ranks(len(self.blocks))):
+            block.rank = rank
+            self.mark_updated(block)
+
+    def delete_block(self, block: LiveBlock) -> None:
+        del self.blocks[self.position(block)]
+        del self._blocks_by_key[block.key]
+        self._updated.discard(block.key)
+        self._styled.discard(block.key)
+        if block.key in self._created:
+            # Never made it to the database, nothing to delete
+            self._created.discard(block.key)
+        elif not self._replicating:
+            self._deleted.add(block.key)
+
+    # Blocks changed by replicated batches are written by the process the batch came from
+
+    def mark_updated(self, block: LiveBlock) -> None:
+        """ Flag that a block's text, type or rank has changed and needs persisting """
+        if block.key not in self._created and not self._replicating:
+            self._updated.add(block.key)
+
+    def mark_styled(self, block: LiveBlock) -> None:
+        """ Flag that a block's inline styles have changed and need persisting """
+        if not self._replicating:
+            self._styled.add(block.key)
+
+    def set_title(self, title: str) -> None:
+        self.document.title = title
+        self._title_changed = True
+
+    # PERSISTENCE
+
+    @property
+    def write_through(self) -> bool:
+        """ With a zero flush interval every applied batch is persisted straight away """
+        return not settings.DOCUMENT_SESSION_FLUSH_INTERVAL
+
+    async def _reserve_revisions(self, count: int) -> int:
+        """ Reserve revisions for a batch of `count` operations, returning the revision before the first one """
+        if hasattr(self.channel_layer, 'sequence'):
+            # Other processes may have the document open, have the broker number the batch
+            return await self.channel_layer.sequence(f'document_{self.document.id}', count, self.revision) - count
+        return self.revision
+
+    def _check(self, serializers: list) -> None:
+        """ Raise ContentBlock.DoesNotExist or BlockExists if any operation in a batch wouldn't find the blocks it needs """
+        check = BatchCheck(self)
+        for serializer in serializers:
+            serializer.check(check)
+
+    async def apply(self, serializers: list, user=None) -> int:
+        """
+        Apply a batch of validated update serializers to the document in order, returning the batch's
+        last revision. Either the whole batch is applied or none of it, raising ContentBlock.DoesNotExist
+        or BlockExists if any operation wouldn't find the blocks it needs.
+        """
+        start = perf_counter()
+        async with self._apply_lock:
+            self._check(serializers)
+            revision: int = await self._reserve_revisions(len(serializers))
+            if revision > self.revision:
+                # Batches other processes were given earlier revisions are applied first, which may change the blocks
+                await self._wait_for(revision)
+                try:
+                    self._check(serializers)
+                except (ContentBlock.DoesNotExist, BlockExists):
+                    # Every other copy waits for the revisions reserved, pass them over
+                    await self._skip_revisions(revision, len(serializers))
+                    raise
+
+            for serializer in serializers:
+                operation_start = perf_counter()
+                serializer.save(instance=self)
+                metrics.OPERATION_SECONDS.observe(perf_counter() - operation_start, serializer.TYPE)
+                metrics.OPERATIONS.inc(serializer.TYPE)
+                operation: dict = serializer.data
+
+                revision += 1
+                self.operations.append((revision, operation))
+                self._operations.append(DocumentOperation(
+                    document_id=self.document.pk, revision=revision, user=user, data=operation))
+            self._advance(revision)
+            self._apply_held()
+
+            if self.write_through:
+                # Written before the next batch is applied, so batches reach the broadcaster in revision order
+                await self.flush()
+        metrics.BATCH_SECONDS.observe(perf_counter() - start)
+        return revision
+
+    def _advance(self, revision: int) -> None:
+        self.revision = revision
+        # Any snapshot of the document is now a revision behind
+        snapshot_cache.invalidate(self.document.id)
+        self._advanced.set()
+
+    def has_applied(self, revision: int) -> bool:
+        """ Determine wether the batch ending at `revision` is already reflected in this copy of the document """
+        return revision <= self.revision
+
+    # REPLICATION
+
+    @staticmethod
+    async def subscribe(document_id: str) -> str:
+        """ Add a channel for a new session to its document's group, if other processes may have it open, returning its name """
+        channel_layer = get_channel_layer()
+        if not hasattr(channel_layer, 'sequence'):
+            return None
+        channel_name: str = await channel_layer.new_channel()
+        await channel_layer.group_add(f'document_{document_id}', channel_name)
+        return channel_name
+
+    def start_replicating(self, channel_name: str) -> None:
+        """ Replicate the batches other processes apply as they're broadcast to `channel_name`, from subscribe """
+        if channel_name is not None:
+            self.channel_name = channel_name
+            self._replication_task = asyncio.create_task(self._receive_replicated())
+
+    async def stop_replicating(self) -> None:
+        for task in (self._replication_task, self._gap_task):
+            if task is not None:
+                task.cancel()
+        self._replication_task = self._gap_task = None
+        if self.channel_name is not None:
+            await self.channel_layer.group_discard(f'document_{self.document.id}', self.channel_name)
+            self.channel_name = None
+
+    async def _receive_replicated(self) -> None:
+        while True:
+            event: dict = await self.channel_layer.receive(self.channel_name)
+            if self.channel_layer.is_local_channel(event.get('sender_channel_name', '')):
+                # Applied by this process, or not an edit at all
+                continue
+            try:
+                if event['type'] == 'update_document_content':
+                    self._replicate_event(event)
+                elif event['type'] == 'skip_revisions':
+                    self.replicate([], event['revision'], event['count'])
+            except Exception:
+                logger.exception('Failed to replicate %s to document %s', event['type'], self.document.id)
+
+    def _replicate_event(self, event: dict) -> None:
+        """ Replicate the batches of an update_document_content event, built by BroadcastAggregator """
+        from api.operations import OPERATIONS
+        if all(self.has_applied(revision) for revision, count in event['batches']):
+            return
+
+        updates: list[dict] = codecs.loads(event['text'])['body']['data']
+        start = 0
+        for revision, count in event['batches']:
+            batch, start = updates[start:start + count], start + count
+            operations = [OPERATIONS[update['type']](update) for update in batch]
+            if not all(operation.is_valid() for operation in operations):
+                logger.error('Invalid update replicated to document %s at revision %s',
+                             self.document.id, revision)
+                # Its revisions are still passed over, so later batches aren't held back
+                operations = []
+            self.replicate(operations, revision, count)
+
+    def replicate(self, serializers: list, revision: int, count: int = None) -> None:
+        """
+        Apply a batch of validated update serializers which another process has already applied
+        and logged, ending at `revision`, once every earlier revision has been. The operations
+        aren't logged again here. With no serializers the batch's `count` revisions are passed over.
+        """
+        before = revision - (len(serializers) if count is None else count)
+        if self.has_applied(revision) or before in self._held:
+            return
+        self._held[before] = (revision, serializers)
+        self._apply_held()
+        if self._held and self._gap_task is None:
+            self._gap_task = asyncio.create_task(self._skip_gaps_later())
+
+    def _apply_held(self) -> None:
+        """ Replicate held batches for as long as one follows on from the current revision """
+        while (batch := self._held.pop(self.revision, None)) is not None:
+            revision, serializers = batch
+            try:
+                self._check(serializers)
+            except (ContentBlock.DoesNotExist, BlockExists):
+                # Copies only differ once revisions have been skipped, this one can't be applied here
+                logger.exception('Failed to replicate update to document %s at revision %s',
+                                 self.document.id, revision)
+                serializers = []
+
+            self._replicating = True
+            try:
+                for i, serializer in enumerate(serializers, self.revision + 1):
+                    serializer.save(instance=self)
+                    self.operations.append((i, serializer.data))
+            finally:
+                self._replicating = False
+            self._advance(revision)
+
+        for before in [before for before in self._held if before < self.revision]:
+            # Overtaken by revisions which were skipped
+            logger.error('Dropped update replicated to document %s at revision %s',
+                         self.document.id, self._held.pop(before)[0])
+
+    async def _wait_for(self, revision: int) -> None:
+        """ Wait for every revision up to `revision` to be applied, skipping any still missing after REPLICATION_TIMEOUT """
+        self._waiting.add(revision)
+        try:
+            async with asyncio.timeout(self.REPLICATION_TIMEOUT):
+                while self.revision < revision:
+                    self._advanced.clear()
+                    await self._advanced.wait()
+        except TimeoutError:
+            while self.revision < revision:
+                self._skip_gap(revision)
+        finally:
+            self._waiting.discard(revision)
+
+    async def _skip_gaps_later(self) -> None:
+        """ Skip missing revisions which held batches are waiting on, if none arrive for REPLICATION_TIMEOUT """
+        try:
+            while self._held:
+                revision = self.revision
+                await asyncio.sleep(self.REPLICATION_TIMEOUT)
+                if self._held and self.revision == revision:
+                    self._skip_gap(min(self._held))
+        finally:
+            self._gap_task = None
+
+    def _skip_gap(self, revision: int) -> None:
+        """ Give up on the revisions missing before `revision`, or an earlier batch which is ready to apply """
+        target = min([revision, *self._held, *self._waiting])
+        if target > self.revision:
+            logger.warning('Skipped missing revisions %s to %s of document %s',
+                           self.revision + 1, target, self.document.id)
+            self._advance(target)
+        self._apply_held()
+
+    async def _skip_revisions(self, revision: int, count: int) -> None:
+        """ Pass over revisions reserved for a batch which couldn't be applied, here and in every other process """
+        self._advance(revision + count)
+        self._apply_held()
+        await self.channel_layer.group_send(f'document_{self.document.id}', {
+            'type': 'skip_revisions',
+            'sender_channel_name': self.channel_name,
+            'revision': revision + count,
+            'count': count,
+        })
+
+    async def flush(self) -> None:
+        """
+        Write all pending changes back to the database in a single transaction, or savepoint of a group
+        commit. If another process has written a later revision, the blocks here may be missing its edits,
+        so the write waits for them to be replicated, or REPLICATION_TIMEOUT.
+        """
+        async with self._flush_lock:
+            while self.has_changes:
+                try:
+                    return await self._flush_changes()
+                except StaleRevision as stale:
+                    await self._wait_for(stale.revision)
+
+    async def _flush_changes(self) -> None:
+        """ Write a snapshot of the pending changes, putting them back if that fails """
+        # Swap pending changes out so edits made whilst writing are picked up by the next flush
+        created, updated, styled, deleted = self._created, self._updated, self._styled, self._deleted
+        title_changed, operations = self._title_changed, self._operations
+        self._created, self._updated, self._styled, self._deleted = set(), set(), set(), set()
+        self._title_changed, self._operations = False, []
+
+        # Snapshot the rows to write so the worker thread never reads blocks which are still being edited
+        created_blocks = [self._blocks_by_key[key] for key in created]
+        created_rows = [ContentBlock(document_id=self.document.pk, key=block.key, text=str(block.text), type=block.type, rank=block.rank)
+                        for block in created_blocks]
+        updated_rows = [ContentBlock(pk=block.pk, key=block.key, text=str(block.text), type=block.type, rank=block.rank)
+                        for block in map(self._blocks_by_key.get, updated)]
+        styled_rows = [(block, block.styles.ranges())
+                       for block in map(self._blocks_by_key.get, styled)]
+        title = self.document.title if title_changed else None
+
+        try:
+            pks = await self._write(created_rows, updated_rows, styled_rows, deleted, title, operations, self.revision)
+        except Exception:
+            # Transaction was rolled back, put the changes back so they're retried
+            self._created |= {key for key in created if key in self._blocks_by_key}
+            self._updated |= updated - self._deleted
+            self._styled |= styled - self._deleted
+            self._deleted |= deleted
+            self._title_changed |= title_changed
+            self._operations[:0] = operations
+            raise
+
+        for key, pk in pks.items():
+            if (block := self._blocks_by_key.get(key)):
+                block.pk = pk
+
+    async def _write(self, *rows) -> dict[str, int]:
+        """ Persist a flush snapshot on the document's writer thread, committed along with whatever else is waiting to be written """
+        return await database_writers.run(self.document.pk, self._write_rows, *rows)
+
+    def _write_rows(self, created_rows, updated_rows, styled_rows, deleted, title, operations, revision) -> dict[str, int]:
+        """
+        Persist a flush snapshot, returning the primary keys of blocks which didn't know theirs.
+        Raises StaleRevision if another process has already written a later revision than `revision`.
+        """
+        with transaction.atomic():
+            # Queryset updates skip auto_now, so the document is marked as modified here. Updated first,
+            # guarded by revision, so a copy lagging behind never overwrites another process' newer rows
+            document_fields = {'updated_at': timezone.now(), 'revision': revision}
+            if title is not None:
+                document_fields['title'] = title
+            if not Document.objects.filter(pk=self.document.pk, revision__lte=revision).update(**document_fields):
+                raise StaleRevision(Document.objects.values_list('revision', flat=True).get(pk=self.document.pk))
+
+            if deleted:
+                self.document.blocks.filter(key__in=deleted).delete()
+
+            # Styles are packed here as any new style names need numbering in the database
+            packed_styles = {block.key: style_dictionary.pack(styles) for block, styles in styled_rows}
+            created_pks = {}
+            if created_rows:
+                for row in created_rows:
+                    row.inline_styles = packed_styles.pop(row.key, b'')
+                rows = ContentBlock.objects.bulk_create(created_rows)
+                created_pks = {row.key: row.pk for row in rows}
+                if None in created_pks.values():
+                    # Database backend can't return ids from a bulk insert
+                    created_pks = dict(self.document.blocks.filter(
+                        key__in=created_pks).values_list('key', 'pk'))
+            styled_rows = [(block, styles) for block, styles in styled_rows if block.key in packed_styles]
+
+            # Blocks replicated from another process only have a primary key once that process has written them
+            unresolved = {row.key for row in updated_rows if row.pk is None} | {
+                block.key for block, styles in styled_rows if block.pk is None and block.key not in created_pks}
+            if unresolved:
+                created_pks.update(self.document.blocks.filter(
+                    key__in=unresolved).values_list('key', 'pk'))
+                for row in updated_rows:
+                    row.pk = row.pk or created_pks.get(row.key)
+                # Anything still unwritten will be by the process which created it
+                updated_rows = [row for row in updated_rows if row.pk is not None]
+                styled_rows = [(block, styles) for block, styles in styled_rows
+                               if block.pk is not None or block.key in created_pks]
+
+            if updated_rows:
+                ContentBlock.objects.bulk_update(
+                    updated_rows, ['text', 'type', 'rank'])
+
+            if styled_rows:
+                ContentBlock.objects.bulk_update([
+                    ContentBlock(pk=block.pk or created_pks[block.key], inline_styles=packed_styles[block.key])
+                    for block, styles in styled_rows
+                ], ['inline_styles'])
+
+            if operations:
+                DocumentOperation.objects.bulk_create(operations)
+
+        return created_pks
+
+    async def _flush_periodically(self) -> None:
+        interval: float = settings.DOCUMENT_SESSION_FLUSH_INTERVAL.total_seconds()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                # Keep the changes in memory and try again on the next tick
+                logger.exception('Failed to flush document %s', self.document.id)
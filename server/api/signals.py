@@ -0,0 +1,35 @@
+import logging
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, post_migrate
+from django.dispatch import receiver
+from api.autocomplete import username_prefix_cache
+from api.models import DocumentCollaborator
+from api.permissions import permission_cache
+from api.search import repair_search_index
+from authentication.models import User
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=DocumentCollaborator)
+@receiver(post_delete, sender=DocumentCollaborator)
+def invalidate_collaborator_permission(sender, instance: DocumentCollaborator, **kwargs) -> None:
+    """ Drop the cached permission of a collaborator which has been added, changed or removed """
+    document_id, user_id = instance.document_id, instance.user_id
+    permission_cache.invalidate(document_id, user_id)
+    # Until the change commits other connections still read the old permission, which may have been cached again since
+    transaction.on_commit(lambda: permission_cache.invalidate(document_id, user_id))
+
+
+@receiver(post_save, sender=User)
+def invalidate_username_prefixes(sender, instance: User, created: bool, **kwargs) -> None:
+    """ List a newly registered user in autocomplete results without waiting for cached prefixes to expire """
+    if created:
+        username_prefix_cache.invalidate(instance.username)
+
+
+@receiver(post_migrate)
+def repair_search_triggers(sender, using: str, **kwargs) -> None:
+    """ Recreate search index triggers dropped by a migration rebuilding the table they're on """
+    if sender.name == 'api' and (repaired := repair_search_index(using)):
+        logger.warning('Recreated missing search index triggers %s', ', '.join(repaired))
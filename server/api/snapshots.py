@@ -0,0 +1,54 @@
+from __future__ import annotations
+import threading
+from collections import OrderedDict
+from django.conf import settings
+
+
+class DocumentSnapshotCache:
+    """
+    Least recently used cache of each document's Draft.js `editor` content, already encoded as
+    JSON, so reopening a document which hasn't changed doesn't load and serialize every block again.
+    Snapshots are stored with the revision they were taken at and only returned for that revision,
+    every edit moves a document on a revision so a stale snapshot is never served. Live sessions
+    also invalidate a document's snapshot as they apply edits, to free it straight away.
+    Snapshots are evicted once their combined length passes `max_size` characters.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        # Document id to (revision, encoded editor content), least recently used first
+        self._snapshots: OrderedDict[str, tuple[int, str]] = OrderedDict()
+        # Views read and fill the cache from worker threads, sessions invalidate it from the event loop
+        self._lock = threading.Lock()
+
+    def get(self, document_id, revision: int) -> str:
+        """ Encoded editor content of a document at `revision`, None if it isn't cached """
+        with self._lock:
+            snapshot = self._snapshots.get(str(document_id))
+            if snapshot is None or snapshot[0] != revision:
+                return None
+            self._snapshots.move_to_end(str(document_id))
+            return snapshot[1]
+
+    def put(self, document_id, revision: int, content: str) -> None:
+        if len(content) > self.max_size:
+            return
+        with self._lock:
+            self._discard(str(document_id))
+            self._snapshots[str(document_id)] = (revision, content)
+            self.size += len(content)
+            while self.size > self.max_size:
+                revision, evicted = self._snapshots.popitem(last=False)[1]
+                self.size -= len(evicted)
+
+    def invalidate(self, document_id) -> None:
+        with self._lock:
+            self._discard(str(document_id))
+
+    def _discard(self, document_id: str) -> None:
+        if (snapshot := self._snapshots.pop(document_id, None)) is not None:
+            self.size -= len(snapshot[1])
+
+
+snapshot_cache = DocumentSnapshotCache(settings.DOCUMENT_SNAPSHOT_CACHE_SIZE)
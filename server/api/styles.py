@@ -0,0 +1,216 @@
+from __future__ import annotations
+import struct
+from typing import Iterable, Iterator
+from django.db import transaction
+from api.models import Style
+
+NO_STYLES: frozenset = frozenset()
+# ContentBlock.inline_styles holds an (offset, length, Style id) triple of little endian uint32s per range
+PACKED_RANGE = struct.Struct('<3I')
+
+
+class StyleRuns:
+    """
+    Inline styles of a block held in a live DocumentSession, kept alongside its Rope and edited
+    along with it so style ranges follow the text they cover.
+    The block's text is split into runs of characters sharing the same set of styles, stored by
+    length rather than offset, so an edit never has to shift the ranges after it. Run lengths are
+    also summed in a Fenwick tree, finding the run at a position and resizing it for an insert or
+    delete are O(log n) in the number of runs. Splitting, merging and restyling rebuild the runs,
+    which is O(n) but only happens on block splits, merges and style changes rather than keystrokes.
+    Text inserted takes the styles of the character before it, as Draft.js does, or of the first
+    character when inserted at the start. Overlapping and adjacent ranges of the same style are
+    merged whenever ranges are read back out.
+    """
+    __slots__ = ('_lengths', '_styles', '_tree', '_length')
+
+    def __init__(self, length: int = 0, ranges: Iterable[tuple[int, int, str]] = ()) -> None:
+        """ Runs for `length` characters of text, styled by (offset, length, style) ranges """
+        # Positions where any range starts or ends split the text into runs
+        ranges = [(max(offset, 0), min(offset + range_length, length), style)
+                  for offset, range_length, style in ranges if range_length > 0 and offset < length]
+        boundaries = sorted({0, length, *(start for start, end, style in ranges), *(end for start, end, style in ranges)})
+        lengths = [end - start for start, end in zip(boundaries, boundaries[1:])]
+        styles = [set() for _ in lengths]
+        indexes = {boundary: i for i, boundary in enumerate(boundaries)}
+        for start, end, style in ranges:
+            for i in range(indexes[start], indexes[end]):
+                styles[i].add(style)
+        self._build(lengths, [frozenset(run_styles) for run_styles in styles])
+
+    def _build(self, lengths: list[int], styles: list[frozenset]) -> None:
+        """ Set the runs, merging neighbours with the same styles and dropping empty runs """
+        self._lengths: list[int] = []
+        self._styles: list[frozenset] = []
+        for length, run_styles in zip(lengths, styles):
+            if not length:
+                continue
+            if self._styles and self._styles[-1] == run_styles:
+                self._lengths[-1] += length
+            else:
+                self._lengths.append(length)
+                self._styles.append(run_styles)
+        self._length = sum(self._lengths)
+
+        tree = [0, *self._lengths]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __bool__(self) -> bool:
+        """ Whether any of the text is styled """
+        return any(self._styles)
+
+    def __iter__(self) -> Iterator[tuple[int, int, str]]:
+        return iter(self.ranges())
+
+    def __repr__(self) -> str:
+        return f'<StyleRuns {self.ranges()}>'
+
+    def _add(self, index: int, delta: int) -> None:
+        self._lengths[index] += delta
+        self._length += delta
+        index += 1
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index += index & -index
+
+    def _find(self, position: int) -> tuple[int, int]:
+        """ Index of the run containing the character at `position`, and the position within it """
+        index, step = 0, 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            if index + step < len(self._tree) and self._tree[index + step] <= position:
+                index += step
+                position -= self._tree[index]
+            step >>= 1
+        return index, position
+
+    def _clamp(self, position: int) -> int:
+        return min(max(position, 0), self._length)
+
+    def ranges(self) -> list[tuple[int, int, str]]:
+        """ Normalised (offset, length, style) ranges, in order of offset then style """
+        ranges, open_ranges = [], {}
+        offset = 0
+        for length, styles in zip(self._lengths, self._styles):
+            if not length:
+                continue
+            for style in list(open_ranges):
+                if style not in styles:
+                    start = open_ranges.pop(style)
+                    ranges.append((start, offset - start, style))
+            for style in styles:
+                open_ranges.setdefault(style, offset)
+            offset += length
+        ranges.extend((start, offset - start, style) for style, start in open_ranges.items())
+        return sorted(ranges)
+
+    def insert(self, position: int, length: int) -> None:
+        """ Make room for `length` characters inserted at `position` """
+        if length <= 0:
+            return
+        if not self._length:
+            self._build([length], [NO_STYLES])
+            return
+        index, offset = self._find(max(self._clamp(position) - 1, 0))
+        self._add(index, length)
+
+    def delete(self, start: int, end: int = None) -> None:
+        """ Remove the characters between `start` and `end`, to the end if `end` is None """
+        start = self._clamp(start)
+        end = self._length if end is None else self._clamp(end)
+        remaining = end - start
+        if remaining <= 0:
+            return
+        index, offset = self._find(start)
+        while remaining:
+            # Emptied runs are left in place until the runs are next rebuilt
+            removed = min(self._lengths[index] - offset, remaining)
+            self._add(index, -removed)
+            remaining -= removed
+            index, offset = index + 1, 0
+
+    def split(self, position: int) -> StyleRuns:
+        """ Cut the styles off at `position`, returning the styles of the text after it """
+        index, offset = self._find(self._clamp(position))
+        lengths, styles = self._lengths, self._styles
+        if index < len(lengths):
+            lengths = [*lengths[:index], offset, lengths[index] - offset, *lengths[index + 1:]]
+            styles = [*styles[:index], styles[index], *styles[index:]]
+            index += 1
+
+        tail = StyleRuns()
+        tail._build(lengths[index:], styles[index:])
+        self._build(lengths[:index], styles[:index])
+        return tail
+
+    def slice(self, start: int) -> StyleRuns:
+        """ Styles of the text from `start` onwards, leaving these styles as they are """
+        copy = StyleRuns()
+        copy._build(self._lengths, self._styles)
+        return copy.split(start)
+
+    def extend(self, other: StyleRuns) -> None:
+        """ Append the styles of text appended to this block """
+        self._build(self._lengths + other._lengths, self._styles + other._styles)
+
+    def add_style(self, position: int, length: int, style: str) -> None:
+        """ Apply a style to `length` characters from `position` """
+        start, end = self._clamp(position), self._clamp(position + length)
+        if end <= start:
+            return
+        tail = self.split(start)
+        rest = tail.split(end - start)
+        self._build(self._lengths + tail._lengths + rest._lengths,
+                    self._styles + [styles | {style} for styles in tail._styles] + rest._styles)
+
+
+class StyleDictionary:
+    """
+    In process copy of the Style table, which numbers every inline style name so blocks can store
+    their ranges packed into ContentBlock.inline_styles with a small id in place of each name.
+    Styles are never renamed or deleted, so once known a name and id are cached for good, and the
+    table is only read again when a block has a name or id which hasn't been seen yet. New names
+    are only matched to their ids once committed, so a rolled back id is never packed into a block.
+    """
+
+    def __init__(self) -> None:
+        self._ids: dict[str, int] = {}
+        self._names: dict[int, str] = {}
+
+    def _load(self) -> dict[int, str]:
+        styles = dict(Style.objects.values_list('id', 'name'))
+        self._names.update(styles)
+        transaction.on_commit(lambda: self._ids.update({name: id for id, name in styles.items()}))
+        return styles
+
+    def ids(self, names: Iterable[str]) -> dict[str, int]:
+        """ Style ids by name, including at least `names`, creating any which don't exist yet """
+        missing = set(names).difference(self._ids)
+        if not missing:
+            return self._ids
+        Style.objects.bulk_create([Style(name=name) for name in missing], ignore_conflicts=True)
+        return {**self._ids, **{name: id for id, name in self._load().items()}}
+
+    def pack(self, ranges: Iterable[tuple[int, int, str]]) -> bytes:
+        """ Pack (offset, length, style) ranges for ContentBlock.inline_styles """
+        ranges = list(ranges)
+        ids = self.ids(style for offset, length, style in ranges)
+        return b''.join(PACKED_RANGE.pack(offset, length, ids[style]) for offset, length, style in ranges)
+
+    def unpack(self, data: bytes) -> list[tuple[int, int, str]]:
+        """ (offset, length, style) ranges packed into ContentBlock.inline_styles """
+        if not data:
+            return []
+        ranges = list(PACKED_RANGE.iter_unpack(data))
+        if any(id not in self._names for offset, length, id in ranges):
+            self._load()
+        return [(offset, length, self._names[id]) for offset, length, id in ranges if id in self._names]
+
+
+style_dictionary = StyleDictionary()
@@ -0,0 +1,1471 @@
+import asyncio
+import json
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+from uuid import uuid4
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.db import connection, transaction
+from django.db.models.functions import Lower
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+from api import codecs, metrics
+from api.autocomplete import username_prefix_cache, users_with_prefix
+from api.auth import AccessTokenCache
+from api.broadcast import BroadcastAggregator
+from api.flowcontrol import UPDATE, PRESENCE, SendQueue, TokenBucket
+from api.layers import BrokerChannelLayer, ChannelBroker
+from collaborative_text_editor.asgi import application
+from api.models import Document, DocumentCollaborator, DocumentOperation, ContentBlock, Style
+from api.management.commands.benchmark_validators import DRF_SERIALIZERS, WebSocketMessageSerializer
+from api.operations import (InsertOperation, DeleteOperation, SplitBlockOperation, SetBlockTypeOperation, SetInlineStyleOperation,
+                            WebSocketMessage, operation_for)
+from api.permissions import CollaboratorPermissionCache, NOT_CACHED
+from api.search import repair_search_index
+from api.session import BlockExists, DocumentSession
+from api.snapshots import DocumentSnapshotCache, snapshot_cache
+from api.styles import StyleRuns, style_dictionary
+from api.text import Rope
+from api.utils import rank_between, evenly_spaced_ranks, needs_rebalance
+from api.writer import DatabaseWriter
+from authentication.models import User
+
+
+class RankTests(SimpleTestCase):
+    def test_rank_between(self):
+        """ Ensure generated ranks always sort strictly between their neighbours """
+        self.assertEqual(rank_between(), 'n')
+        self.assertEqual(rank_between('n', 'o'), 'nn')
+        self.assertEqual(rank_between(None, 'b'), 'an')
+        self.assertEqual(rank_between('nz', 'o'), 'nzn')
+
+        ranks = ['n']
+        for _ in range(500):
+            # Repeatedly splitting directly after the first block is the worst case
+            ranks.insert(1, rank_between(ranks[0], ranks[1] if len(ranks) > 1 else None))
+            ranks.insert(0, rank_between(None, ranks[0]))
+        self.assertEqual(ranks, sorted(set(ranks)))
+        self.assertTrue(all(not rank.endswith('a') for rank in ranks))
+
+        with self.assertRaises(ValueError):
+            rank_between('n', 'n')
+
+    def test_evenly_spaced_ranks(self):
+        """ Ensure rebalanced ranks are ordered, unique and short """
+        for count in (0, 1, 25, 26, 5000):
+            ranks = evenly_spaced_ranks(count)
+            self.assertEqual(ranks, sorted(set(ranks)))
+            self.assertEqual(len(ranks), count)
+            self.assertFalse(any(needs_rebalance(rank) for rank in ranks))
+
+
+class OperationValidationTests(SimpleTestCase):
+    def test_errors_match_drf(self):
+        """ Ensure operations are validated exactly as the DRF serializers they replaced validated them """
+        updates = [
+            {'type': 'insert', 'block': 'abcde', 'position': 3, 'text': ' '},
+            {'type': 'insert', 'block': ' ab ', 'position': '4.00', 'text': ''},
+            {'type': 'insert', 'block': 'abcdef\x00', 'position': 1.5, 'text': '\ud800'},
+            {'type': 'insert', 'block': '   ', 'position': True, 'text': None},
+            {'type': 'insert', 'block': 12, 'position': '9' * 1001, 'text': ['x']},
+            {'type': 'insert', 'block': False, 'position': None},
+            {'type': 'delete', 'block': 'abc', 'position': -1, 'offset': -1},
+            {'type': 'delete', 'block': {}, 'position': -2, 'offset': '3'},
+            {'type': 'split-block', 'block': 'abc', 'position': 0, 'newBlock': ''},
+            {'type': 'set-block-type', 'block': 'abc', 'newBlockType': ' header-one '},
+            {'type': 'set-block-type', 'block': 'abc', 'position': 'x', 'newBlockType': 4.5},
+            {'type': 'set-inline-style', 'block': 'abc', 'position': 0, 'offset': 5, 'style': ''},
+        ]
+        for update in updates:
+            operation = operation_for(update)
+            serializer = DRF_SERIALIZERS[update['type']](data=update)
+            with self.subTest(update=update):
+                self.assertEqual(operation.is_valid(), serializer.is_valid())
+                self.assertEqual(json.dumps(operation.errors), json.dumps(serializer.errors))
+                for field, value in getattr(serializer, 'validated_data', {}).items():
+                    self.assertEqual(getattr(operation, field), value)
+
+        # Updates without a known type are rejected, rather than validated as the fields every operation has
+        for update in ({'block': 'abc', 'position': 2}, {'type': 'bogus', 'block': 'abc', 'position': 2}, {}):
+            with self.subTest(update=update):
+                operation = operation_for(update)
+                self.assertFalse(operation.is_valid())
+                self.assertEqual(operation.errors, {'type': ['Unknown operation type']})
+        self.assertFalse(operation_for([]).is_valid())
+
+        for message in ({'type': 'x', 'access_token': 'y', 'body': []}, [], None, 'message'):
+            with self.subTest(message=message):
+                validated, serializer = WebSocketMessage(message), WebSocketMessageSerializer(data=message)
+                self.assertFalse(validated.is_valid() or serializer.is_valid())
+                self.assertEqual(json.dumps(validated.errors), json.dumps(serializer.errors))
+
+
+class RopeTests(SimpleTestCase):
+    @mock.patch.object(Rope, 'FLAT_SIZE', 1000)
+    def test_matches_str_slicing(self):
+        """ Ensure rope edits across chunk boundaries, and back to flat text, give the same text as slicing a str """
+        text = ''.join(chr(ord('a') + i % 26) for i in range(3000))
+        rope = Rope(text)
+        edits = [('insert', 0, 'start'), ('insert', 1500, 'x' * 1200), ('delete', 400, 2600),
+                 ('insert', len(text) + 100, 'end'), ('delete', 10, 11), ('delete', 0, 5000)]
+
+        for type, position, value in edits:
+            if type == 'insert':
+                rope.insert(position, value)
+                text = text[:position] + value + text[position:]
+            else:
+                rope.delete(position, value)
+                text = text[:position] + text[value:]
+            self.assertEqual(len(rope), len(text))
+            self.assertEqual(rope.slice(5, 1700), text[5:1700])
+            self.assertEqual(str(rope), text)
+
+    @mock.patch.object(Rope, 'FLAT_SIZE', 1000)
+    def test_flat_until_long(self):
+        """ Ensure short text is kept flat, only being chunked once it's longer than FLAT_SIZE and flattened again at half of it """
+        rope = Rope('x' * 1000)
+        self.assertEqual(repr(rope), '<Rope 1000 characters, flat>')
+        rope.insert(-5, 'ab')
+        rope.delete(1, None)
+        rope.insert(5, 'c' * 1000)
+        self.assertEqual(str(rope), 'ac' + 'c' * 999)
+        self.assertEqual(repr(rope), '<Rope 1001 characters, 2 chunks>')
+        rope.delete(500, 1000)
+        self.assertEqual(repr(rope), '<Rope 501 characters, 1 chunks>')
+        rope.delete(0, 1)
+        self.assertEqual(repr(rope), '<Rope 500 characters, flat>')
+        self.assertEqual(rope.slice(498, 600), 'cc')
+
+
+class StyleRunsTests(SimpleTestCase):
+    @staticmethod
+    def ranges(characters: list[set]) -> list[tuple[int, int, str]]:
+        """ Normalised ranges of a list of each character's styles """
+        return StyleRuns(len(characters), [(offset, 1, style)
+                                           for offset, styles in enumerate(characters) for style in styles]).ranges()
+
+    def test_matches_per_character_styles(self):
+        """ Ensure styles follow their text through edits, the same as styling every character on its own """
+        characters = [set() for _ in range(40)]
+        runs = StyleRuns(40)
+        edits = [('style', 5, 10, 'BOLD'), ('style', 10, 10, 'ITALIC'), ('insert', 12, 3), ('insert', 0, 2),
+                 ('delete', 3, 9), ('style', 0, 100, 'UNDERLINE'), ('delete', 14, 20), ('insert', 14, 4),
+                 ('insert', 100, 1), ('delete', 0, 100), ('insert', 0, 5)]
+
+        for type, position, value, *style in edits:
+            if type == 'style':
+                runs.add_style(position, value, style[0])
+                for styles in characters[position:position + value]:
+                    styles.add(style[0])
+            elif type == 'insert':
+                runs.insert(position, value)
+                position = min(position, len(characters))
+                inherited = characters[max(position - 1, 0)] if characters else set()
+                characters[position:position] = [set(inherited) for _ in range(value)]
+            else:
+                runs.delete(position, value)
+                del characters[position:value]
+            self.assertEqual(len(runs), len(characters))
+            self.assertEqual(runs.ranges(), self.ranges(characters))
+
+    def test_split_and_extend(self):
+        """ Ensure a block's styles split with its text, and are merged back into one range when it's rejoined """
+        runs = StyleRuns(10, [(2, 3, 'BOLD'), (4, 4, 'BOLD'), (0, 10, 'ITALIC')])
+        self.assertEqual(runs.ranges(), [(0, 10, 'ITALIC'), (2, 6, 'BOLD')])
+
+        tail = runs.split(5)
+        self.assertEqual(runs.ranges(), [(0, 5, 'ITALIC'), (2, 3, 'BOLD')])
+        self.assertEqual(tail.ranges(), [(0, 3, 'BOLD'), (0, 5, 'ITALIC')])
+        self.assertEqual(tail.slice(3).ranges(), [(0, 2, 'ITALIC')])
+        self.assertEqual(len(tail), 5)
+
+        runs.extend(tail)
+        self.assertEqual(runs.ranges(), [(0, 10, 'ITALIC'), (2, 6, 'BOLD')])
+        self.assertFalse(StyleRuns(5))
+
+
+class DocumentSnapshotCacheTests(SimpleTestCase):
+    def test_eviction(self):
+        """ Ensure snapshots are only served at their revision, and least recently used ones are evicted past the size limit """
+        cache = DocumentSnapshotCache(max_size=10)
+        cache.put('a', 1, 'aaaa')
+        cache.put('b', 1, 'bbbb')
+        self.assertIsNone(cache.get('a', 2))
+        self.assertEqual(cache.get('a', 1), 'aaaa')
+
+        cache.put('c', 1, 'cccc')
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual((cache.get('a', 1), cache.get('c', 1)), ('aaaa', 'cccc'))
+        self.assertEqual(cache.size, 8)
+
+        cache.put('d', 1, 'd' * 11)
+        self.assertIsNone(cache.get('d', 1))
+        cache.invalidate('a')
+        self.assertEqual(cache.size, 4)
+
+
+class DocumentSessionTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ach_henderson')
+        self.document = Document.objects.create(title='Session')
+        DocumentCollaborator.objects.create(
+            document=self.document, user=self.user, permission=0)
+        ContentBlock.objects.create(
+            document=self.document, key='aaaaa', text='Hello', rank='g')
+        ContentBlock.objects.create(
+            document=self.document, key='bbbbb', text='world', rank='n')
+
+    def apply(self, session: DocumentSession, operation_class, **data):
+        operation = operation_class(data)
+        self.assertTrue(operation.is_valid(), operation.errors)
+        operation.save(instance=session)
+
+    async def test_edits_held_in_memory_until_flush(self):
+        """
+        Ensure edits are applied to the shared session without touching the
+        database, then persisted in one go when flushed
+        """
+        session = await DocumentSession.join(str(self.document.id))
+        self.assertIs(session, await DocumentSession.join(str(self.document.id)))
+
+        self.apply(session, InsertOperation,
+                   block='aaaaa', position=5, text=' there')
+        self.apply(session, SplitBlockOperation,
+                   block='aaaaa', position=5, newBlock='ccccc')
+        self.apply(session, DeleteOperation,
+                   block='bbbbb', position=0, offset=1)
+
+        self.assertEqual(
+            [(block.key, block.text) for block in session.blocks],
+            [('aaaaa', 'Hello'), ('ccccc', ' there'), ('bbbbb', 'orld')])
+        self.assertEqual(await ContentBlock.objects.filter(key='aaaaa').values_list('text', flat=True).aget(), 'Hello')
+
+        await session.flush()
+        blocks = [(block.key, block.text) async for block in ContentBlock.objects.filter(document=self.document)]
+        self.assertEqual(
+            blocks, [('aaaaa', 'Hello'), ('ccccc', ' there'), ('bbbbb', 'orld')])
+
+        # Session is only closed, and flushed, once every socket has left
+        self.apply(session, DeleteOperation,
+                   block='ccccc', position=-1, offset=1)
+        await session.leave()
+        self.assertIsNotNone(DocumentSession.get_live(self.document.id))
+        await session.leave()
+        self.assertIsNone(DocumentSession.get_live(self.document.id))
+        blocks = [(block.key, block.text) async for block in ContentBlock.objects.filter(document=self.document)]
+        self.assertEqual(blocks, [('aaaaa', 'Hello there'), ('bbbbb', 'orld')])
+
+    # Writes are made on this thread, so their queries are counted
+    @override_settings(DOCUMENT_SESSION_FLUSH_INTERVAL=timedelta(0), DATABASE_WRITER_SHARDS=0)
+    def test_batch_written_through_in_one_transaction(self):
+        """
+        Ensure a batch touching the same blocks many times writes each block once,
+        in a single transaction, when the session is in write through mode
+        """
+        session = async_to_sync(DocumentSession.join)(str(self.document.id))
+        updates = [InsertOperation({'block': 'aaaaa', 'position': 5 + i, 'text': '!'})
+                   for i in range(20)]
+        updates += [DeleteOperation({'block': 'bbbbb', 'position': 0, 'offset': 1})
+                    for i in range(3)]
+        updates.append(SplitBlockOperation(
+            data={'block': 'bbbbb', 'position': 1, 'newBlock': 'ccccc'}))
+        for serializer in updates:
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+
+        # Begin, bulk insert, bulk update, log operations, update revision, commit
+        with self.assertNumQueries(6):
+            async_to_sync(session.apply)(updates)
+        async_to_sync(session.leave)()
+
+        blocks = [(block.key, block.text) for block in ContentBlock.objects.filter(document=self.document)]
+        self.assertEqual(
+            blocks, [('aaaaa', 'Hello' + '!' * 20), ('bbbbb', 'l'), ('ccccc', 'd')])
+
+    @override_settings(DOCUMENT_SESSION_FLUSH_INTERVAL=timedelta(0))
+    async def test_written_through_before_next_batch(self):
+        """ Ensure in write through mode a batch isn't applied until the one before it is written and returned, to be broadcast first """
+        session = await DocumentSession.join(str(self.document.id))
+        written = asyncio.Event()
+        write = session._write
+
+        async def slow_write(*rows):
+            await written.wait()
+            return await write(*rows)
+
+        def insert(text):
+            operation = InsertOperation({'block': 'aaaaa', 'position': 5, 'text': text})
+            self.assertTrue(operation.is_valid(), operation.errors)
+            return operation
+
+        with mock.patch.object(session, '_write', slow_write):
+            first = asyncio.create_task(session.apply([insert('!')]))
+            second = asyncio.create_task(session.apply([insert('?')]))
+            await asyncio.sleep(0.05)
+            self.assertEqual(session.revision, 1)
+            written.set()
+            self.assertEqual(await asyncio.wait_for(first, 1), 1)
+            self.assertFalse(second.done())
+            self.assertEqual(await asyncio.wait_for(second, 1), 2)
+        await session.leave()
+        self.assertEqual((await ContentBlock.objects.aget(key='aaaaa')).text, 'Hello?!')
+
+    @override_settings(DOCUMENT_SESSION_FLUSH_INTERVAL=timedelta(0), DATABASE_WRITER_SHARDS=0)
+    def test_split_only_writes_affected_blocks(self):
+        """ Ensure splitting a block near the top of a long document doesn't renumber the blocks after it """
+        ContentBlock.objects.bulk_create([
+            ContentBlock(document=self.document, key=f'x{i:04}', rank='o' + rank)
+            for i, rank in enumerate(evenly_spaced_ranks(500))
+        ])
+        session = async_to_sync(DocumentSession.join)(str(self.document.id))
+        split = SplitBlockOperation(
+            data={'block': 'aaaaa', 'position': 2, 'newBlock': 'ccccc'})
+        self.assertTrue(split.is_valid(), split.errors)
+
+        # Begin, insert the new block, update the split block, log, revision, commit
+        with self.assertNumQueries(6):
+            async_to_sync(session.apply)([split])
+        async_to_sync(session.leave)()
+
+        keys = list(ContentBlock.objects.filter(
+            document=self.document).values_list('key', flat=True))
+        self.assertEqual(keys[:4], ['aaaaa', 'ccccc', 'bbbbb', 'x0000'])
+        self.assertEqual(len(keys), 503)
+
+    async def test_failing_batch_not_applied(self):
+        """ Ensure a batch with an operation which can't be applied is rejected whole, before any of it is applied or numbered """
+        session = await DocumentSession.join(str(self.document.id))
+        batches = [
+            # The second operation's block doesn't exist
+            [InsertOperation({'block': 'aaaaa', 'position': 5, 'text': '!'}),
+             DeleteOperation({'block': 'zzzzz', 'position': 0, 'offset': 1})],
+            # The last operation's block was merged away by the one before it
+            [SplitBlockOperation({'block': 'aaaaa', 'position': 2, 'newBlock': 'ccccc'}),
+             DeleteOperation({'block': 'ccccc', 'position': -1, 'offset': 0}),
+             InsertOperation({'block': 'bbbbb', 'position': 0, 'text': '!'}),
+             SetBlockTypeOperation({'block': 'ccccc', 'newBlockType': 'header-one'})],
+        ]
+        for batch in batches:
+            for serializer in batch:
+                self.assertTrue(serializer.is_valid(), serializer.errors)
+            with self.assertRaises(ContentBlock.DoesNotExist):
+                await session.apply(batch, self.user)
+        split = SplitBlockOperation({'block': 'aaaaa', 'position': 2, 'newBlock': 'bbbbb'})
+        self.assertTrue(split.is_valid())
+        with self.assertRaises(BlockExists):
+            await session.apply([split], self.user)
+
+        self.assertEqual([(block.key, str(block.text)) for block in session.blocks], [('aaaaa', 'Hello'), ('bbbbb', 'world')])
+        self.assertEqual((session.revision, list(session.operations)), (0, []))
+        self.assertFalse(session.has_changes)
+
+        # Merging a block and then editing the block it was merged into is fine
+        batch = [SplitBlockOperation({'block': 'aaaaa', 'position': 2, 'newBlock': 'ccccc'}),
+                 DeleteOperation({'block': 'ccccc', 'position': -1, 'offset': 0}),
+                 InsertOperation({'block': 'aaaaa', 'position': 5, 'text': '!'})]
+        for serializer in batch:
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertEqual(await session.apply(batch, self.user), 3)
+        self.assertEqual(str(session.get_block('aaaaa').text), 'Hello!')
+        await session.leave()
+
+    @override_settings(DOCUMENT_OPERATION_CATCHUP_LIMIT=3)
+    async def test_revisions_and_catch_up(self):
+        """
+        Ensure every applied operation is logged against a new revision, and that
+        clients are only sent what they missed unless they've missed too much
+        """
+        session = await DocumentSession.join(str(self.document.id))
+        for i in range(4):
+            self.apply(session, InsertOperation,
+                       block='aaaaa', position=0, text=str(i))
+        updates = [InsertOperation(
+            data={'block': 'bbbbb', 'position': 0, 'text': '!'})]
+        self.assertTrue(updates[0].is_valid())
+        self.assertEqual(await session.apply(updates, self.user), 1)
+
+        self.assertEqual(session.sync(1), {'revision': 1, 'title': 'Session', 'operations': []})
+        self.assertEqual(session.sync(0)['operations'], [
+                         {'type': 'insert', 'block': 'bbbbb', 'position': 0, 'text': '!'}])
+
+        await session.apply(updates * 3, self.user)
+        # Four operations behind with only three held, whole document is sent instead
+        body = session.sync(0)
+        self.assertNotIn('operations', body)
+        self.assertEqual([block['text'] for block in body['editor']['blocks']],
+                         ['3210Hello', '!!!!world'])
+
+        await session.leave()
+        self.assertEqual((await Document.objects.aget(id=self.document.id)).revision, 4)
+        self.assertEqual([operation.revision async for operation in DocumentOperation.objects.filter(document=self.document)],
+                         [1, 2, 3, 4])
+
+    async def test_replicated_batches_not_logged_again(self):
+        """
+        Ensure a batch replicated from another process is applied in memory, leaving its operations
+        and blocks for that process to write rather than logging or writing them a second time
+        """
+        session = await DocumentSession.join(str(self.document.id))
+        updates = [
+            InsertOperation(
+                data={'block': 'aaaaa', 'position': 5, 'text': ' there'}),
+            SplitBlockOperation(
+                {'block': 'aaaaa', 'position': 5, 'newBlock': 'ccccc'}),
+        ]
+        for serializer in updates:
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+
+        session.replicate(updates, 2)
+        self.assertFalse(session.has_changes)
+        self.assertTrue(session.has_applied(2))
+        self.assertEqual(session.revision, 2)
+        self.assertEqual(session.sync(0)['operations'], [
+                         serializer.data for serializer in updates])
+
+        await session.flush()
+        self.assertEqual(await DocumentOperation.objects.filter(document=self.document).acount(), 0)
+        self.assertFalse(await ContentBlock.objects.filter(key='ccccc').aexists())
+        self.assertEqual((await ContentBlock.objects.aget(key='aaaaa')).text, 'Hello')
+
+        # Once the other process has written the new block, edits made here find it by key
+        await ContentBlock.objects.acreate(
+            document=self.document, key='ccccc', text=' there', rank=session.get_block('ccccc').rank)
+        self.apply(session, InsertOperation,
+                   block='ccccc', position=6, text='!')
+        await session.leave()
+        self.assertEqual((await ContentBlock.objects.aget(key='ccccc')).text, ' there!')
+
+    async def test_stale_copies_wait_to_flush(self):
+        """ Ensure a copy behind the revision another process has written waits to catch up before writing over its rows """
+        session = await DocumentSession.join(str(self.document.id))
+        self.apply(session, InsertOperation,
+                   block='aaaaa', position=5, text='!')
+        # Another process has replicated that edit, made two of its own and written them
+        await Document.objects.filter(id=self.document.id).aupdate(revision=2)
+        await ContentBlock.objects.filter(key='aaaaa').aupdate(text='Hello!??')
+
+        flushing = asyncio.create_task(session.flush())
+        await asyncio.sleep(0.05)
+        self.assertFalse(flushing.done())
+        self.assertEqual((await ContentBlock.objects.aget(key='aaaaa')).text, 'Hello!??')
+
+        updates = [InsertOperation({'block': 'aaaaa', 'position': 6, 'text': '?'}),
+                   InsertOperation({'block': 'aaaaa', 'position': 7, 'text': '?'})]
+        for serializer in updates:
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+        session.replicate(updates, 2)
+        await asyncio.wait_for(flushing, 1)
+        self.assertEqual((await ContentBlock.objects.aget(key='aaaaa')).text, 'Hello!??')
+        self.assertEqual((await Document.objects.aget(id=self.document.id)).revision, 2)
+        await session.leave()
+
+    async def test_joins_only_wait_for_their_own_document(self):
+        """ Ensure a document slow to load holds up other joins of it, which share one session, but not joins of other documents """
+        other = await Document.objects.acreate(title='Other')
+        loaded = asyncio.Event()
+
+        async def flush_other_processes(document_id):
+            if document_id == str(self.document.id):
+                await loaded.wait()
+
+        with mock.patch.object(DocumentSession, '_flush_other_processes', flush_other_processes):
+            joins = [asyncio.create_task(DocumentSession.join(str(self.document.id))) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            other_session = await asyncio.wait_for(DocumentSession.join(str(other.id)), 1)
+            self.assertFalse(any(join.done() for join in joins))
+            loaded.set()
+            first, second = await asyncio.wait_for(asyncio.gather(*joins), 1)
+        self.assertIs(first, second)
+        self.assertEqual(first.connections, 2)
+
+        for session in (first, second, other_session):
+            await session.leave()
+        self.assertIsNone(DocumentSession.get_live(self.document.id))
+
+    async def test_processes_apply_batches_in_revision_order(self):
+        """
+        Ensure two processes editing a document at once apply every batch in revision order, their own
+        included, holding back batches which arrive early, so both copies end up the same
+        """
+        directory = tempfile.TemporaryDirectory()
+        path = f'{directory.name}/broker.sock'
+        broker_task = asyncio.create_task(ChannelBroker(path).serve())
+        # Two layers stand in for two worker processes
+        layers = [BrokerChannelLayer(path), BrokerChannelLayer(path)]
+        group = f'document_{self.document.id}'
+        await asyncio.sleep(0.05)
+        sessions = []
+        try:
+            for layer in layers:
+                session = await DocumentSession.load(str(self.document.id))
+                session.channel_layer = layer
+                channel = await layer.new_channel()
+                await layer.group_add(group, channel)
+                session.start_replicating(channel)
+                sessions.append(session)
+            first, second = sessions
+            await asyncio.sleep(0.05)
+
+            async def broadcast(session, revision, operation):
+                sender = await session.channel_layer.new_channel()
+                await session.channel_layer.group_send(group, BroadcastAggregator.event([(sender, {
+                    'type': 'update_document_content', 'body': {'data': [operation.data]}, 'revision': revision})]))
+
+            def insert(position, text):
+                operation = InsertOperation({'block': 'aaaaa', 'position': position, 'text': text})
+                self.assertTrue(operation.is_valid(), operation.errors)
+                return operation
+
+            # The second process' batch is numbered after the first's, so waits for it to arrive
+            a, b = insert(5, 'A'), insert(0, 'B')
+            self.assertEqual(await first.apply([a]), 1)
+            applying = asyncio.create_task(second.apply([b]))
+            await asyncio.sleep(0.05)
+            self.assertFalse(applying.done())
+            await broadcast(first, 1, a)
+            self.assertEqual(await asyncio.wait_for(applying, 1), 2)
+            await broadcast(second, 2, b)
+
+            # Batches broadcast out of order are held until the ones before them arrive
+            c, d = insert(1, 'C'), insert(2, 'D')
+            self.assertEqual(await second.apply([c]), 3)
+            self.assertEqual(await second.apply([d]), 4)
+            await broadcast(second, 4, d)
+            await asyncio.sleep(0.05)
+            self.assertEqual(first.revision, 2)
+            await broadcast(second, 3, c)
+            await asyncio.sleep(0.05)
+
+            for session in sessions:
+                self.assertEqual(session.revision, 4)
+                self.assertEqual(str(session.get_block('aaaaa').text), 'BCDHelloA')
+                self.assertEqual([revision for revision, operation in session.operations], [1, 2, 3, 4])
+        finally:
+            for session in sessions:
+                await session.stop_replicating()
+            for layer in layers:
+                await layer.close()
+            await asyncio.sleep(0.05)
+            broker_task.cancel()
+            directory.cleanup()
+
+    async def test_styles_follow_edits(self):
+        """ Ensure inline styles shift with the text around them, split and merge with blocks, and are persisted """
+        session = await DocumentSession.join(str(self.document.id))
+        self.apply(session, SetInlineStyleOperation,
+                   block='aaaaa', position=1, offset=3, style='BOLD')
+        self.apply(session, InsertOperation,
+                   block='aaaaa', position=0, text='Oh ')
+        self.apply(session, InsertOperation,
+                   block='aaaaa', position=6, text='XX')
+        self.apply(session, SplitBlockOperation,
+                   block='aaaaa', position=5, newBlock='ccccc')
+        self.assertEqual(list(session.get_block('aaaaa').styles), [(4, 1, 'BOLD')])
+        self.assertEqual(list(session.get_block('ccccc').styles), [(0, 4, 'BOLD')])
+
+        await session.flush()
+        styles = [(key, style_dictionary.unpack(inline_styles))
+                  async for key, inline_styles in ContentBlock.objects.values_list('key', 'inline_styles')]
+        self.assertEqual(styles, [('aaaaa', [(4, 1, 'BOLD')]), ('ccccc', [(0, 4, 'BOLD')]), ('bbbbb', [])])
+
+        self.apply(session, DeleteOperation,
+                   block='ccccc', position=-1, offset=1)
+        self.apply(session, DeleteOperation,
+                   block='aaaaa', position=4, offset=5)
+        await session.leave()
+        block = await ContentBlock.objects.aget(key='aaaaa')
+        self.assertEqual((block.text, bytes(block.inline_styles)), ('Oh Ho', b''))
+        self.assertEqual([name async for name in Style.objects.values_list('name', flat=True)], ['BOLD'])
+
+
+class BrokerChannelLayerTests(SimpleTestCase):
+    async def start_broker(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = f'{self.directory.name}/broker.sock'
+        self.broker = ChannelBroker(path)
+        self.broker_task = asyncio.create_task(self.broker.serve())
+        # Two layers stand in for two worker processes
+        self.layers = [BrokerChannelLayer(path), BrokerChannelLayer(path)]
+        await asyncio.sleep(0.05)
+
+    async def stop_broker(self):
+        for layer in self.layers:
+            await layer.close()
+        # Let the broker see the disconnects before it's stopped
+        await asyncio.sleep(0.05)
+        self.broker_task.cancel()
+        self.directory.cleanup()
+
+    async def test_group_send_once_per_process(self):
+        """ Ensure group messages reach every member in every process, with one frame sent to each other process """
+        await self.start_broker()
+        try:
+            first, second = self.layers
+            channels = [await first.new_channel(), await first.new_channel(), await second.new_channel(), await second.new_channel()]
+            for channel in channels:
+                await (first if first.is_local_channel(channel) else second).group_add('document', channel)
+            await asyncio.sleep(0.05)
+
+            with mock.patch.object(self.broker, 'deliver', wraps=self.broker.deliver) as deliver:
+                await first.group_send('document', {'type': 'update_document_content'})
+                for channel in channels:
+                    layer = first if first.is_local_channel(channel) else second
+                    self.assertEqual(await asyncio.wait_for(layer.receive(channel), 1), {'type': 'update_document_content'})
+            self.assertEqual(deliver.call_count, 1)
+
+            await first.send(channels[2], {'type': 'direct'})
+            self.assertEqual(await asyncio.wait_for(second.receive(channels[2]), 1), {'type': 'direct'})
+
+            # Revisions for a document are numbered across both processes
+            self.assertEqual(await first.sequence('document', 3, 0), 3)
+            self.assertEqual(await second.sequence('document', 1, 0), 4)
+            self.assertEqual(await second.sequence('document', 1, 10), 11)
+        finally:
+            await self.stop_broker()
+
+    async def test_group_request_waits_for_other_processes(self):
+        """ Ensure a group request returns once every other process with group members has replied """
+        await self.start_broker()
+        try:
+            first, second = self.layers
+            channel = await second.new_channel()
+            await second.group_add('document', channel)
+            await asyncio.sleep(0.05)
+
+            async def reply():
+                message = await second.receive(channel)
+                await second.send(message['reply_channel'], {'type': 'document_flushed', 'channel': channel})
+            replier = asyncio.create_task(reply())
+            await asyncio.wait_for(first.group_request('document', {'type': 'flush_document'}, 5), 1)
+            self.assertTrue(replier.done())
+        finally:
+            await self.stop_broker()
+
+
+class SendQueueTests(SimpleTestCase):
+    async def test_slow_socket(self):
+        """
+        Ensure a socket falling behind has its cursors coalesced, then its updates replaced by a
+        snapshot, and is closed once only replies are left queued
+        """
+        sent, closed = [], []
+        unblocked = asyncio.Event()
+
+        async def send(frame):
+            await unblocked.wait()
+            sent.append(frame)
+
+        async def close():
+            closed.append(True)
+
+        async def wait_for_sent(count):
+            while len(sent) < count:
+                await asyncio.sleep(0)
+
+        queue = SendQueue(send, close, 4, {UPDATE: lambda: (4, 'document'), PRESENCE: lambda: (None, 'everyone')})
+        queue.put('reply 1')
+        # The first frame is taken off the queue, the rest wait behind it
+        await asyncio.sleep(0)
+        queue.put('cursor 1', PRESENCE)
+        queue.put('cursor 2', PRESENCE)
+        queue.put('edit 1', UPDATE, 1)
+        queue.put('reply 2')
+        queue.put('cursor 3', PRESENCE)
+        self.assertEqual([frame for kind, revision, frame in queue.frames], ['edit 1', 'reply 2'])
+        for revision in (2, 3, 4):
+            queue.put(f'edit {revision}', UPDATE, revision)
+        queue.put('title', UPDATE)
+        self.assertEqual([frame for kind, revision, frame in queue.frames], ['reply 2'])
+
+        unblocked.set()
+        await asyncio.wait_for(wait_for_sent(4), 1)
+        self.assertEqual(sent, ['reply 1', 'document', 'everyone', 'reply 2'])
+        # Updates already in the snapshot are skipped
+        queue.put('edit 4', UPDATE, 4)
+        queue.put('edit 5', UPDATE, 5)
+        await asyncio.wait_for(wait_for_sent(5), 1)
+        self.assertEqual(sent[-1], 'edit 5')
+
+        unblocked.clear()
+        for i in range(6):
+            queue.put(f'reply {i + 3}')
+            await asyncio.sleep(0)
+        self.assertTrue(queue.closed)
+        self.assertEqual(closed, [True])
+        self.assertEqual(len(queue), 0)
+
+    def test_token_bucket(self):
+        """ Ensure a token bucket allows bursts up to its size, topping up at its rate, and reserves tokens it doesn't have yet """
+        bucket = TokenBucket(10, 3)
+        self.assertEqual([bucket.take() for _ in range(4)], [True, True, True, False])
+        bucket.updated -= 0.1
+        self.assertEqual([bucket.take() for _ in range(2)], [True, False])
+        # Reserving goes into debt, each token over the limit waiting a tenth of a second more
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+
+
+class DocumentOperationsViewTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ach_henderson')
+        self.document = Document.objects.create(title='Operations', revision=3)
+        DocumentCollaborator.objects.create(
+            document=self.document, user=self.user, permission=2)
+        ContentBlock.objects.create(
+            document=self.document, key='aaaaa', text='abc', rank='n')
+        for revision, text in enumerate('abc', start=1):
+            DocumentOperation.objects.create(document=self.document, revision=revision, data={
+                'type': 'insert', 'block': 'aaaaa', 'position': revision - 1, 'text': text})
+        self.client.force_authenticate(self.user)
+        self.url = f'/api/documents/{self.document.id}/operations/'
+
+    @override_settings(DOCUMENT_OPERATION_CATCHUP_LIMIT=2)
+    def test_catch_up(self):
+        """ Ensure only missed operations are returned, with a snapshot once too many are missed """
+        response = self.client.get(self.url, {'revision': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['revision'], 3)
+        self.assertEqual([operation['text'] for operation in response.json()['operations']], ['b', 'c'])
+
+        response = self.client.get(self.url, {'revision': 0})
+        self.assertNotIn('operations', response.json())
+        self.assertEqual(response.json()['editor']['blocks'][0]['text'], 'abc')
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_requires_collaborator(self):
+        """ Ensure users can't read the operations of documents they aren't a collaborator of """
+        self.client.force_authenticate(User.objects.create(username='stranger'))
+        response = self.client.get(self.url, {'revision': 0})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+# Sessions write on the test's thread, in the transaction the test runs in
+@override_settings(DATABASE_WRITER_SHARDS=0)
+class DocumentsListViewTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ach_henderson')
+        self.other = User.objects.create(username='other')
+        self.client.force_authenticate(self.user)
+
+    def test_summaries(self):
+        """ Ensure documents are listed as summaries, most recently modified first, a page at a time in one query """
+        for i in range(30):
+            document = Document.objects.create(title=f'Document {i}')
+            ContentBlock.objects.create(document=document, key='aaaaa', text='Not listed', rank='n')
+            DocumentCollaborator.objects.create(
+                document=document, user=self.user, permission=DocumentCollaborator.OWNER if i % 2 else DocumentCollaborator.VIEWER)
+            DocumentCollaborator.objects.create(document=document, user=self.other, permission=DocumentCollaborator.EDITOR)
+        Document.objects.create(title='Not shared')
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/documents/', {'page_size': 20})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        page = response.json()
+        self.assertEqual(page['results'][0], {
+            'id': str(document.id),
+            'title': 'Document 29',
+            'updated_at': page['results'][0]['updated_at'],
+            'permission': DocumentCollaborator.OWNER,
+            'permission_level': 'Owner',
+            'collaborator_count': 2,
+        })
+        self.assertEqual(page['results'][1]['permission_level'], 'Viewer')
+
+        response = self.client.get(page['next'])
+        titles = [summary['title'] for summary in page['results'] + response.json()['results']]
+        self.assertEqual(titles, [f'Document {i}' for i in reversed(range(30))])
+        self.assertIsNone(response.json()['next'])
+
+    def test_edited_documents_listed_first(self):
+        """ Ensure a document moves to the top of the listing once edits to it are flushed """
+        documents = [Document.objects.create(title=title) for title in ('first', 'second')]
+        for document in documents:
+            DocumentCollaborator.objects.create(document=document, user=self.user, permission=DocumentCollaborator.OWNER)
+
+        session = async_to_sync(DocumentSession.join)(str(documents[0].id))
+        session.set_title('edited')
+        async_to_sync(session.leave)()
+
+        response = self.client.get('/api/documents/')
+        self.assertEqual([summary['title'] for summary in response.json()['results']], ['edited', 'second'])
+
+    def test_create_with_styles(self):
+        """ Ensure styles of created blocks are packed into one column per block and served back unchanged """
+        ranges = [{'length': 5, 'offset': 0, 'style': 'BOLD'}, {'length': 3, 'offset': 2, 'style': 'STRIKETHROUGH'}]
+        response = self.client.post('/api/documents/', {'title': 'Styled', 'blocks': [
+            {'key': 'aaaaa', 'text': 'Hello world', 'type': 'unstyled', 'inlineStyleRanges': ranges},
+            {'key': 'bbbbb', 'text': 'Plain', 'type': 'unstyled', 'inlineStyleRanges': []},
+        ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        block = ContentBlock.objects.get(key='aaaaa')
+        self.assertEqual(len(block.inline_styles), 24)
+        self.assertEqual(Style.objects.count(), 2)
+        blocks = self.client.get(f'/api/documents/{response.json()["id"]}/').json()['editor']['blocks']
+        self.assertEqual([block['inlineStyleRanges'] for block in blocks], [ranges, []])
+
+
+@override_settings(DATABASE_WRITER_SHARDS=0)
+class DocumentViewTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ach_henderson')
+        self.document = Document.objects.create(title='Large')
+        for i, username in enumerate(('ach_henderson', 'editor', 'viewer')):
+            user = self.user if i == 0 else User.objects.create(username=username)
+            DocumentCollaborator.objects.create(document=self.document, user=user, permission=i * 2)
+        self.client.force_authenticate(self.user)
+
+    def test_constant_queries(self):
+        """ Ensure a document is loaded in the same number of queries however many blocks and styles it has """
+        ranks = evenly_spaced_ranks(2000)
+        inline_styles = style_dictionary.pack([(0, 2, 'BOLD'), (3, 2, 'ITALIC')])
+        ContentBlock.objects.bulk_create(
+            ContentBlock(document=self.document, key=f'{i:05}', text=f'Block {i}', rank=rank,
+                         inline_styles=inline_styles if i % 10 == 0 else b'')
+            for i, rank in reversed(list(enumerate(ranks))))
+        # Permissions are cached, so the first request can take one more query than the rest
+        self.client.get(f'/api/documents/{self.document.id}/')
+        snapshot_cache.invalidate(self.document.id)
+
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/documents/{self.document.id}/')
+        # Unchanged content is served from the snapshot taken by the last request
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get(f'/api/documents/{self.document.id}/').content, response.content)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.json()
+        self.assertEqual(len(body['editor']['blocks']), 2000)
+        self.assertEqual(body['editor']['blocks'][0], {
+            'key': '00000', 'text': 'Block 0', 'type': 'unstyled',
+            'inlineStyleRanges': [{'length': 2, 'offset': 0, 'style': 'BOLD'}, {'length': 2, 'offset': 3, 'style': 'ITALIC'}],
+            'data': {}, 'depth': 0, 'entityRanges': [],
+        })
+        self.assertEqual(body['editor']['blocks'][1]['inlineStyleRanges'], [])
+        self.assertEqual([collaborator['user']['username'] for collaborator in body['collaborators']],
+                         ['ach_henderson', 'editor', 'viewer'])
+        self.assertEqual((body['permission'], body['permission_level']), (DocumentCollaborator.OWNER, 'Owner'))
+        self.assertTrue(response['X-Authentication-Ticket'])
+
+    def test_non_collaborator(self):
+        """ Ensure users who aren't collaborators can't see, edit or delete a document """
+        self.client.force_authenticate(User.objects.create(username='stranger'))
+        url = f'/api/documents/{self.document.id}/'
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.patch(url, {'title': 'Mine'}).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(Document.objects.get(pk=self.document.pk).title, 'Large')
+
+    def test_conditional_get(self):
+        """ Ensure unchanged reopens get a 304, changed documents a new ETag, and unchanged content comes from the snapshot cache """
+        ContentBlock.objects.create(document=self.document, key='aaaaa', text='Hello', rank='n')
+        url = f'/api/documents/{self.document.id}/'
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertEqual(response.json()['editor']['blocks'][0]['text'], 'Hello')
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        # Tickets are single use, so a fresh one is sent even when the document is unchanged
+        self.assertEqual(response['X-Authentication-Ticket'], str(User.objects.get(pk=self.user.pk).authentication_ticket))
+
+        # Title changes don't move the revision, but do change the ETag
+        self.client.patch(url, {'title': 'Renamed'})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        with mock.patch('api.views.editor_content') as content:
+            self.assertEqual(self.client.get(url).json()['editor']['blocks'][0]['text'], 'Hello')
+            content.assert_not_called()
+
+        # Applying an edit moves the revision on, so the content is loaded again
+        session = async_to_sync(DocumentSession.join)(str(self.document.id))
+        insert = InsertOperation({'block': 'aaaaa', 'position': 5, 'text': '!'})
+        self.assertTrue(insert.is_valid())
+        async_to_sync(session.apply)([insert])
+        async_to_sync(session.leave)()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.json()['editor']['blocks'][0]['text'], 'Hello!')
+        self.assertEqual(response.json()['revision'], 1)
+
+        # Outsiders with a current ETag get neither a 304 nor the cached snapshot
+        etag = response['ETag']
+        self.client.force_authenticate(User.objects.create(username='stranger'))
+        with mock.patch('api.views.snapshot_cache') as cache, mock.patch.object(DocumentSession, 'flush_document') as flush:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            cache.get.assert_not_called()
+            flush.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertNotIn('ETag', response)
+
+
+class DocumentBlocksViewTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ach_henderson')
+        self.document = Document.objects.create(title='Long', revision=2)
+        DocumentCollaborator.objects.create(document=self.document, user=self.user, permission=3)
+        ContentBlock.objects.bulk_create(
+            ContentBlock(document=self.document, key=f'{i:05}', text=f'Block {i}', rank=rank,
+                         inline_styles=style_dictionary.pack([(0, 5, 'BOLD')]) if i == 11 else b'')
+            for i, rank in enumerate(evenly_spaced_ranks(50)))
+        self.client.force_authenticate(self.user)
+        self.url = f'/api/documents/{self.document.id}/blocks/'
+
+    def test_windows(self):
+        """ Ensure blocks are loaded a window at a time by offset or key cursor, matching the live session """
+        response = self.client.get(self.url, {'offset': 10, 'limit': 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        window = response.json()
+        self.assertEqual({key: window[key] for key in ('revision', 'title', 'count', 'offset', 'next')},
+                         {'revision': 2, 'title': 'Long', 'count': 50, 'offset': 10, 'next': '00014'})
+        self.assertEqual([block['key'] for block in window['blocks']], ['00010', '00011', '00012', '00013', '00014'])
+        self.assertEqual(window['blocks'][1]['inlineStyleRanges'], [{'length': 5, 'offset': 0, 'style': 'BOLD'}])
+
+        response = self.client.get(self.url, {'after': window['next'], 'limit': 40})
+        self.assertEqual(response.json()['offset'], 15)
+        self.assertEqual(len(response.json()['blocks']), 35)
+        self.assertIsNone(response.json()['next'])
+
+        session = async_to_sync(DocumentSession.join)(str(self.document.id))
+        self.assertEqual(session.blocks_window(5, offset=10), window)
+        self.assertEqual(session.blocks_window(40, after='00014'), response.json())
+        async_to_sync(session.leave)()
+
+        self.assertEqual(self.client.get(self.url, {'after': 'zzzzz', 'limit': 5}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url, {'limit': 501}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(DATABASE_WRITER_SHARDS=0)
+class DocumentSearchViewTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ach_henderson')
+        self.client.force_authenticate(self.user)
+        self.documents = [Document.objects.create(title=title) for title in ('Quarterly report', 'Meeting notes', 'Secret plans')]
+        for document in self.documents[:2]:
+            DocumentCollaborator.objects.create(document=document, user=self.user, permission=DocumentCollaborator.EDITOR)
+        ContentBlock.objects.bulk_create([
+            ContentBlock(document=self.documents[0], key='aaaaa', text='Revenue grew in every region', rank='g'),
+            ContentBlock(document=self.documents[1], key='bbbbb', text='Agenda', rank='g'),
+            ContentBlock(document=self.documents[1], key='ccccc', text='We reviewed the report on revenue and regional growth', rank='n'),
+            ContentBlock(document=self.documents[2], key='ddddd', text='Revenue is confidential', rank='g'),
+        ])
+
+    def test_search(self):
+        """ Ensure only the caller's documents are searched, best match first, with highlighted snippets of the best block """
+        response = self.client.get('/api/documents/search/', {'q': 'report'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.json()['results']
+        self.assertEqual([result['title'] for result in results], ['Quarterly report', 'Meeting notes'])
+        self.assertEqual((results[0]['title_highlights'], results[0]['block']), ([{'offset': 10, 'length': 6}], None))
+        self.assertEqual(results[0]['permission_level'], 'Editor')
+
+        # Every word has to match in the same block, the last word as a prefix
+        results = self.client.get('/api/documents/search/', {'q': 'report, reven'}).json()['results']
+        self.assertEqual([(result['title'], result['block']) for result in results], [('Meeting notes', 'ccccc')])
+        self.assertEqual((results[0]['snippet'], results[0]['title_highlights']),
+                         ('We reviewed the report on revenue and regional growth', []))
+        self.assertEqual(results[0]['snippet_highlights'], [{'offset': 16, 'length': 6}, {'offset': 26, 'length': 7}])
+
+        self.assertEqual(self.client.get('/api/documents/search/', {'q': '"*) OR'}).json()['results'], [])
+        self.assertEqual(self.client.get('/api/documents/search/', {'q': 'confidential'}).json()['results'], [])
+        self.assertEqual(self.client.get('/api/documents/search/').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_without_index(self):
+        """ Ensure databases without the FTS5 indexes are searched by substring instead """
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            results = self.client.get('/api/documents/search/', {'q': 'report, reven'}).json()['results']
+            self.assertEqual([(result['title'], result['block']) for result in results], [('Meeting notes', 'ccccc')])
+            self.assertEqual(results[0]['snippet'], 'We reviewed the report on revenue and regional growth')
+            self.assertEqual(results[0]['snippet_highlights'], [{'offset': 16, 'length': 6}, {'offset': 26, 'length': 5}])
+
+            results = self.client.get('/api/documents/search/', {'q': 'REPORT'}).json()['results']
+            self.assertEqual({result['title'] for result in results}, {'Quarterly report', 'Meeting notes'})
+            quarterly = next(result for result in results if result['title'] == 'Quarterly report')
+            self.assertEqual((quarterly['title_highlights'], quarterly['block']), ([{'offset': 10, 'length': 6}], None))
+            self.assertEqual(self.client.get('/api/documents/search/', {'q': 'confidential'}).json()['results'], [])
+
+    @override_settings(DOCUMENT_SESSION_FLUSH_INTERVAL=timedelta(0))
+    def test_index_follows_edits(self):
+        """ Ensure edits and title changes are searchable once the session writes them, and deleted blocks no longer match """
+        session = async_to_sync(DocumentSession.join)(str(self.documents[1].id))
+        updates = [InsertOperation({'block': 'bbbbb', 'position': 6, 'text': ' for the offsite'}),
+                   DeleteOperation({'block': 'ccccc', 'position': -1, 'offset': 0})]
+        for update in updates:
+            self.assertTrue(update.is_valid(), update.errors)
+        session.set_title('Offsite planning')
+        async_to_sync(session.apply)(updates)
+        async_to_sync(session.leave)()
+
+        results = self.client.get('/api/documents/search/', {'q': 'offsite'}).json()['results']
+        self.assertEqual([(result['title'], result['block']) for result in results], [('Offsite planning', 'bbbbb')])
+        self.assertEqual(results[0]['snippet'], 'Agenda for the offsiteWe reviewed the report on revenue and regional growth')
+        self.assertEqual(self.client.get('/api/documents/search/', {'q': 'notes'}).json()['results'], [])
+
+    def test_index_keyed_by_document(self):
+        """ Ensure titles stay matched up with their documents when rowids are renumbered, and dropped triggers are recreated """
+        with connection.cursor() as cursor:
+            # As VACUUM may do, api_document has no INTEGER PRIMARY KEY to keep them stable
+            cursor.execute('UPDATE api_document SET rowid = 1000 - rowid')
+        results = self.client.get('/api/documents/search/', {'q': 'quarterly'}).json()['results']
+        self.assertEqual([result['id'] for result in results], [str(self.documents[0].id)])
+
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER api_document_fts_update')
+        Document.objects.filter(pk=self.documents[0].pk).update(title='Annual report')
+        self.assertEqual(repair_search_index(), ['api_document_fts_update'])
+        self.assertEqual(repair_search_index(), [])
+        results = self.client.get('/api/documents/search/', {'q': 'annual'}).json()['results']
+        self.assertEqual([result['title'] for result in results], ['Annual report'])
+
+        self.documents[1].delete()
+        self.assertEqual(self.client.get('/api/documents/search/', {'q': 'notes'}).json()['results'], [])
+
+
+class UserAutocompleteViewTests(APITestCase):
+    def setUp(self):
+        username_prefix_cache.clear()
+        self.user = User.objects.create(username='ach_henderson')
+        self.client.force_authenticate(self.user)
+        self.document = Document.objects.create(title='Shared')
+        DocumentCollaborator.objects.create(document=self.document, user=self.user, permission=DocumentCollaborator.OWNER)
+        for username in ('Achilles', 'acheron', 'ACHE', 'alice', 'bach'):
+            User.objects.create(username=username)
+        DocumentCollaborator.objects.create(
+            document=self.document, user=User.objects.get(username='acheron'), permission=DocumentCollaborator.VIEWER)
+        self.url = '/api/users/autocomplete/'
+
+    def test_autocomplete(self):
+        """ Ensure usernames are matched by case insensitive prefix, leaving out the caller and the document's collaborators """
+        response = self.client.get(self.url, {'q': 'aCh'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([user['username'] for user in response.json()['results']], ['ACHE', 'acheron', 'Achilles'])
+
+        response = self.client.get(self.url, {'q': 'ach', 'document': str(self.document.id), 'limit': 1})
+        self.assertEqual([user['username'] for user in response.json()['results']], ['ACHE'])
+
+        stranger = Document.objects.create(title='Not shared')
+        response = self.client.get(self.url, {'q': 'ach', 'document': str(stranger.id)})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(self.url, {'q': 'ach', 'limit': 1000}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_prefixes_cached(self):
+        """ Ensure repeated prefixes aren't queried again, until someone registers with a username they match """
+        self.client.get(self.url, {'q': 'al'})
+        with self.assertNumQueries(0):
+            self.assertEqual([user['username'] for user in self.client.get(self.url, {'q': 'AL'}).json()['results']], ['alice'])
+
+        User.objects.create(username='Alfred')
+        self.assertEqual([user['username'] for user in self.client.get(self.url, {'q': 'al'}).json()['results']], ['Alfred', 'alice'])
+
+    def test_prefix_index(self):
+        """ Ensure prefixes are looked up through the lowercased username index rather than scanning every user """
+        queryset = User.objects.annotate(username_lower=Lower('username')).filter(
+            username_lower__gte='ach', username_lower__lt='ach\U0010ffff')
+        self.assertIn('user_username_lower', queryset.explain())
+        self.assertEqual([user.username for user in users_with_prefix('ACH', 2)], ['ach_henderson', 'ACHE'])
+
+    def test_non_ascii_prefix(self):
+        """ Ensure prefixes with letters the database doesn't lowercase still match, as they're folded the same way """
+        for username in ('Élodie', 'ÉMILE', 'Straße'):
+            User.objects.create(username=username)
+        self.assertEqual([user['username'] for user in self.client.get(self.url, {'q': 'Él'}).json()['results']], ['Élodie'])
+        # Only ASCII letters are matched whatever their case
+        self.assertEqual([user['username'] for user in self.client.get(self.url, {'q': 'éMI'}).json()['results']], [])
+        self.assertEqual([user['username'] for user in self.client.get(self.url, {'q': 'STRAß'}).json()['results']], ['Straße'])
+
+
+class AccessTokenCacheTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ach_henderson')
+
+    def test_token_only_validated_when_changed_or_expired(self):
+        """ Ensure repeated messages carrying the same token don't decode it again """
+        cache = AccessTokenCache()
+        token = str(AccessToken.for_user(self.user))
+
+        with mock.patch.object(JWTAuthentication, 'get_validated_token', wraps=JWTAuthentication().get_validated_token) as validate:
+            for _ in range(5):
+                self.assertTrue(async_to_sync(cache.is_valid)(token, self.user))
+            self.assertEqual(validate.call_count, 1)
+
+            # Different token for the same user
+            new_token = str(AccessToken.for_user(self.user))
+            self.assertTrue(async_to_sync(cache.is_valid)(new_token, self.user))
+            self.assertEqual(validate.call_count, 2)
+
+            # Cached token past its expiry is validated again
+            with mock.patch('api.auth.time.time', return_value=AccessToken(new_token)['exp'] + 1):
+                async_to_sync(cache.is_valid)(new_token, self.user)
+            self.assertEqual(validate.call_count, 3)
+
+        self.assertFalse(async_to_sync(cache.is_valid)('not a token', self.user))
+        other_user = User.objects.create(username='someone_else')
+        self.assertFalse(async_to_sync(cache.is_valid)(str(AccessToken.for_user(other_user)), self.user))
+
+
+class CollaboratorPermissionCacheTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ach_henderson')
+        self.document = Document.objects.create(title='Shared')
+        self.collaborator = DocumentCollaborator.objects.create(
+            document=self.document, user=self.user, permission=DocumentCollaborator.VIEWER)
+
+    def test_invalidated_on_commit(self):
+        """ Ensure a permission cached again before a change to it commits is forgotten once it does """
+        cache = CollaboratorPermissionCache(60, 100)
+        with mock.patch('api.signals.permission_cache', cache):
+            self.assertEqual(cache.get(self.document.id, self.user.id), DocumentCollaborator.VIEWER)
+            with transaction.atomic():
+                self.collaborator.permission = DocumentCollaborator.EDITOR
+                self.collaborator.save()
+                self.assertEqual(cache.peek(self.document.id, self.user.id), NOT_CACHED)
+                # Cached by a lookup from another connection, which can't see the change yet
+                cache._permissions[(str(self.document.id), str(self.user.id))] = (monotonic() + 60, DocumentCollaborator.VIEWER)
+            self.assertEqual(cache.peek(self.document.id, self.user.id), NOT_CACHED)
+            self.assertEqual(cache.get(self.document.id, self.user.id), DocumentCollaborator.EDITOR)
+
+    def test_expires(self):
+        """ Ensure a permission changed where this process' signals can't see it is queried again once it expires """
+        cache = CollaboratorPermissionCache(60, 100)
+        self.assertEqual(cache.get(self.document.id, self.user.id), DocumentCollaborator.VIEWER)
+        # Changed by another process
+        DocumentCollaborator.objects.filter(pk=self.collaborator.pk).update(permission=DocumentCollaborator.ADMIN)
+        self.assertEqual(cache.get(self.document.id, self.user.id), DocumentCollaborator.VIEWER)
+        with mock.patch('api.permissions.monotonic', return_value=monotonic() + 61):
+            self.assertEqual(cache.get(self.document.id, self.user.id), DocumentCollaborator.ADMIN)
+
+
+class DatabaseWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.writer = DatabaseWriter('test-writer', max_batch=8)
+
+    def tearDown(self):
+        self.writer.stop()
+
+    async def test_group_commit(self):
+        """ Ensure writes queued together are committed in one transaction, without a failed write rolling back the rest """
+        events = []
+        started, unblocked = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            unblocked.wait(1)
+
+        def create(title):
+            document = Document.objects.create(title=title)
+            transaction.on_commit(lambda: events.append(('commit', title)))
+            events.append(('write', title))
+            if title == 'Broken':
+                raise ValueError(title)
+            return document.title
+
+        blocker = self.writer.submit(block)
+        # Everything submitted whilst the writer is busy goes into the next group
+        await asyncio.to_thread(started.wait, 1)
+        writes = [self.writer.run(create, title) for title in ('First', 'Broken', 'Second')]
+        unblocked.set()
+        results = await asyncio.gather(*writes, return_exceptions=True)
+        await asyncio.wrap_future(blocker)
+
+        self.assertEqual(results[::2], ['First', 'Second'])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(events, [('write', 'First'), ('write', 'Broken'), ('write', 'Second'),
+                                  ('commit', 'First'), ('commit', 'Second')])
+        self.assertEqual(sorted([document.title async for document in Document.objects.all()]), ['First', 'Second'])
+
+
+class DocumentConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.document = Document.objects.create(title='Consumer')
+        ContentBlock.objects.create(
+            document=self.document, key='aaaaa', text='Hello', rank='n')
+        self.owner = self.create_collaborator('owner', DocumentCollaborator.OWNER)
+        self.viewer = self.create_collaborator('viewer', DocumentCollaborator.VIEWER)
+        self.communicators: list[WebsocketCommunicator] = []
+
+    def create_collaborator(self, username: str, permission: int) -> User:
+        user = User.objects.create(username=username)
+        DocumentCollaborator.objects.create(
+            document=self.document, user=user, permission=permission)
+        return user
+
+    async def connect(self, user: User, document_id=None, subprotocols: list[str] = None) -> WebsocketCommunicator:
+        """ Open a websocket to the document, authenticated with a fresh ticket like the frontend """
+        user.authentication_ticket = uuid4()
+        user.authentication_ticket_expires_at = datetime.now(tz=timezone.utc) + timedelta(minutes=1)
+        await user.asave(update_fields=['authentication_ticket', 'authentication_ticket_expires_at'])
+        communicator = WebsocketCommunicator(
+            application, f'/ws/document/{document_id or self.document.id}/?{user.authentication_ticket}', subprotocols=subprotocols)
+        self.communicators.append(communicator)
+        return communicator
+
+    def message(self, user: User, type: str, body: dict) -> str:
+        return json.dumps({'type': type, 'access_token': str(AccessToken.for_user(user)), 'body': body})
+
+    async def disconnect_all(self) -> None:
+        for communicator in self.communicators:
+            await communicator.disconnect()
+        self.communicators = []
+
+    async def test_permissions(self):
+        """ Ensure only collaborators can connect, and viewers can't edit """
+        stranger = await User.objects.acreate(username='stranger')
+        connected, _ = await (await self.connect(stranger)).connect()
+        self.assertFalse(connected)
+        connected, _ = await (await self.connect(self.owner, document_id=uuid4())).connect()
+        self.assertFalse(connected)
+
+        owner = await self.connect(self.owner)
+        viewer = await self.connect(self.viewer)
+        self.assertTrue((await owner.connect())[0])
+        self.assertTrue((await viewer.connect())[0])
+
+        insert = {'data': [{'type': 'insert', 'block': 'aaaaa', 'position': 5, 'text': '!'}]}
+        await viewer.send_to(text_data=self.message(self.viewer, 'update_document_content', insert))
+        self.assertIn('permission', json.loads(await viewer.receive_from())['errors'][0])
+
+        await owner.send_to(text_data=self.message(self.owner, 'update_document_content', insert))
+        response = json.loads(await viewer.receive_from())
+        self.assertEqual(response['type'], 'update_document_content')
+        self.assertEqual(response['revision'], 1)
+        self.assertEqual(response['body'], insert)
+        self.assertEqual(str(DocumentSession.get_live(self.document.id).get_block('aaaaa').text), 'Hello!')
+
+        await self.disconnect_all()
+        self.assertEqual((await ContentBlock.objects.aget(key='aaaaa')).text, 'Hello!')
+
+    async def test_broadcast_encoded_once(self):
+        """ Ensure a broadcast frame is encoded once by the sender however many sockets receive it """
+        # Each ticket is single use, so every socket connects before the next ticket is issued
+        owner = await self.connect(self.owner)
+        self.assertTrue((await owner.connect())[0])
+        viewers = []
+        for _ in range(3):
+            viewers.append(await self.connect(self.viewer))
+            self.assertTrue((await viewers[-1].connect())[0])
+
+        insert = {'data': [{'type': 'insert', 'block': 'aaaaa', 'position': 0, 'text': '!'}]}
+        message = self.message(self.owner, 'update_document_content', insert)
+        with mock.patch('api.codecs.dumps', wraps=codecs.dumps) as dumps:
+            await owner.send_to(text_data=message)
+            frames = [await viewer.receive_from() for viewer in viewers]
+        self.assertEqual(dumps.call_count, 1)
+        self.assertEqual(len(set(frames)), 1)
+        self.assertEqual(json.loads(frames[0])['body'], insert)
+
+        await self.disconnect_all()
+
+    @override_settings(DOCUMENT_BROADCAST_WINDOW=timedelta(milliseconds=200))
+    async def test_broadcasts_coalesced(self):
+        """
+        Ensure edits sent within the broadcast window reach each socket as one frame, in
+        revision order, without senders being sent their own edits back
+        """
+        editor = await sync_to_async(self.create_collaborator)('editor', DocumentCollaborator.EDITOR)
+        sockets = {}
+        for user in (self.owner, editor, self.viewer):
+            sockets[user] = await self.connect(user)
+            self.assertTrue((await sockets[user].connect())[0])
+        events_sent, events_saved = BroadcastAggregator.events_sent, BroadcastAggregator.events_saved
+
+        updates = [{'type': 'insert', 'block': 'aaaaa', 'position': 0, 'text': text} for text in 'abc']
+        for user, update in zip((self.owner, editor, self.owner), updates):
+            await sockets[user].send_to(text_data=self.message(user, 'update_document_content', {'data': [update]}))
+
+        frame = json.loads(await sockets[self.viewer].receive_from())
+        self.assertEqual(frame['body']['data'], updates)
+        self.assertEqual(frame['revision'], 3)
+        self.assertEqual(json.loads(await sockets[self.owner].receive_from())['body']['data'], [updates[1]])
+        self.assertEqual(json.loads(await sockets[editor].receive_from())['body']['data'], [updates[0], updates[2]])
+        self.assertTrue(await sockets[self.viewer].receive_nothing())
+
+        self.assertEqual(BroadcastAggregator.events_sent - events_sent, 1)
+        self.assertEqual(BroadcastAggregator.events_saved - events_saved, 2)
+        await self.disconnect_all()
+
+    @skipUnless(codecs.msgpack, 'msgpack is not installed')
+    async def test_msgpack_subprotocol(self):
+        """ Ensure sockets asking for msgpack send and receive binary frames, alongside sockets using JSON """
+        owner = await self.connect(self.owner, subprotocols=['msgpack'])
+        self.assertEqual(await owner.connect(), (True, 'msgpack'))
+        viewer = await self.connect(self.viewer)
+        self.assertEqual(await viewer.connect(), (True, None))
+        packed_viewer = await self.connect(self.viewer, subprotocols=['msgpack'])
+        self.assertEqual(await packed_viewer.connect(), (True, 'msgpack'))
+
+        insert = {'data': [{'type': 'insert', 'block': 'aaaaa', 'position': 5, 'text': '!'}]}
+        await owner.send_to(bytes_data=codecs.msgpack.packb(json.loads(self.message(self.owner, 'update_document_content', insert))))
+        self.assertEqual(json.loads(await viewer.receive_from())['body'], insert)
+        self.assertEqual(codecs.msgpack.unpackb((await packed_viewer.receive_output())['bytes'])['body'], insert)
+
+        await owner.send_to(bytes_data=b'\xc1')
+        self.assertIn('errors', codecs.msgpack.unpackb((await owner.receive_output())['bytes']))
+        await self.disconnect_all()
+
+    @skipUnless(codecs.msgpack, 'msgpack is not installed')
+    async def test_unknown_fields_dropped(self):
+        """ Ensure only the validated fields of an operation are broadcast and logged, whatever else the client sends """
+        owner = await self.connect(self.owner, subprotocols=['msgpack'])
+        self.assertEqual(await owner.connect(), (True, 'msgpack'))
+        viewer = await self.connect(self.viewer)
+        self.assertTrue((await viewer.connect())[0])
+
+        insert = {'type': 'insert', 'block': 'aaaaa', 'position': '5', 'text': '!'}
+        message = json.loads(self.message(self.owner, 'update_document_content', {'data': [{**insert, 'x': 0}]}))
+        message['body']['data'][0]['x'] = b'\x00\x01'
+        await owner.send_to(bytes_data=codecs.msgpack.packb(message))
+        self.assertEqual(json.loads(await viewer.receive_from())['body']['data'], [{**insert, 'position': 5}])
+
+        await self.disconnect_all()
+        self.assertEqual((await ContentBlock.objects.aget(key='aaaaa')).text, 'Hello!')
+        self.assertEqual((await DocumentOperation.objects.aget(document=self.document)).data, {**insert, 'position': 5})
+
+    async def test_unknown_operation_rejected(self):
+        """ Ensure a batch with an update of an unknown type is rejected whole, rather than applied, logged and broadcast """
+        owner = await self.connect(self.owner)
+        self.assertTrue((await owner.connect())[0])
+        updates = [{'type': 'insert', 'block': 'aaaaa', 'position': 5, 'text': '!'}, {'type': 'bogus', 'block': 'aaaaa', 'position': 0}]
+        await owner.send_to(text_data=self.message(self.owner, 'update_document_content', {'data': updates}))
+        self.assertEqual(json.loads(await owner.receive_from())['errors'], [{'type': ['Unknown operation type']}])
+        self.assertEqual(DocumentSession.get_live(self.document.id).revision, 0)
+
+        await self.disconnect_all()
+        self.assertFalse(await DocumentOperation.objects.filter(document=self.document).aexists())
+        self.assertEqual((await ContentBlock.objects.aget(key='aaaaa')).text, 'Hello')
+
+    async def test_load_blocks(self):
+        """ Ensure a socket can page through the document's blocks, answered only to that socket """
+        viewer = await self.connect(self.viewer)
+        self.assertTrue((await viewer.connect())[0])
+        await viewer.send_to(text_data=self.message(self.viewer, 'load_blocks', {'offset': 0, 'limit': 10}))
+        response = json.loads(await viewer.receive_from())
+        self.assertEqual(response['type'], 'load_blocks')
+        self.assertEqual((response['body']['count'], response['body']['next']), (1, None))
+        self.assertEqual(response['body']['blocks'][0]['text'], 'Hello')
+
+        await viewer.send_to(text_data=self.message(self.viewer, 'load_blocks', {'after': 'zzzzz', 'limit': 10}))
+        self.assertIn('after', json.loads(await viewer.receive_from())['errors'][0])
+        await viewer.send_to(text_data=self.message(self.viewer, 'load_blocks', {}))
+        self.assertIn('limit', json.loads(await viewer.receive_from())['errors'][0])
+        await self.disconnect_all()
+
+    @override_settings(DOCUMENT_PRESENCE_INTERVAL=timedelta(milliseconds=20), DOCUMENT_PRESENCE_IDLE_AFTER=timedelta(milliseconds=400))
+    async def test_presence(self):
+        """
+        Ensure sockets sending their cursor are sent everyone present, each connection's latest
+        cursor once per interval, and when connections join, leave and go idle
+        """
+        owner = await self.connect(self.owner)
+        viewer = await self.connect(self.viewer)
+        self.assertTrue((await owner.connect())[0])
+        self.assertTrue((await viewer.connect())[0])
+
+        def cursor(offset: int) -> str:
+            # No access token, presence doesn't go through the checks edits do
+            return json.dumps({'type': 'presence', 'body': {
+                'anchorKey': 'aaaaa', 'anchorOffset': offset, 'focusKey': 'aaaaa', 'focusOffset': offset}})
+
+        await viewer.send_to(text_data=cursor(0))
+        joined = json.loads(await viewer.receive_from())['body']
+        self.assertEqual(joined['events'], [])
+        self.assertEqual(json.loads(await viewer.receive_from())['body']['events'][0]['event'], 'joined')
+        self.assertEqual(json.loads(await viewer.receive_from())['body']['events'][0]['event'], 'cursor')
+
+        # Only the latest of the moves made within an interval is sent
+        for offset in range(1, 6):
+            await owner.send_to(text_data=cursor(offset))
+        body = json.loads(await owner.receive_from())['body']
+        self.assertEqual([(event['event'], event['username'], event['selection']['focusOffset']) for event in body['events']],
+                         [('joined', 'viewer', 0)])
+        owner_connection = body['connection']
+        events = [json.loads(await viewer.receive_from())['body']['events'] for _ in range(2)]
+        self.assertEqual([[(event['event'], event['connection']) for event in frame] for frame in events],
+                         [[('joined', owner_connection)], [('cursor', owner_connection)]])
+        self.assertEqual(events[1][0]['selection']['anchorOffset'], 5)
+        # Sockets are sent their own events as well, to skip by their connection id
+        own = [json.loads(await owner.receive_from())['body']['events'][0]['connection'] for _ in range(2)]
+        self.assertEqual(own, [owner_connection] * 2)
+
+        await owner.send_to(text_data=json.dumps({'type': 'presence', 'body': {'anchorKey': 'aaaaa'}}))
+        self.assertIn('focusOffset', json.loads(await owner.receive_from(timeout=1))['errors'][0])
+        await owner.disconnect()
+        frames = [json.loads(await viewer.receive_from(timeout=1))['body']['events'] for _ in range(2)]
+        self.assertIn([{'event': 'left', 'connection': owner_connection}], frames)
+        self.assertEqual([event['event'] for frame in frames for event in frame if event['event'] != 'left'], ['idle'])
+        await self.disconnect_all()
+
+    @override_settings(SOCKET_RECEIVE_RATE=20, SOCKET_RECEIVE_BURST=2)
+    async def test_rate_limit(self):
+        """ Ensure messages over a socket's rate limit are held back until it's under the limit again, rather than dropped """
+        owner = await self.connect(self.owner)
+        self.assertTrue((await owner.connect())[0])
+        rate_limited = metrics.RATE_LIMITED.values.get((), 0)
+        start = monotonic()
+        for text in 'abc':
+            insert = {'data': [{'type': 'insert', 'block': 'aaaaa', 'position': 0, 'text': text}]}
+            await owner.send_to(text_data=self.message(self.owner, 'update_document_content', insert))
+        await owner.send_to(text_data=self.message(self.owner, 'load_blocks', {'offset': 0, 'limit': 10}))
+        response = json.loads(await owner.receive_from(timeout=1))
+        # Two messages over the burst, each waiting for a token
+        self.assertGreaterEqual(monotonic() - start, 0.1)
+        self.assertEqual(response['body']['blocks'][0]['text'], 'cbaHello')
+        self.assertEqual(metrics.RATE_LIMITED.values[()], rate_limited + 2)
+        await self.disconnect_all()
+
+    @override_settings(SOCKET_RECEIVE_RATE=0.5, SOCKET_RECEIVE_BURST=1, SOCKET_RECEIVE_QUEUE_SIZE=3)
+    async def test_rate_limited_socket_sent_broadcasts(self):
+        """ Ensure a socket waiting on its rate limit is still sent everyone else's edits, and is closed once it floods the queue """
+        editor = await sync_to_async(self.create_collaborator)('editor', DocumentCollaborator.EDITOR)
+        owner, other = await self.connect(self.owner), await self.connect(editor)
+        self.assertTrue((await owner.connect())[0])
+        self.assertTrue((await other.connect())[0])
+        for _ in range(2):
+            await owner.send_to(text_data=self.message(self.owner, 'load_blocks', {'offset': 0, 'limit': 10}))
+        self.assertEqual(json.loads(await owner.receive_from(timeout=1))['type'], 'load_blocks')
+
+        # The second message waits two seconds for a token, edits from everyone else aren't held up behind it
+        insert = {'data': [{'type': 'insert', 'block': 'aaaaa', 'position': 0, 'text': '!'}]}
+        await other.send_to(text_data=self.message(editor, 'update_document_content', insert))
+        frame = json.loads(await owner.receive_from(timeout=1))
+        self.assertEqual((frame['type'], frame['body']['data']), ('update_document_content', insert['data']))
+
+        flooding = metrics.FLOODING_SOCKETS.values.get((), 0)
+        for _ in range(3):
+            await owner.send_to(text_data=self.message(self.owner, 'load_blocks', {'offset': 0, 'limit': 10}))
+        self.assertEqual(await owner.receive_output(timeout=1), {'type': 'websocket.close', 'code': 1008})
+        self.assertEqual(metrics.FLOODING_SOCKETS.values[()], flooding + 1)
+        await self.disconnect_all()
+
+    async def test_metrics(self):
+        """ Ensure applied operations, errors and open sockets are exposed by the metrics endpoint """
+        owner = await self.connect(self.owner)
+        self.assertTrue((await owner.connect())[0])
+        operations = metrics.OPERATIONS.values.get(('insert',), 0)
+        errors = metrics.MESSAGE_ERRORS.values.get(('unknown',), 0)
+
+        insert = {'data': [{'type': 'insert', 'block': 'aaaaa', 'position': 5, 'text': '!'}]}
+        await owner.send_to(text_data=self.message(self.owner, 'update_document_content', insert))
+        await owner.send_to(text_data=self.message(self.owner, 'no_such_message', {}))
+        self.assertIn('errors', json.loads(await owner.receive_from()))
+        self.assertEqual(metrics.OPERATIONS.values[('insert',)], operations + 1)
+        self.assertEqual(metrics.MESSAGE_ERRORS.values[('unknown',)], errors + 1)
+
+        # Only served to a scraper with the token, as document ids are among the labels
+        self.assertEqual((await self.async_client.get('/metrics/')).status_code, 404)
+        with override_settings(METRICS_TOKEN='scraper'):
+            self.assertEqual((await self.async_client.get('/metrics/')).status_code, 401)
+            response = await self.async_client.get('/metrics/', headers={'Authorization': 'Bearer scraper'})
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn(f'editor_operations_total{{type="insert"}} {operations + 1:g}', text)
+        self.assertIn(f'editor_active_sockets{{document="{self.document.id}"}} 1', text)
+        self.assertIn('editor_operation_apply_seconds_bucket{type="insert",le="+Inf"}', text)
+        self.assertIn('editor_channel_layer_queued_messages 0', text)
+        await self.disconnect_all()
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+
+class Rope:
+    """
+    Editable text for blocks held in a live DocumentSession. Text longer than FLAT_SIZE is stored
+    as a list of short chunks so an insert or delete only rebuilds the chunk it lands in, rather
+    than the whole string. The chunk found by the last edit is remembered, so a user typing in one
+    spot doesn't need to walk the chunk list at all. A flat str is only built by `str(rope)`, which
+    is cached until the next edit.
+    Most blocks are far shorter, and are kept as a plain str which is sliced on every edit, as
+    copying that little text is quicker than finding and rebuilding a chunk (see benchmark_text).
+    Positions behave like str slicing, anything out of range is clamped to the text.
+    """
+    __slots__ = ('_chunks', '_length', '_cursor_index', '_cursor_start', '_text')
+    CHUNK_SIZE = 512
+    # Longest text kept flat, chunked text goes back to being flat once it's shrunk to half of this
+    FLAT_SIZE = 16_384
+
+    def __init__(self, text: str = '') -> None:
+        # None while the text is flat, and only held in _text
+        self._chunks: list[str] = None
+        self._length = len(text)
+        # Index and start position of the chunk used by the last edit
+        self._cursor_index = 0
+        self._cursor_start = 0
+        self._text: str = text
+        if self._length > self.FLAT_SIZE:
+            self._split()
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __str__(self) -> str:
+        if self._text is None:
+            self._text = ''.join(self._chunks)
+        return self._text
+
+    def __repr__(self) -> str:
+        if self._chunks is None:
+            return f'<Rope {len(self)} characters, flat>'
+        return f'<Rope {len(self)} characters, {len(self._chunks)} chunks>'
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (Rope, str)):
+            return str(self) == str(other)
+        return NotImplemented
+
+    def _clamp(self, position: int) -> int:
+        return min(max(position, 0), self._length)
+
+    def _split(self) -> None:
+        """ Break the flat text up into chunks """
+        text = self._text
+        self._chunks = [text[i:i + self.CHUNK_SIZE] for i in range(0, len(text), self.CHUNK_SIZE)] or ['']
+        self._cursor_index, self._cursor_start = 0, 0
+
+    def _locate(self, position: int) -> tuple[int, int]:
+        """ Index and start position of the chunk containing `position`, walking from the last one used """
+        index, start = self._cursor_index, self._cursor_start
+        chunks = self._chunks
+        while position < start:
+            index -= 1
+            start -= len(chunks[index])
+        while index < len(chunks) - 1 and position >= start + len(chunks[index]):
+            start += len(chunks[index])
+            index += 1
+        self._cursor_index, self._cursor_start = index, start
+        return index, start
+
+    def insert(self, position: int, text: str) -> None:
+        if self._chunks is None:
+            # Slicing already clamps positions past the end
+            flat = self._text
+            position = position if position > 0 else 0
+            self._text = flat[:position] + text + flat[position:]
+            self._length += len(text)
+            if self._length > self.FLAT_SIZE:
+                self._split()
+            return
+        if not text:
+            return
+        position = self._clamp(position)
+        if len(self._chunks) == 1:
+            # Short text, no chunks to search
+            index, offset = 0, position
+        else:
+            index, start = self._locate(position)
+            offset = position - start
+        chunk = self._chunks[index]
+        chunk = chunk[:offset] + text + chunk[offset:]
+
+        if len(chunk) > 2 * self.CHUNK_SIZE:
+            # Keep chunks short so later edits here stay cheap
+            self._chunks[index:index + 1] = [chunk[i:i + self.CHUNK_SIZE]
+                                             for i in range(0, len(chunk), self.CHUNK_SIZE)]
+            self._locate(position + len(text))
+        else:
+            self._chunks[index] = chunk
+        self._length += len(text)
+        self._text = None
+
+    def append(self, text: str) -> None:
+        self.insert(self._length, text)
+
+    def delete(self, start: int, end: int = None) -> None:
+        """ Remove the text between `start` and `end`, to the end of the text if `end` is None """
+        if self._chunks is None:
+            flat = self._text
+            start = start if start > 0 else 0
+            if end is None or end > start:
+                self._text = flat[:start] + flat[end:] if end is not None else flat[:start]
+                self._length = len(self._text)
+            return
+        start = self._clamp(start)
+        end = self._length if end is None else self._clamp(end)
+        if end <= start:
+            return
+
+        first, first_start = self._locate(start)
+        last, last_start = self._locate(end - 1)
+        chunk = self._chunks[first][:start - first_start] + \
+            self._chunks[last][end - last_start:]
+        self._chunks[first:last + 1] = [chunk] if chunk or len(self._chunks) == last - first + 1 else []
+
+        self._length -= end - start
+        self._text = None
+        # Chunks after the deleted range have moved, start walking again from the edit
+        self._cursor_index, self._cursor_start = min(
+            first, len(self._chunks) - 1), first_start
+        if self._cursor_index < first:
+            self._cursor_start -= len(self._chunks[self._cursor_index])
+        if self._length <= self.FLAT_SIZE // 2:
+            self._text, self._chunks = ''.join(self._chunks), None
+
+    def slice(self, start: int, end: int = None) -> str:
+        """ Equivalent to str(rope)[start:end] without building the whole string """
+        start = self._clamp(start)
+        end = self._length if end is None else self._clamp(end)
+        if end <= start:
+            return ''
+        if self._text is not None:
+            return self._text[start:end]
+
+        first, first_start = self._locate(start)
+        last, last_start = self._locate(end - 1)
+        if first == last:
+            return self._chunks[first][start - first_start:end - first_start]
+        return ''.join([
+            self._chunks[first][start - first_start:],
+            *self._chunks[first + 1:last],
+            self._chunks[last][:end - last_start],
+        ])
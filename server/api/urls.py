@@ -4,8 +4,13 @@ from api.views import *
 
 urlpatterns = [
     path('documents/', DocumentsListCreateView.as_view(), name='documents'),
+    path('documents/search/', DocumentSearchView.as_view(), name='document-search-view'),
     path('documents/<str:pk>/', DocumentView.as_view(), name='document-view'),
+    path('documents/<str:pk>/operations/', DocumentOperationsView.as_view(),
+         name='document-operations-view'),
+    path('documents/<str:pk>/blocks/', DocumentBlocksView.as_view(),
+         name='document-blocks-view'),
     path('collaborators/', CollaboratorsView.as_view(),
          name='document-collaborators-view'),
-    path('users/search/', UserSearchView.as_view(), name='user-search-view'),
+    path('users/autocomplete/', UserAutocompleteView.as_view(), name='user-autocomplete-view'),
 ]
@@ -1,21 +1,66 @@
-# NOTE Potentially a future basis for ranking content blocks
-def increment_rank(rank: str, increment: int = 1) -> str:
-    """ Increment base 26 encoded rank id """
-    if (val := ord(rank[-1]) + increment) > 122:
-        # Value has overflown into character to left
-        if rank[-2] != 'z':
-            new_rank: str = rank[:-2] + chr(ord(rank[-2]) + 1) + chr(val - 26)
-        else:
-            # 2nd last char is a z, need to incrememt through
-            new_rank: str = rank[:-1] + chr(val - 26)
-
-            i = -2
-            while ord(new_rank[i]) >= 122:
-                if -i == len(new_rank):
-                    new_rank = 'a' + new_rank
-                new_rank = new_rank[:i] + 'a' + new_rank[i + 1:]
-                i -= 1
-
-        return new_rank
-    else:
-        return rank[:-1] + chr(val)
+"""
+Fractional indexing used to rank ContentBlocks within a document.
+
+Ranks are base 26 fractions written with the digits a-z (a = 0), so 'n' is one half and
+'an' is one fifty-second. Comparing two ranks as plain strings gives the same order as
+comparing the fractions, which lets the database order blocks by rank while a new block
+can always be given a rank between its neighbours without renumbering anything else.
+A rank never ends in an 'a', otherwise there would be no room left directly below it.
+"""
+RANK_BASE = 26
+RANK_MIN_DIGIT = ord('a')
+# Once a generated rank gets longer than this its document should be rebalanced
+RANK_REBALANCE_LENGTH = 32
+
+
+def rank_digit(rank: str, i: int, default: int) -> int:
+    """ Numeric value of the i'th digit of a rank, `default` if the rank is shorter than that """
+    return ord(rank[i]) - RANK_MIN_DIGIT if i < len(rank) else default
+
+
+def rank_between(before: str = None, after: str = None) -> str:
+    """
+    Generate a rank which sorts between `before` and `after`. Either can be None to
+    generate a rank at the start or end of the document respectively.
+    """
+    before = before or ''
+    if after is not None and before >= after:
+        raise ValueError(f'Rank {before!r} must sort before {after!r}')
+
+    rank = ''
+    i = 0
+    while True:
+        low = rank_digit(before, i, 0)
+        high = rank_digit(after, i, RANK_BASE) if after is not None else RANK_BASE
+
+        if high - low > 1:
+            # Room for a digit of its own between the two neighbours
+            return rank + chr(RANK_MIN_DIGIT + (low + high) // 2)
+
+        rank += chr(RANK_MIN_DIGIT + low)
+        if low < high:
+            # Now strictly below `after` whatever follows, only `before` still bounds the rank
+            after = None
+        i += 1
+
+
+def evenly_spaced_ranks(count: int) -> list[str]:
+    """ Generate `count` ascending ranks spread evenly over the whole rank space, as short as possible """
+    width = 1
+    while RANK_BASE ** width <= count:
+        width += 1
+
+    ranks = []
+    for i in range(1, count + 1):
+        value = i * RANK_BASE ** width // (count + 1)
+        digits = []
+        for _ in range(width):
+            value, digit = divmod(value, RANK_BASE)
+            digits.append(chr(RANK_MIN_DIGIT + digit))
+        ranks.append(''.join(reversed(digits)).rstrip('a'))
+    return ranks
+
+
+def needs_rebalance(rank: str) -> bool:
+    """ Determine wether a rank has grown long enough that its document should be re-ranked """
+    return len(rank) > RANK_REBALANCE_LENGTH
@@ -1,19 +1,50 @@
+from hashlib import blake2b
 from rest_framework.generics import (
     CreateAPIView,
     ListCreateAPIView,
     RetrieveUpdateDestroyAPIView,
-    ListAPIView
 )
-from rest_framework import filters
-from api.models import Document, DocumentCollaborator
-from api.serializers import DocumentSerializer, DocumentCollaboratorSerializer
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.shortcuts import get_object_or_404
+from django.utils.crypto import constant_time_compare
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from asgiref.sync import async_to_sync
+from api import codecs, metrics as api_metrics
+from api.autocomplete import username_prefix_cache
+from api.models import Document, DocumentCollaborator, ContentBlock
+from api.permissions import permission_cache
+from api.session import DocumentSession
+from api.snapshots import snapshot_cache
+from api.pagination import DocumentCursorPagination
+from api.search import search_documents
+from api.serializers import (
+    DocumentSerializer, DocumentSummarySerializer, DocumentCollaboratorSerializer, SyncDocumentSerializer, BlocksWindowSerializer,
+    DocumentSearchSerializer, UserAutocompleteSerializer, editor_content, blocks_window,
+)
 from authentication.models import User
 from authentication.serializers import UserSerializer
 
 
 class DocumentsListCreateView(ListCreateAPIView):
-    """ API view that lists all documents a user has permissions for """
+    """
+    API view that lists summaries of all documents a user has permissions for, a page at a time,
+    in a single query. Creating a document returns it in full, ready to be edited.
+    """
     serializer_class = DocumentSerializer
+    pagination_class = DocumentCursorPagination
+
+    def get_serializer_class(self):
+        if self.request.method == 'GET':
+            return DocumentSummarySerializer
+        return super().get_serializer_class()
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -31,31 +62,188 @@ class DocumentsListCreateView(ListCreateAPIView):
         user has access to. This method has been implemented instead
         of the queryset keyword.
         """
-        user = self.request.user
-        return Document.objects.filter(collaborators__user=user)
+        return user_documents(self.request.user)
+
+
+def user_documents(user: User):
+    """ Documents a user collaborates on, annotated as DocumentSummarySerializer expects """
+    collaborator_count = DocumentCollaborator.objects.filter(document=OuterRef('pk')).order_by().values(
+        'document').annotate(count=Count('pk')).values('count')
+    # The permission annotation reuses the join filtering to the user's own collaborator row
+    return Document.objects.filter(collaborators__user=user).annotate(
+        permission=F('collaborators__permission'),
+        collaborator_count=Subquery(collaborator_count),
+    )
+
+
+class DocumentSearchView(APIView):
+    """
+    API view searching the titles and text of the documents a user collaborates on (`?q=`), best
+    match first. Each result is a document summary with the offsets of any matches in its title,
+    the key of the block which best matched and a snippet of its text with the matches within it.
+    """
+
+    def get(self, request: Request, format=None) -> Response:
+        serializer = DocumentSearchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        matches: list[dict] = search_documents(
+            request.user, serializer.validated_data['q'], serializer.validated_data['limit'])
+
+        documents = {document.id: document for document in user_documents(request.user).filter(
+            pk__in=[match['id'] for match in matches])}
+        return Response({'results': [
+            {**DocumentSummarySerializer(documents[match.pop('id')]).data, **match}
+            for match in matches if match['id'] in documents
+        ]})
 
 
 class DocumentView(RetrieveUpdateDestroyAPIView):
-    """ API view for editing documents """
-    queryset = Document.objects.all()
+    """
+    API view for editing documents. Documents are served with an ETag, a reopen with a matching
+    If-None-Match gets a 304 without the content being loaded, otherwise the content comes from
+    snapshot_cache when the document hasn't changed since it was last opened. The websocket
+    authentication ticket is sent in the X-Authentication-Ticket header, so it's fresh on a 304.
+    """
     serializer_class = DocumentSerializer
 
+    def get_queryset(self):
+        # Only collaborators can see a document, anyone else gets a 404 as if it didn't exist
+        return Document.objects.filter(collaborators__user=self.request.user)
+
     def get_serializer_context(self):
         context = super().get_serializer_context()
         context['user'] = self.request.user
         if self.request.method == 'GET':
             context['generate_authentication_ticket'] = True
+            context['include_editor'] = False
         return context
 
+    def retrieve(self, request: Request, *args, **kwargs) -> HttpResponse:
+        self.flush_session()
+        # The document and its blocks are read in one transaction, so the revision the ETag and
+        # snapshot are keyed by is never older than the content served with it. Nested in a
+        # transaction already, this one needs no savepoint of its own
+        with transaction.atomic(savepoint=False):
+            return self.respond(request, super().get_object())
+
+    def respond(self, request: Request, document: Document) -> HttpResponse:
+        representation: dict = self.get_serializer(document).data
+        headers = {
+            'X-Authentication-Ticket': representation.pop('authentication_ticket'),
+            # Browsers keep the response, but check it's still current every time
+            'Cache-Control': 'private, no-cache',
+        }
+
+        # Editor content only changes along with the revision, everything else is in the representation
+        summary: str = codecs.dumps(representation)
+        headers['ETag'] = f'"{blake2b(f"{document.revision}:{summary}".encode(), digest_size=16).hexdigest()}"'
+        if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+        if headers['ETag'] in if_none_match or '*' in if_none_match:
+            return HttpResponse(status=304, headers=headers)
+
+        content: str = snapshot_cache.get(document.id, document.revision)
+        if content is None:
+            content = codecs.dumps(editor_content(document))
+            snapshot_cache.put(document.id, document.revision, content)
+        return HttpResponse(f'{summary[:-1]},"editor":{content}}}', content_type='application/json', headers=headers)
+
+    def get_object(self) -> Document:
+        self.flush_session()
+        return super().get_object()
+
+    def flush_session(self) -> None:
+        # Turn away anyone who isn't a collaborator before an open session is flushed for them, or
+        # an ETag or snapshot is looked at. Cached, so it doesn't cost collaborators a query
+        if permission_cache.get(self.kwargs['pk'], self.request.user.id) is None:
+            raise NotFound()
+        # Make sure edits still held in memory by an open editing session are included
+        async_to_sync(DocumentSession.flush_document)(self.kwargs['pk'])
+
+
+class DocumentOperationsView(APIView):
+    """
+    API view for a reconnecting client to catch up on the operations applied since the last
+    revision it saw (`?revision=`). If too many have been applied since then, the whole
+    document's content is returned under `editor` instead of `operations`.
+    """
+
+    def get(self, request: Request, pk: str, format=None) -> Response:
+        document: Document = get_object_or_404(
+            Document.objects.filter(collaborators__user=request.user), pk=pk)
+        serializer = SyncDocumentSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        revision: int = serializer.validated_data['revision']
+
+        # Make sure operations still held in memory by an open editing session are included
+        async_to_sync(DocumentSession.flush_document)(pk)
+        document.refresh_from_db()
+
+        body = {'revision': document.revision, 'title': document.title}
+        if revision <= document.revision and document.revision - revision <= settings.DOCUMENT_OPERATION_CATCHUP_LIMIT:
+            body['operations'] = list(document.operations.filter(
+                revision__gt=revision).values_list('data', flat=True))
+        else:
+            body['editor'] = editor_content(document)
+        return Response(body)
+
+
+class DocumentBlocksView(APIView):
+    """
+    API view for a window of a large document's blocks (`?limit=` from `?offset=`, or `?after=` a
+    block key), so the editor can load the blocks in view before the rest. Along with the blocks
+    comes the total block count, where the window starts and the key to continue after (`next`).
+    """
+
+    def get(self, request: Request, pk: str, format=None) -> Response:
+        document: Document = get_object_or_404(
+            Document.objects.filter(collaborators__user=request.user), pk=pk)
+        serializer = BlocksWindowSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+
+        # Make sure edits still held in memory by an open editing session are included
+        async_to_sync(DocumentSession.flush_document)(pk)
+        document.refresh_from_db()
+        try:
+            return Response(blocks_window(document, **serializer.validated_data))
+        except ContentBlock.DoesNotExist:
+            return Response({'after': ['Content block does not exist.']}, status=status.HTTP_400_BAD_REQUEST)
+
 
 class CollaboratorsView(CreateAPIView):
     serializer_class = DocumentCollaboratorSerializer
 
 
-class UserSearchView(ListAPIView):
-    # TODO Filter search results to not show users already in document, and
-    #    prevent users from being added in consumer/serializer
-    queryset = User.objects.all()
-    serializer_class = UserSerializer
-    filter_backends = [filters.SearchFilter]
-    search_fields = ['username']
+class UserAutocompleteView(APIView):
+    """
+    API view autocompleting the username typed into the add collaborator box (`?q=`), by case
+    insensitive prefix. Given a `document` the caller collaborates on, users who are already its
+    collaborators are left out. Users matching each prefix come from username_prefix_cache.
+    """
+
+    def get(self, request: Request, format=None) -> Response:
+        serializer = UserAutocompleteSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        excluded = {request.user.id}
+        if (document_id := serializer.validated_data.get('document')) is not None:
+            document: Document = get_object_or_404(
+                Document.objects.filter(collaborators__user=request.user), pk=document_id)
+            excluded.update(document.collaborators.values_list('user_id', flat=True))
+
+        users = [user for user in username_prefix_cache.get(serializer.validated_data['q']) if user.id not in excluded]
+        return Response({'results': UserSerializer(
+            users[:serializer.validated_data['limit']], many=True, context={'request': request}).data})
+
+
+async def metrics(request: HttpRequest) -> HttpResponse:
+    """
+    Metrics for this process in the Prometheus text format. Runs on the event loop the sockets
+    do, so live sessions and channel layer queues are read without racing them.
+    Requires `Authorization: Bearer <METRICS_TOKEN>`, and is a 404 while METRICS_TOKEN is unset,
+    as its labels include document ids.
+    """
+    if not settings.METRICS_TOKEN:
+        return HttpResponse(status=404)
+    if not constant_time_compare(
+            request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_TOKEN}'):
+        return HttpResponse(status=401)
+    return HttpResponse(api_metrics.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
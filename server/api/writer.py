@@ -0,0 +1,139 @@
+"""
+Writes made by live documents, run on dedicated writer threads rather than the thread pool
+database_sync_to_async shares with every read.
+
+SQLite lets one connection write at a time, so writes from several pool threads at once only queue
+up on the database lock, and fail with "database is locked" if they wait longer than its timeout.
+Instead every write for a document goes through the same writer thread, which commits everything
+queued whilst it was committing the last transaction in a single transaction of its own, so a burst
+of small flushes from many documents costs one commit rather than one each. Reads stay on the
+thread pool, which in WAL mode never waits on a writer.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from time import perf_counter
+from typing import Any, Callable
+from django.conf import settings
+from django.db import connection, transaction
+from channels.db import database_sync_to_async
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseWriter:
+    """
+    Thread running writes one after another, group committing up to `max_batch` at a time.
+    Each write runs in a savepoint, one which raises is rolled back on its own and the rest of its
+    group are still committed. A write's result is only returned once it has been committed.
+    """
+
+    def __init__(self, name: str, max_batch: int) -> None:
+        self.name = name
+        self.max_batch = max_batch
+        self._queue: queue.SimpleQueue[tuple[Future, Callable, tuple]] = queue.SimpleQueue()
+        self._thread: threading.Thread = None
+        self._lock = threading.Lock()
+
+    async def run(self, function: Callable, *args) -> Any:
+        """ Run `function(*args)` on the writer thread, returning its result once committed """
+        return await asyncio.wrap_future(self.submit(function, *args))
+
+    def submit(self, function: Callable, *args) -> Future:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((future, function, args))
+        return future
+
+    def stop(self) -> None:
+        """ Stop the thread once everything already queued has been written """
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            # Everything queued whilst the last group was being committed is committed together
+            while len(batch) < self.max_batch and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                self._commit(batch)
+            if stopping:
+                connection.close()
+                return
+
+    def _commit(self, batch: list[tuple[Future, Callable, tuple]]) -> None:
+        start = perf_counter()
+        results = []
+        try:
+            with transaction.atomic():
+                for future, function, args in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with transaction.atomic():
+                            results.append((future, function(*args), None))
+                    except Exception as error:
+                        results.append((future, None, error))
+        except Exception as error:
+            # The commit itself failed, nothing in the group was written
+            logger.exception('Failed to commit %s writes', len(batch))
+            # The connection is usually kept open between groups, start afresh in case it's broken
+            connection.close()
+            for future, function, args in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        metrics.WRITE_GROUP_SIZE.observe(len(batch))
+        metrics.WRITE_GROUP_SECONDS.observe(perf_counter() - start)
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+class DatabaseWriters:
+    """
+    DATABASE_WRITER_SHARDS writer threads, which writes are shared between by key so each document's
+    writes are made in order by the same thread. Threads are started as they're first needed.
+    With no writer threads, writes are run on the thread pool like any other query.
+    """
+
+    def __init__(self) -> None:
+        self.writers: list[DatabaseWriter] = []
+
+    def writer_for(self, key: Any) -> DatabaseWriter:
+        shards = settings.DATABASE_WRITER_SHARDS
+        if not shards:
+            return None
+        while len(self.writers) < shards:
+            self.writers.append(DatabaseWriter(f'database-writer-{len(self.writers)}', settings.DATABASE_WRITER_MAX_BATCH))
+        return self.writers[hash(str(key)) % shards]
+
+    async def run(self, key: Any, function: Callable, *args) -> Any:
+        """ Run `function(*args)` on the writer thread for `key`, returning its result once committed """
+        writer = self.writer_for(key)
+        if writer is None:
+            return await database_sync_to_async(function)(*args)
+        return await writer.run(function, *args)
+
+
+database_writers = DatabaseWriters()
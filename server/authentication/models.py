@@ -1,5 +1,6 @@
 from uuid import uuid4
 from django.db import models
+from django.db.models.functions import Lower
 from django.contrib.auth.models import AbstractUser
 
 
@@ -13,3 +14,9 @@ class User(AbstractUser):
         null=True, default=None, unique=True)
     authentication_ticket_expires_at = models.DateTimeField(
         null=True, default=None)
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Autocompletes usernames by case insensitive prefix, see api.autocomplete
+            models.Index(Lower('username'), name='user_username_lower'),
+        ]
@@ -91,6 +91,17 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Running several ASGI worker processes, e.g. `uvicorn --workers 4`, needs every worker
+# connected to one broker process started with `python manage.py runbroker`
+CHANNEL_BROKER_SOCKET = os.environ.get('CHANNEL_BROKER_SOCKET')
+if CHANNEL_BROKER_SOCKET:
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'api.layers.BrokerChannelLayer',
+        'CONFIG': {
+            'path': CHANNEL_BROKER_SOCKET,
+        },
+    }
+
 WSGI_APPLICATION = 'collaborative_text_editor.wsgi.application'
 
 
@@ -101,6 +112,16 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Readers and the writer don't block each other in WAL mode, and with it commits only need
+            # syncing at checkpoints to be safe from corruption (a power cut can lose the latest commits)
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            # Seconds to wait for another connection's write lock, rather than failing with "database is locked"
+            'timeout': 20,
+            # Take the write lock when a transaction starts, a transaction which reads first and can't
+            # upgrade its lock once another connection has written fails straight away whatever the timeout
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
@@ -175,3 +196,70 @@ SIMPLE_JWT = {
 }
 
 AUTHENTICATION_TICKET_EXPIRE_TIME_DELTA = timedelta(seconds=5)
+
+
+# Live document sessions
+
+# How often edits held in memory by an open document are written back to the database,
+# each flush is a single transaction. Set to zero to write every update batch through immediately
+DOCUMENT_SESSION_FLUSH_INTERVAL = timedelta(seconds=5)
+
+# Number of missed operations a reconnecting client can be sent before it's sent the whole document instead
+DOCUMENT_OPERATION_CATCHUP_LIMIT = 500
+
+# How long a document's outgoing edits are collected for before being broadcast as a single frame
+# to each socket, 16-50ms keeps fast typists from flooding everyone else. Zero broadcasts every batch straight away
+DOCUMENT_BROADCAST_WINDOW = timedelta(0)
+
+# Edits are broadcast before the window is up once this many operations are waiting
+DOCUMENT_BROADCAST_MAX_OPERATIONS = 200
+
+# How long cursor moves are collected for before being sent to a document's sockets as one frame,
+# only each connection's latest cursor is sent. Connections are sent as idle once their cursor hasn't moved for IDLE_AFTER
+DOCUMENT_PRESENCE_INTERVAL = timedelta(milliseconds=50)
+DOCUMENT_PRESENCE_IDLE_AFTER = timedelta(minutes=1)
+
+# Most frames waiting to be sent to a single socket. A socket this far behind has its queued cursors
+# coalesced, then its queued edits replaced by a snapshot of the document, and is closed if it's still behind
+SOCKET_SEND_QUEUE_SIZE = 64
+
+# Messages a single socket can send a second on average, in bursts of up to SOCKET_RECEIVE_BURST.
+# Messages over the limit wait until the socket is back under it, and a socket with
+# SOCKET_RECEIVE_QUEUE_SIZE messages waiting is closed. Cursor moves aren't limited
+SOCKET_RECEIVE_RATE = 30
+SOCKET_RECEIVE_BURST = 60
+SOCKET_RECEIVE_QUEUE_SIZE = 256
+
+# Threads live documents write to the database on, each document always writing on the same one.
+# SQLite only lets one connection write at a time, so more than one only helps with other databases.
+# Zero writes on the thread pool along with every other query instead
+DATABASE_WRITER_SHARDS = 1
+
+# Most writes a writer thread commits together in one transaction
+DATABASE_WRITER_MAX_BATCH = 64
+
+# Most blocks a client can load at once when paging through a large document
+DOCUMENT_BLOCKS_PAGE_LIMIT = 500
+
+# Most documents a single search returns
+DOCUMENT_SEARCH_LIMIT = 50
+
+# Characters of encoded document content DocumentView keeps cached for reopening unchanged documents
+DOCUMENT_SNAPSHOT_CACHE_SIZE = 64 * 1024 * 1024
+
+# Bearer token Prometheus has to scrape the metrics/ endpoint with, which isn't served at all while unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Maximum number of (document, user) permission levels cached by api.permissions, and for how long.
+# Changes made by other processes aren't seen until the cached permission expires
+COLLABORATOR_PERMISSION_CACHE_SIZE = 10_000
+COLLABORATOR_PERMISSION_CACHE_TTL = timedelta(seconds=10)
+
+# Most users the add collaborator autocomplete returns at once
+USER_AUTOCOMPLETE_LIMIT = 20
+
+# Users cached per autocompleted username prefix, and for how long. Candidates are cached before a
+# document's collaborators are left out, so there should be enough left to fill USER_AUTOCOMPLETE_LIMIT
+USER_AUTOCOMPLETE_CANDIDATES = 50
+USER_AUTOCOMPLETE_CACHE_TTL = timedelta(seconds=30)
+USER_AUTOCOMPLETE_CACHE_SIZE = 1000
@@ -17,6 +17,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from api.views import metrics
 
 urlpatterns = [
     path('api/', include([
@@ -24,6 +25,7 @@ urlpatterns = [
         path('', include('api.urls')),
     ])),
     path('admin/', admin.site.urls),
+    path('metrics/', metrics, name='metrics'),
 ]
 
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)